@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Latency of one colorization step (net_forward with fresh hints) for the eager
+# pytorch model against the TorchScript and ONNX exports of the same weights.
+#
+#   python -m models.pytorch.export --color_model ./models/pytorch/caffemodel.pth
+#   python benchmark_backends.py --color_model ./models/pytorch/caffemodel.pth
+#
+# It also reports the largest difference of each backend's ab prediction and
+# distribution to the eager ones.
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+import torch
+
+from data import colorize_image as CI
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='benchmark inference backends')
+    parser.add_argument('--image_file', dest='image_file', type=str, default='./test_imgs/mortar_pestle.jpg')
+    parser.add_argument('--color_model', dest='color_model', type=str, default='./models/pytorch/caffemodel.pth')
+    parser.add_argument('--backends', dest='backends', nargs='+', default=['eager', 'torchscript', 'onnx'])
+    parser.add_argument('--load_size', dest='load_size', type=int, default=256)
+    parser.add_argument('--iters', dest='iters', type=int, default=20)
+    parser.add_argument('--warmup', dest='warmup', type=int, default=3)
+    parser.add_argument('--threads', dest='threads', type=int, default=None, help='cpu threads, all cores if not set')
+    return parser.parse_args()
+
+
+def random_hints(rng, Xd, n=10):
+    input_ab = np.zeros((2, Xd, Xd))
+    input_mask = np.zeros((1, Xd, Xd))
+    for y, x in rng.randint(0, Xd - 4, (n, 2)):
+        input_ab[:, y:y + 4, x:x + 4] = rng.uniform(-100, 100, (2, 1, 1))
+        input_mask[:, y:y + 4, x:x + 4] = 1
+    return input_ab, input_mask
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    print('%d cpu threads' % torch.get_num_threads())
+    outputs = {}
+    for backend in args.backends:
+        model = CI.ColorizeImageTorchDist(Xd=args.load_size)
+        model.prep_net(gpu_id=-1, path=args.color_model, backend=backend)
+        model.cache.max_bytes = 0  # time the network, not the prediction cache
+        model.load_image(args.image_file)
+        rng = np.random.RandomState(0)
+        times = []
+        for it in range(args.warmup + args.iters):
+            input_ab, input_mask = random_hints(rng, args.load_size)
+            t = time.time()
+            model.net_forward(input_ab, input_mask, return_rgb=False)
+            if it >= args.warmup:
+                times.append(time.time() - t)
+        outputs[backend] = (model.output_ab.copy(), model.dist_ab.copy())
+        print('%-12s %8.1f ms/forward (median %.1f)' % (backend, 1000 * np.mean(times), 1000 * np.median(times)))
+
+    if 'eager' in outputs:
+        ref_ab, ref_dist = outputs['eager']
+        for backend, (output_ab, dist_ab) in outputs.items():
+            if backend != 'eager':
+                print('%-12s max |ab - eager| %.2e, max |dist - eager| %.2e' % (
+                    backend, np.abs(output_ab - ref_ab).max(), np.abs(dist_ab - ref_dist).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Compares get_ab_reccs(method='modes') against the original KMeans sampler
+# (method='sample') on the predicted distributions of a few images.
+#
+#   python benchmark_suggestions.py --color_model ./models/pytorch/caffemodel.pth test_imgs/*.jpg
+#
+# For each method it reports the time per call and the weighted k-means cost
+# E_p[min_k |ab - center_k|^2] of the suggestions under the predicted
+# distribution (lower is better). It also reports how far each
+# 'modes' color is from the nearest 'sample' color.
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+
+from data import colorize_image as CI
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='benchmark color suggestions')
+    parser.add_argument('images', nargs='*', default=['./test_imgs/mortar_pestle.jpg'])
+    parser.add_argument('--color_model', dest='color_model', type=str, default='./models/pytorch/caffemodel.pth')
+    parser.add_argument('--pytorch_maskcent', dest='pytorch_maskcent', action='store_true')
+    parser.add_argument('--gpu', dest='gpu', type=int, default=-1)
+    parser.add_argument('--K', dest='K', type=int, default=9, help='colors per suggestion')
+    parser.add_argument('--N', dest='N', type=int, default=25000, help='samples drawn by the sampler')
+    parser.add_argument('--points', dest='points', type=int, default=50, help='random pixels per image')
+    return parser.parse_args()
+
+
+def weighted_cost(pts_ab, probs, centers):
+    d2 = np.sum((pts_ab[:, np.newaxis, :] - centers[np.newaxis, :, :])**2, axis=2)
+    return np.dot(probs / np.sum(probs), np.min(d2, axis=1))
+
+
+def main():
+    args = parse_args()
+    model = CI.ColorizeImageTorchDist(Xd=256, maskcent=args.pytorch_maskcent)
+    model.prep_net(gpu_id=args.gpu, path=args.color_model, dist=True)
+    rng = np.random.RandomState(0)
+
+    times = {'modes': [], 'sample': []}
+    costs = {'modes': [], 'sample': []}
+    match_dist = []
+    conf_diff = []
+    for image_file in args.images:
+        model.load_image(image_file)
+        model.net_forward(np.zeros((2, 256, 256)), np.zeros((1, 256, 256)))
+        for h, w in rng.randint(0, 256, (args.points, 2)):
+            reccs = {}
+            for method in ('modes', 'sample'):
+                t = time.time()
+                reccs[method] = model.get_ab_reccs(h=h, w=w, K=args.K, N=args.N, return_conf=True, method=method)
+                times[method].append(time.time() - t)
+                costs[method].append(weighted_cost(model.pts_in_hull, model.dist_ab[:, h, w], reccs[method][0]))
+            ab_modes, conf_modes = reccs['modes']
+            ab_sample, conf_sample = reccs['sample']
+            d2 = np.sum((ab_modes[:, np.newaxis, :] - ab_sample[np.newaxis, :, :])**2, axis=2)
+            match_dist.append(np.mean(np.sqrt(np.min(d2, axis=1))))
+            conf_diff.append(np.abs(conf_modes[0] - conf_sample[0]))
+
+    n = len(times['modes'])
+    print('%d suggestions of K=%d over %d images' % (n, args.K, len(args.images)))
+    for method in ('sample', 'modes'):
+        print('%-7s %8.2f ms/call   weighted cost %8.2f' % (method, 1000 * np.mean(times[method]), np.mean(costs[method])))
+    print('speedup %.1fx' % (np.mean(times['sample']) / np.mean(times['modes'])))
+    print('modes colors are %.2f ab from the nearest sampled color on average' % np.mean(match_dist))
+    print('top confidence differs by %.3f on average' % np.mean(conf_diff))
+    print('modes cost within 1%% of the sampler or lower at %.0f%% of the pixels' % (
+        100 * np.mean(np.array(costs['modes']) <= 1.01 * np.array(costs['sample']))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+from __future__ import print_function
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import cv2
+
+from data import colorize_image as CI
+from data import image_writer
+
+IMG_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+PROGRESS_FILE = 'progress.txt'
+# datetime suffix of the folders GUIDraw.save_result writes, '%y%m%d_%H%M%S'
+SAVE_SUFFIX = re.compile(r'^\d{6}_\d{6}$')
+
+# model held by each pool worker, loaded once in init_worker
+_worker_model = None
+_worker_opts = None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='ideepcolor.py batch', description='iDeepColor: headless batch colorization')
+    parser.add_argument('inputs', nargs='+', help='image files, directories of images, or .txt files listing image paths')
+    parser.add_argument('--out_dir', dest='out_dir', help='directory for the colorized results', type=str, required=True)
+    parser.add_argument('--hints_dir', dest='hints_dir', help='directory with <image name>/im_ab.npy and im_mask.npy hint files', type=str, default=None)
+    parser.add_argument('--color_model', dest='color_model', help='colorization model', type=str,
+                        default='./models/pytorch/caffemodel.pth')
+    parser.add_argument('--backend', dest='backend', help='eager pytorch, or a model exported by models/pytorch/export.py', type=str,
+                        choices=['eager', 'torchscript', 'onnx'], default='eager')
+    parser.add_argument('--quantized', dest='quantized', help='--color_model is an int8 checkpoint written by models/pytorch/quantize.py', action='store_true')
+    parser.add_argument('--optimize', dest='optimize', help='run a batch norm folded, channels_last copy of the model under inference_mode', action='store_true')
+    parser.add_argument('--pytorch_maskcent', dest='pytorch_maskcent', help='need to center mask (activate for siggraph_pretrained but not for converted caffemodel)', action='store_true')
+    parser.add_argument('--gpu', dest='gpu', help='gpu id', type=int, default=-1)
+    parser.add_argument('--workers', dest='workers', help='number of worker processes, 0 runs in this process', type=int, default=max(1, multiprocessing.cpu_count() // 4))
+    parser.add_argument('--batch_size', dest='batch_size', help='images per forward pass, chosen from --mem_budget if not set', type=int, default=None)
+    parser.add_argument('--mem_budget', dest='mem_budget', help='activation memory budget per worker in MB', type=int, default=1024)
+    parser.add_argument('--load_size', dest='load_size', help='image size', type=int, default=256)
+    parser.add_argument('--keep_aspect', dest='keep_aspect', help='run at about load_size^2 pixels with the aspect ratio of each image, as the GUI does with --keep_aspect', action='store_true')
+    parser.add_argument('--no_fullres', dest='fullres', help='only save the load_size result', action='store_false')
+    return parser.parse_args(argv)
+
+
+def list_images(inputs):
+    img_list = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(IMG_EXTS):
+                    img_list.append(os.path.join(path, name))
+        elif path.lower().endswith('.txt'):
+            with open(path) as f:
+                img_list += [line.strip() for line in f if line.strip()]
+        else:
+            img_list.append(path)
+    return img_list
+
+
+def find_hints(img_path, hints_dir=None, method='with_dist'):
+    ''' Look for im_ab.npy/im_mask.npy written by GUIDraw.save_result, either in
+    hints_dir/<image name>/ or in the newest <image>_<method>_<yymmdd>_<HHMMSS>/ folder
+    next to the image; method is GUIDraw.method. Returns (input_ab, input_mask) or None '''
+    stem = os.path.splitext(os.path.basename(img_path))[0]
+    candidates = []
+    if hints_dir is not None:
+        candidates.append(os.path.join(hints_dir, stem))
+    # exactly the folder names save_result makes, so park.jpg does not pick up park_2.jpg's hints
+    prefix = os.path.splitext(os.path.abspath(img_path))[0] + '_' + method + '_'
+    saved = [path for path in glob.glob(glob.escape(prefix) + '*') if SAVE_SUFFIX.match(path[len(prefix):])]
+    # the timestamps sort chronologically, newest first
+    candidates += sorted(saved, key=lambda path: path[len(prefix):], reverse=True)
+    for cand in candidates:
+        ab_path = os.path.join(cand, 'im_ab.npy')
+        mask_path = os.path.join(cand, 'im_mask.npy')
+        if os.path.exists(ab_path) and os.path.exists(mask_path):
+            return (np.load(ab_path), np.load(mask_path))
+    return None
+
+
+def output_names(img_list):
+    ''' Output file name (without extension) for each image of img_list: the image's
+    name, or where images in different places share it, their paths relative to the
+    folder they have in common with the extension kept (a/img.jpg, b/img.jpg and
+    img.png become a_img_jpg, b_img_jpg and img_png). Anything still taken gets _2, _3... '''
+    paths = [os.path.abspath(img_path) for img_path in img_list]
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    groups = {}
+    for n, name in enumerate(names):
+        groups.setdefault(name, []).append(n)
+    for inds in groups.values():
+        if len(set(paths[n] for n in inds)) < 2:
+            continue
+        root = os.path.commonpath([os.path.dirname(paths[n]) for n in inds])
+        for n in inds:
+            names[n] = os.path.relpath(paths[n], root).replace(os.sep, '_').replace('.', '_')
+    taken = {}
+    for n, (path, name) in enumerate(zip(paths, names)):
+        unique = name
+        k = 2
+        while taken.get(unique, path) != path:
+            unique = '%s_%d' % (name, k)
+            k += 1
+        taken[unique] = path
+        names[n] = unique
+    return names
+
+
+def output_path(out_dir, name, suffix=''):
+    return os.path.join(out_dir, name + suffix + '.png')
+
+
+def save_fullres(path, img_rgb, output_ab):
+    # upsample the predicted ab onto the full resolution lightness, streamed in strips
+    writer = image_writer.open_strip_writer(path, img_rgb.shape[0], img_rgb.shape[1])
+    for top, strip in CI.iter_fullres_strips(img_rgb, output_ab):
+        writer.write(strip)
+    writer.close()
+
+
+def init_worker(opts):
+    global _worker_model, _worker_opts
+    import torch
+    # split the cores between workers instead of every worker grabbing all of them
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // max(1, opts.workers)))
+    _worker_opts = opts
+    _worker_model = CI.ColorizeImageTorch(Xd=opts.load_size, maskcent=opts.pytorch_maskcent)
+    _worker_model.keep_aspect = opts.keep_aspect
+    _worker_model.prep_net(gpu_id=opts.gpu, path=opts.color_model, backend=opts.backend, quantized=opts.quantized, optimize=opts.optimize)
+
+
+def colorize_chunk(chunk):
+    ''' Runs in a worker: colorize the (image path, output name) pairs of chunk in one
+    batched forward pass (one per image shape with --keep_aspect) and write the results.
+    Returns (done paths, [(failed path, error message)]); a path is done once all its
+    files are written '''
+    opts = _worker_opts
+    imgs = []
+    hints = []
+    loaded = []
+    done = []
+    failed = []
+    for img_path, name in chunk:
+        im = cv2.imread(img_path, 1)
+        if im is None:
+            failed.append((img_path, 'could not read image'))
+            continue
+        # a bad hint file fails its own image, not the whole chunk
+        try:
+            hint = find_hints(img_path, opts.hints_dir)
+            if hint is not None:
+                hint = CI.resize_hints(hint[0], hint[1], _worker_model.load_shape(im.shape[0], im.shape[1]))
+        except Exception as e:
+            failed.append((img_path, 'bad hints: %s' % e))
+            continue
+        imgs.append(cv2.cvtColor(im, cv2.COLOR_BGR2RGB))
+        hints.append(hint)
+        loaded.append((img_path, name))
+
+    if len(imgs) == 0:
+        return [], failed
+
+    try:
+        out_rgbs, out_abs = _worker_model.net_forward_batch(imgs, hints, batch_size=len(imgs))
+    except Exception as e:
+        return [], failed + [(img_path, str(e)) for img_path, name in loaded]
+
+    for (img_path, name), im, out_rgb, out_ab in zip(loaded, imgs, out_rgbs, out_abs):
+        # a failed write (full disk, bad path) fails this image only, and it is not recorded as done
+        try:
+            path = output_path(opts.out_dir, name, '_%d' % opts.load_size)
+            if not cv2.imwrite(path, out_rgb[:, :, ::-1]):
+                raise IOError('could not write %s' % path)
+            if opts.fullres:
+                save_fullres(output_path(opts.out_dir, name), im, out_ab)
+        except Exception as e:
+            failed.append((img_path, 'could not save: %s' % e))
+            continue
+        done.append(img_path)
+    return done, failed
+
+
+def load_progress(out_dir):
+    # absolute paths of the finished images, so ./imgs and /abs/imgs resume the same job
+    progress_path = os.path.join(out_dir, PROGRESS_FILE)
+    if not os.path.exists(progress_path):
+        return set()
+    with open(progress_path) as f:
+        return set(os.path.abspath(line.strip()) for line in f if line.strip())
+
+
+def run(opts):
+    if not os.path.exists(opts.out_dir):
+        os.makedirs(opts.out_dir)
+
+    # absolute paths, each image once
+    img_list = []
+    seen = set()
+    for img_path in map(os.path.abspath, list_images(opts.inputs)):
+        if img_path not in seen:
+            seen.add(img_path)
+            img_list.append(img_path)
+    # named from the whole list, so the names do not depend on what is already done
+    names = dict(zip(img_list, output_names(img_list)))
+    finished = load_progress(opts.out_dir)
+    todo = [(img_path, names[img_path]) for img_path in img_list if img_path not in finished]
+    print('%d images, %d already done, %d to colorize' % (len(img_list), len(img_list) - len(todo), len(todo)))
+    if len(todo) == 0:
+        return 0
+
+    if opts.batch_size is None:
+        opts.batch_size = CI.ColorizeImageTorch(Xd=opts.load_size).batch_size_for_budget(opts.mem_budget * 2**20, dist=False)
+    chunks = [todo[n:n + opts.batch_size] for n in range(0, len(todo), opts.batch_size)]
+    print('batch size %d, %d workers' % (opts.batch_size, opts.workers))
+
+    n_done = 0
+    all_failed = []
+    start_t = time.time()
+    with open(os.path.join(opts.out_dir, PROGRESS_FILE), 'a') as progress:
+        if opts.workers == 0:
+            init_worker(opts)
+            results = map(colorize_chunk, chunks)
+        else:
+            pool = multiprocessing.Pool(opts.workers, initializer=init_worker, initargs=(opts,))
+            results = pool.imap_unordered(colorize_chunk, chunks)
+
+        for done, failed in results:
+            for img_path in done:
+                progress.write(img_path + '\n')
+            progress.flush()
+            n_done += len(done)
+            all_failed += failed
+            for img_path, err in failed:
+                print('failed on %s: %s' % (img_path, err))
+            elapsed = time.time() - start_t
+            print('[%d/%d] %.2f images/sec' % (n_done + len(all_failed), len(todo), n_done / elapsed))
+
+        if opts.workers != 0:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start_t
+    print('colorized %d images in %.1f sec (%.2f images/sec, %.3f sec/image), %d failed' % (
+        n_done, elapsed, n_done / elapsed, elapsed / max(1, n_done), len(all_failed)))
+    return 1 if len(all_failed) > 0 else 0
+
+
+def main(argv):
+    return run(parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,193 @@
+''' Float32 sRGB <-> CIE Lab (D65, 2 degree observer) conversions.
+
+Drop-in for the skimage.color.rgb2lab/lab2rgb calls on the interactive paths.
+The sRGB matrix, white point and uint8 linearization table are computed once at
+import, every function accepts an `out` array, and the intermediate buffers are
+reused per thread, so repeated conversions of the same size allocate nothing
+when `out` is given. Results match skimage to float32 precision.
+'''
+import threading
+import numpy as np
+
+# sRGB -> XYZ (same matrix as skimage.color)
+_XYZ_FROM_RGB = np.array([[0.412453, 0.357580, 0.180423],
+                          [0.212671, 0.715160, 0.072169],
+                          [0.019334, 0.119193, 0.950227]])
+_RGB_FROM_XYZ = np.linalg.inv(_XYZ_FROM_RGB)
+_WHITE = np.array([0.95047, 1., 1.08883])  # D65
+
+# rows ordered (Y, X, Z) and divided by the white point, so the Lab
+# differences can be formed in place (see rgb2lab)
+_YXZ_FROM_RGB_T = np.ascontiguousarray((_XYZ_FROM_RGB / _WHITE[:, np.newaxis])[[1, 0, 2], :].T, dtype=np.float32)
+# white point folded into the inverse matrix
+_RGB_FROM_FXYZ_T = np.ascontiguousarray((_RGB_FROM_XYZ * _WHITE[np.newaxis, :]).T, dtype=np.float32)
+
+_LAB_EPS = 0.008856  # cube root / linear switch in XYZ
+_LAB_EPS_F = 0.2068966  # same switch in f() space, 6/29
+_LAB_K = 7.787
+_LAB_OFS = 16. / 116.
+
+
+def _srgb_to_linear(c):
+    c = np.asarray(c, dtype=np.float64)
+    return np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+
+
+# 256-entry table: uint8 sRGB code value -> linear intensity
+SRGB_LINEAR_LUT = _srgb_to_linear(np.arange(256) / 255.).astype(np.float32)
+
+_workspace = threading.local()
+_SCRATCH_KEEP_MAX = 2**22  # only keep buffers up to this many elements around between calls
+
+
+def _scratch(shape, name, dtype=np.float32):
+    # per-thread scratch buffer, reallocated only when the image size changes
+    buf = getattr(_workspace, name, None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype)
+        if buf.size <= _SCRATCH_KEEP_MAX:
+            setattr(_workspace, name, buf)
+    return buf
+
+
+def _select(dst, alt, mask):
+    # dst = where(mask, alt, dst) in place; alt is clobbered. Cheaper than a
+    # masked copy since every step is a plain vectorized pass.
+    alt -= dst
+    alt *= mask
+    dst += alt
+
+
+def rgb2lab(rgb, out=None):
+    ''' INPUTS
+            rgb     XxYx3     uint8, or float in [0,1]
+        OUTPUTS
+            XxYx3 float32 Lab, written into out if given '''
+    shape = rgb.shape[:-1] + (3,)
+    if out is None:
+        out = np.empty(shape, np.float32)
+    lin = _scratch(shape, 'lin')
+    alt = _scratch(shape, 'alt')
+    mask = _scratch(shape, 'mask', bool)
+
+    # linearize
+    if rgb.dtype == np.uint8:
+        np.take(SRGB_LINEAR_LUT, rgb, out=lin)
+    else:
+        lin[...] = rgb
+        np.greater(lin, 0.04045, out=mask)
+        np.add(lin, 0.055, out=alt)
+        alt *= 1. / 1.055
+        np.power(alt, 2.4, out=alt)
+        lin *= 1. / 12.92
+        _select(lin, alt, mask)
+
+    # normalized (Y, X, Z), then f(t)
+    np.matmul(lin, _YXZ_FROM_RGB_T, out=out)
+    np.greater(out, _LAB_EPS, out=mask)
+    np.cbrt(out, out=alt)
+    out *= _LAB_K
+    out += _LAB_OFS
+    _select(out, alt, mask)
+
+    fy = out[..., 0]
+    fx = out[..., 1]
+    fz = out[..., 2]
+    fx -= fy  # a = 500 (fx - fy)
+    fx *= 500.
+    np.subtract(fy, fz, out=fz)  # b = 200 (fy - fz)
+    fz *= 200.
+    fy *= 116.  # L = 116 fy - 16
+    fy -= 16.
+    return out
+
+
+def _lab_channels2linear(l, a, b, shape):
+    # l, a, b planes -> linear rgb in a scratch buffer (unclipped)
+    f = _scratch(shape, 'f')
+    alt = _scratch(shape, 'alt')
+    mask = _scratch(shape, 'mask', bool)
+    fx = f[..., 0]
+    fy = f[..., 1]
+    fz = f[..., 2]
+    np.add(l, 16., out=fy)
+    fy *= 1. / 116.
+    np.multiply(a, 1. / 500., out=fx)
+    fx += fy
+    np.multiply(b, -1. / 200., out=fz)
+    fz += fy
+    np.maximum(fz, 0, out=fz)
+
+    np.greater(f, _LAB_EPS_F, out=mask)
+    np.multiply(f, f, out=alt)
+    alt *= f
+    f -= _LAB_OFS
+    f *= 1. / _LAB_K
+    _select(f, alt, mask)
+
+    lin = _scratch(shape, 'lin')
+    np.matmul(f, _RGB_FROM_FXYZ_T, out=lin)
+    return lin
+
+
+def _linear2srgb(lin, out):
+    alt = _scratch(lin.shape, 'alt')
+    tmp = _scratch(lin.shape, 'f')
+    mask = _scratch(lin.shape, 'mask', bool)
+    np.clip(lin, 0, 1, out=lin)
+    np.greater(lin, 0.0031308, out=mask)
+    # c^(1/2.4) = c^(1/3) * c^(1/12), much faster than a float power
+    np.cbrt(lin, out=alt)
+    np.sqrt(alt, out=tmp)
+    np.sqrt(tmp, out=tmp)
+    alt *= tmp
+    alt *= 1.055
+    alt -= 0.055
+    lin *= 12.92
+    _select(lin, alt, mask)
+    if out.dtype == np.uint8:
+        lin *= 255.
+        np.copyto(out, lin, casting='unsafe')  # truncates, like (rgb * 255).astype('uint8')
+    else:
+        np.copyto(out, lin)
+    return out
+
+
+def lab2rgb(lab, out=None):
+    ''' INPUTS
+            lab     XxYx3     L in [0,100], ab in [-110,110]
+        OUTPUTS
+            XxYx3 float32 rgb clipped to [0,1], or uint8 in [0,255] when out is uint8 '''
+    shape = lab.shape[:-1] + (3,)
+    if out is None:
+        out = np.empty(shape, np.float32)
+    lin = _lab_channels2linear(lab[..., 0], lab[..., 1], lab[..., 2], shape)
+    return _linear2srgb(lin, out)
+
+
+def lab2rgb_uint8(lab, out=None):
+    # lab2rgb scaled to uint8, matching (np.clip(color.lab2rgb(lab), 0, 1) * 255).astype('uint8')
+    if out is None:
+        out = np.empty(lab.shape[:-1] + (3,), np.uint8)
+    return lab2rgb(lab, out=out)
+
+
+def lab_planes2rgb_uint8(img_l, img_ab, out=None):
+    ''' INPUTS
+            img_l     1xXxY     [0,100]
+            img_ab    2xXxY     [-110,110]
+        OUTPUTS
+            XxYx3 uint8, without stacking the planes first '''
+    shape = img_l.shape[1:] + (3,)
+    if out is None:
+        out = np.empty(shape, np.uint8)
+    lin = _lab_channels2linear(img_l[0], img_ab[0], img_ab[1], shape)
+    return _linear2srgb(lin, out)
+
+
+def rgb2lab_planes(img_rgb, out=None):
+    ''' INPUTS
+            img_rgb   XxYx3     uint8, or float in [0,1]
+        OUTPUTS
+            3xXxY float32 Lab (a transposed view of the XxYx3 result) '''
+    return rgb2lab(img_rgb, out=out).transpose((2, 0, 1))
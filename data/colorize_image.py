@@ -1,10 +1,14 @@
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
-from skimage import color
 from sklearn.cluster import KMeans
 import os
+import threading
+import hashlib
+from collections import OrderedDict
 from scipy.ndimage.interpolation import zoom
+from data import color_space
+from data import image_writer
 
 
 def create_temp_directory(path_template, N=1e8):
@@ -23,9 +27,7 @@ def lab2rgb_transpose(img_l, img_ab):
             img_ab     2xXxX     [-100,100]
         OUTPUTS
             returned value is XxXx3 '''
-    pred_lab = np.concatenate((img_l, img_ab), axis=0).transpose((1, 2, 0))
-    pred_rgb = (np.clip(color.lab2rgb(pred_lab), 0, 1) * 255).astype('uint8')
-    return pred_rgb
+    return color_space.lab_planes2rgb_uint8(img_l, img_ab)
 
 
 def rgb2lab_transpose(img_rgb):
@@ -33,29 +35,415 @@ def rgb2lab_transpose(img_rgb):
             img_rgb XxXx3
         OUTPUTS
             returned value is 3xXxX '''
-    return color.rgb2lab(img_rgb).transpose((2, 0, 1))
+    return color_space.rgb2lab_planes(img_rgb)
+
+
+def resize_hints(input_ab, input_mask, shape):
+    ''' INPUTS
+            input_ab     2xHxW     hint colors, as GUIDraw.save_result writes them
+            input_mask   1xHxW     hint mask
+            shape        (H, W) the hints are needed at
+        OUTPUTS
+            (input_ab, input_mask) at shape: ab resized bilinearly, the mask with
+            nearest neighbours so it stays binary. Raises ValueError for planes
+            that do not fit together '''
+    input_ab = np.asarray(input_ab)
+    input_mask = np.asarray(input_mask)
+    if input_ab.ndim != 3 or input_ab.shape[0] != 2 or input_mask.shape != (1, ) + input_ab.shape[1:]:
+        raise ValueError('hints of shape %s and %s are not 2xHxW and 1xHxW' % (input_ab.shape, input_mask.shape))
+    if input_ab.shape[1:] == tuple(shape):
+        return input_ab, input_mask
+    dsize = (shape[1], shape[0])
+    input_ab = cv2.resize(input_ab.transpose((1, 2, 0)).astype(np.float32), dsize, interpolation=cv2.INTER_LINEAR).transpose((2, 0, 1))
+    input_mask = cv2.resize(input_mask[0].astype(np.float32), dsize, interpolation=cv2.INTER_NEAREST)[np.newaxis]
+    return input_ab, input_mask
+
+
+def working_size(h, w, pixels, multiple=8):
+    # (H, W) with about `pixels` pixels and the aspect ratio of an hxw image, both multiples of `multiple`
+    s = np.sqrt(float(pixels) / (h * w))
+    return tuple(max(multiple, int(round(n * s / multiple)) * multiple) for n in (h, w))
+
+
+def _zoom_coords(n_in, n_out):
+    # neighbours and weights of scipy.ndimage.zoom(order=1) along one axis
+    if n_out > 1:
+        pos = np.arange(n_out) * ((n_in - 1.) / (n_out - 1.))
+    else:
+        pos = np.zeros(1)
+    i0 = np.minimum(np.floor(pos).astype(int), n_in - 1)
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    return i0, i1, (pos - i0).astype('float32')
+
+
+def _zoom_nearest(n_in, n_out):
+    # source index of each output pixel of scipy.ndimage.zoom(order=0) along one axis
+    i0, i1, w = _zoom_coords(n_in, n_out)
+    return np.where(w >= .5, i1, i0)
+
+
+def iter_nearest_strips(img_l, img_ab, shape, strip_height=256):
+    ''' Convert Lab planes upsampled with nearest neighbour, one strip of rows at a time
+        INPUTS
+            img_l            1xXxX     [0,100]
+            img_ab           2xXxX     upsampled to shape like zoom(order=0)
+            shape            (H, W)
+        OUTPUTS
+            yields (first row, strip_heightxWx3 uint8), top to bottom '''
+    H, W = shape
+    rows = _zoom_nearest(img_l.shape[1], H)
+    cols = _zoom_nearest(img_l.shape[2], W)
+    for top in range(0, H, strip_height):
+        r = rows[top:top + strip_height]
+        yield top, color_space.lab_planes2rgb_uint8(img_l[:, r][:, :, cols], img_ab[:, r][:, :, cols])
+
+
+def join_strips(strips, shape):
+    # (first row, strip) pairs into one HxWx3 uint8 image
+    out = np.empty(tuple(shape) + (3,), np.uint8)
+    for top, strip in strips:
+        out[top:top + strip.shape[0]] = strip
+    return out
+
+
+def iter_fullres_strips(img_rgb_fullres, ab, strip_height=256):
+    ''' Colorize a full resolution image one strip of rows at a time
+        INPUTS
+            img_rgb_fullres  HxWx3     full resolution image, only its lightness is used
+            ab               2xXxX     ab prediction, bilinearly upsampled to HxW
+        OUTPUTS
+            yields (first row, strip_heightxWx3 uint8), top to bottom '''
+    H, W = img_rgb_fullres.shape[:2]
+    r0, r1, rw = _zoom_coords(ab.shape[1], H)
+    c0, c1, cw = _zoom_coords(ab.shape[2], W)
+    for top in range(0, H, strip_height):
+        bottom = min(H, top + strip_height)
+        w = rw[top:bottom, np.newaxis]
+        ab_rows = ab[:, r0[top:bottom], :] * (1 - w) + ab[:, r1[top:bottom], :] * w
+        ab_strip = ab_rows[:, :, c0] * (1 - cw) + ab_rows[:, :, c1] * cw
+        l_strip = rgb2lab_transpose(img_rgb_fullres[top:bottom])[[0], :, :]
+        yield top, color_space.lab_planes2rgb_uint8(l_strip, ab_strip)
+
+
+def _kmeans_seed(d2_bins, p, K, first, n_cand=8):
+    # k-means++ seeding made deterministic: of the n_cand bins with the largest
+    # p * D^2, take the one that lowers the weighted cost the most.
+    # p is CxQ, first C bin indices; returns CxK bin indices
+    C, Q = p.shape
+    rows = np.arange(C)
+    n_cand = min(n_cand, Q)
+    inds = np.empty((C, K), dtype=int)
+    inds[:, 0] = first
+    d2_min = d2_bins[first]  # CxQ
+    for k in range(1, K):
+        cand = np.argpartition(-p * d2_min, n_cand - 1, axis=1)[:, :n_cand]
+        d2_cand = np.minimum(d2_min[:, :, np.newaxis], d2_bins[cand].transpose((0, 2, 1)))  # CxQxn_cand
+        best = np.argmin(np.einsum('cq,cqn->cn', p, d2_cand), axis=1)
+        inds[:, k] = cand[rows, best]
+        d2_min = d2_cand[rows, :, best]
+    return inds
+
+
+def _assign(pts_ab, centers):
+    # nearest center for every bin, CxKx2 centers -> CxQ labels and squared distances
+    labels = np.zeros((centers.shape[0], pts_ab.shape[0]), dtype=int)
+    d2_min = None
+    for k in range(centers.shape[1]):
+        d2 = (pts_ab[:, 0] - centers[:, k, 0:1])**2 + (pts_ab[:, 1] - centers[:, k, 1:2])**2
+        if d2_min is None:
+            d2_min = d2
+        else:
+            closer = d2 < d2_min  # ties go to the lower k, like argmin
+            labels[closer] = k
+            np.minimum(d2_min, d2, out=d2_min)
+    return labels, d2_min
+
+
+def ab_modes(pts_ab, probs, K=5, n_starts=4, n_iter=50):
+    ''' Weighted k-means over the bins of an ab histogram, deterministic
+        INPUTS
+            pts_ab    Qx2       bin centers
+            probs     Q         bin probabilities, or CxQ for C histograms at once
+            K                   number of colors
+            n_starts            seedings tried, starting from the n_starts most probable bins
+        OUTPUTS
+            centers   Kx2       cluster centers, most probable first (CxKx2 for CxQ probs)
+            mass      K         probability mass of each cluster (CxK) '''
+    single = probs.ndim == 1
+    p = np.atleast_2d(probs).astype('float64')
+    p = p / np.sum(p, axis=1, keepdims=True)
+    C = p.shape[0]
+    rows = np.arange(C)
+    offsets = K * rows[:, np.newaxis]
+    d2_bins = np.sum((pts_ab[:, np.newaxis, :] - pts_ab[np.newaxis, :, :])**2, axis=2).astype('float64')  # QxQ
+
+    best_cost = np.full(C, np.inf)
+    best_centers = np.zeros((C, K, 2))
+    best_labels = np.zeros(p.shape, dtype=int)
+    firsts = np.argsort(-p, axis=1, kind='stable')[:, :n_starts]
+    for start in range(firsts.shape[1]):
+        centers = pts_ab[_kmeans_seed(d2_bins, p, K, firsts[:, start])].astype('float64')
+        labels, d2 = _assign(pts_ab, centers)
+        active = rows  # histograms whose assignment is still changing
+        for it in range(n_iter):
+            act_p = p[active]
+            n_act = len(active)
+            flat = (labels[active] + offsets[:n_act]).ravel()
+            mass = np.bincount(flat, weights=act_p.ravel(), minlength=n_act * K).reshape((n_act, K))
+            sums = np.stack([np.bincount(flat, weights=(act_p * pts_ab[:, c]).ravel(), minlength=n_act * K).reshape((n_act, K))
+                             for c in range(2)], axis=2)
+            nonempty = mass > 0
+            act_centers = centers[active]
+            act_centers[nonempty] = sums[nonempty] / mass[nonempty][:, np.newaxis]  # empty clusters stay put
+            centers[active] = act_centers
+            new_labels, new_d2 = _assign(pts_ab, act_centers)
+            changed = np.any(new_labels != labels[active], axis=1)
+            labels[active] = new_labels
+            d2[active] = new_d2
+            active = active[changed]
+            if len(active) == 0:
+                break
+        cost = np.sum(p * d2, axis=1)
+        better = cost < best_cost
+        best_cost[better] = cost[better]
+        best_centers[better] = centers[better]
+        best_labels[better] = labels[better]
+
+    mass = np.bincount((best_labels + offsets).ravel(), weights=p.ravel(), minlength=C * K).reshape((C, K))
+    order = np.argsort(-mass, axis=1, kind='stable')
+    centers = best_centers[rows[:, np.newaxis], order]
+    mass = mass[rows[:, np.newaxis], order]
+    if single:
+        return centers[0], mass[0]
+    return centers, mass
+
+
+def sample_ab_reccs(pts_ab, probs, K=5, N=25000):
+    # KMeans on N random draws from the histogram, the original suggestion method
+    cmf = np.cumsum(probs)  # CMF
+    cmf = cmf / cmf[-1]
+
+    # randomly sample N points
+    rnd_pts = np.random.uniform(low=0, high=1.0, size=N)
+    inds = np.digitize(rnd_pts, bins=cmf)
+    rnd_pts_ab = pts_ab[inds, :]
+
+    # run k-means
+    kmeans = KMeans(n_clusters=K).fit(rnd_pts_ab)
+
+    # sort by cluster occupancy
+    k_label_cnt = np.histogram(kmeans.labels_, np.arange(0, K + 1))[0]
+    k_inds = np.argsort(k_label_cnt, axis=0)[::-1]
+
+    cluster_per = 1. * k_label_cnt[k_inds] / N  # percentage of points within cluster
+    cluster_centers = kmeans.cluster_centers_[k_inds, :]  # cluster centers
+    return cluster_centers, cluster_per
+
+
+class PredictionCache():
+    # LRU of network outputs keyed by (image, hint set), bounded by the total
+    # size of the stored arrays. put makes the arrays read-only, so get hands
+    # out the stored arrays themselves without them being changed under it
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(img_id, input_ab, input_mask):
+        h = hashlib.sha1(str(img_id).encode())
+        for arr in (input_ab, input_mask):
+            arr = np.ascontiguousarray(arr, dtype=np.float32)
+            h.update(str(arr.shape).encode())
+            h.update(arr.data)
+        return h.digest()
+
+    def get(self, key):
+        outputs = self.entries.get(key)
+        if outputs is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return outputs
+
+    def put(self, key, outputs):
+        for out in outputs:
+            out.setflags(write=False)
+        size = sum(out.nbytes for out in outputs)
+        if size > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = outputs
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= sum(out.nbytes for out in old)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def __str__(self):
+        return 'prediction cache: %d hits, %d misses, %d entries (%.1f MB)' % (
+            self.hits, self.misses, len(self.entries), self.nbytes / 2.**20)
+
+
+class SuggestionMap():
+    ''' Top-K suggested colors for every block x block cell of the image,
+    computed from a distribution prediction on a background thread.
+
+    Each cell uses the distribution at its top left pixel. The torch
+    distribution head is upsampled 4x with nearest neighbour, so with block=4
+    all pixels of a cell share that distribution and a lookup returns what
+    get_ab_reccs would compute at the pixel, up to float16 rounding. The
+    default block=8 does a quarter of the work.
+    Stored as float16: ab is Kx2x(H/block)x(W/block), conf Kx(H/block)x(W/block).
+    '''
+    def __init__(self, K=9, block=8, chunk=256):
+        self.K = K
+        self.block = block
+        self.chunk = chunk  # cells clustered per batch, bounds the scratch memory
+        self.key = None  # identifies the distribution the map is (being) computed for
+        self.ready = False
+        self.ab = None
+        self.conf = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, pts_ab, dist_ab, key):
+        # dist_ab QxHxW must not be modified afterwards; supersedes any running job
+        with self.lock:
+            if key == self.key:
+                return
+            self.key = key
+            self.ready = False
+        self.thread = threading.Thread(target=self._compute, args=(pts_ab, dist_ab, key))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _compute(self, pts_ab, dist_ab, key):
+        cells = dist_ab[:, ::self.block, ::self.block]
+        Q, h, w = cells.shape
+        probs = cells.reshape((Q, h * w)).T
+        ab = np.zeros((self.K, 2, h * w), np.float16)
+        conf = np.zeros((self.K, h * w), np.float16)
+        for c0 in range(0, h * w, self.chunk):
+            if self.key != key:  # a newer distribution came in
+                return
+            centers, mass = ab_modes(pts_ab, probs[c0:c0 + self.chunk], K=self.K)
+            ab[:, :, c0:c0 + self.chunk] = centers.transpose((1, 2, 0))
+            conf[:, c0:c0 + self.chunk] = mass.T
+        with self.lock:
+            if self.key == key:
+                self.ab = ab.reshape((self.K, 2, h, w))
+                self.conf = conf.reshape((self.K, h, w))
+                self.ready = True
+
+    def lookup(self, h, w, K, key):
+        # (Kx2 ab, K conf) at pixel (h,w), None unless the map for key is finished
+        with self.lock:
+            if not self.ready or key != self.key or K != self.K:
+                return None
+            y = h // self.block
+            x = w // self.block
+            return self.ab[:, :, y, x].astype('float64'), self.conf[:, y, x].astype('float64')
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+class DistSnapshot():
+    ''' The distribution of one prediction with what get_ab_reccs needs, so colors
+    can be suggested from it on one thread while the engine runs the next forward
+    pass on another. dist_ab must not be modified afterwards. '''
+    def __init__(self, pts_in_hull, dist_ab, dist_key, suggest_map=None):
+        self.pts_in_hull = pts_in_hull
+        self.dist_ab = dist_ab
+        self.dist_key = dist_key
+        self.suggest_map = suggest_map  # only answers while it holds dist_key's map
+
+    def get_ab_reccs(self, h, w, K=5, N=25000, return_conf=False, method='modes'):
+        # see ColorizeImageTorchDist.get_ab_reccs
+        if method == 'sample':
+            cluster_centers, cluster_per = sample_ab_reccs(self.pts_in_hull, self.dist_ab[:, h, w], K=K, N=N)
+        else:
+            found = None if self.suggest_map is None else self.suggest_map.lookup(h, w, K, self.dist_key)
+            if found is None:
+                found = ab_modes(self.pts_in_hull, self.dist_ab[:, h, w], K=K)
+            cluster_centers, cluster_per = found
+
+        if return_conf:
+            return cluster_centers, cluster_per
+        else:
+            return cluster_centers
 
 
 class ColorizeImageBase():
-    def __init__(self, Xd=256, Xfullres_max=10000):
+    def __init__(self, Xd=256, Xfullres_max=10000, lab_fullres_thread=False):
         self.Xd = Xd
+        # pytorch engines only: work at about Xd*Xd pixels with the aspect ratio of
+        # the image (see load_shape) instead of squashing it to XdxXd
+        self.keep_aspect = False
         self.img_l_set = False
         self.net_set = False
         self.Xfullres_max = Xfullres_max  # maximum size of maximum dimension
+        # full resolution Lab is computed on first use; optionally start it in a
+        # background thread as soon as an image is loaded
+        self.lab_fullres_thread = lab_fullres_thread
+        self._img_lab_fullres = None
+        self._lab_fullres_lock = threading.Lock()
+        # outputs of earlier forwards, keyed by img_id and the hints; emptied when net is replaced
+        self.cache = PredictionCache()
+        self._net = None
+        self.img_id = 0
         self.img_just_set = False  # this will be true whenever image is just loaded
         # net_forward can set this to False if they want
+        self.output_ab = None  # prediction for the loaded image, None until net_forward runs on it
+        self._output_rgb = None  # built from output_ab on demand, see output_rgb
+        self._output_rgb_fullres = None
+        self._output_PSNR = None
 
     def prep_net(self):
         raise Exception("Should be implemented by base class")
 
+    def prepare_thread(self):
+        # called by a thread other than the one prep_net ran on before it runs the net
+        pass
+
+    def dist_snapshot(self):
+        # DistSnapshot of the current distribution prediction; None, this engine has none
+        return None
+
+    @property
+    def net(self):
+        return self._net
+
+    @net.setter
+    def net(self, net):
+        # cached outputs belong to the previous net (prep_net, optimize_net, or a direct assignment)
+        self._net = net
+        self.cache.clear()
+
     # ***** Image prepping *****
+    def load_shape(self, h, w):
+        # (H, W) the network works at for an hxw image, the shape of the hint planes
+        if self.keep_aspect:
+            return working_size(h, w, self.Xd * self.Xd)
+        return (self.Xd, self.Xd)
+
     def load_image(self, input_path):
-        # rgb image [CxXdxXd]
+        # rgb image [CxHxW], see load_shape
         im = cv2.cvtColor(cv2.imread(input_path, 1), cv2.COLOR_BGR2RGB)
         self.img_rgb_fullres = im.copy()
         self._set_img_lab_fullres_()
+        self._clear_outputs_()
+        self.img_id += 1
 
-        im = cv2.resize(im, (self.Xd, self.Xd))
+        H, W = self.load_shape(*im.shape[:2])
+        im = cv2.resize(im, (W, H))
         self.img_rgb = im.copy()
         # self.img_rgb = sp.misc.imresize(plt.imread(input_path),(self.Xd,self.Xd)).transpose((2,0,1))
 
@@ -68,9 +456,14 @@ class ColorizeImageBase():
     def set_image(self, input_image):
         self.img_rgb_fullres = input_image.copy()
         self._set_img_lab_fullres_()
+        self._clear_outputs_()
+        self.img_id += 1
 
         self.img_l_set = True
 
+        H, W = self.load_shape(*input_image.shape[:2])
+        if input_image.shape[:2] != (H, W):
+            input_image = cv2.resize(input_image, (W, H))
         self.img_rgb = input_image
         # convert into lab space
         self._set_img_lab_()
@@ -90,72 +483,115 @@ class ColorizeImageBase():
             return -1
 
         self.input_ab = input_ab
-        self.input_ab_mc = (input_ab - self.ab_mean) / self.ab_norm
         self.input_mask = input_mask
-        self.input_mask_mult = input_mask * self.mask_mult
         return 0
 
+    @property
+    def input_ab_mc(self):
+        # normalized on use, the pytorch engines fill their input buffer directly instead
+        return (self.input_ab - self.ab_mean) / self.ab_norm
+
+    @property
+    def input_mask_mult(self):
+        return self.input_mask * self.mask_mult
+
     def get_result_PSNR(self, result=-1, return_SE_map=False):
         if np.array((result)).flatten()[0] == -1:
-            cur_result = self.get_img_forward()
+            # PSNR of the current prediction, cached until the next forward
+            if self._output_PSNR is None:
+                self._output_PSNR = self._compute_PSNR(self.get_img_forward())
+            cur_PSNR, SE_map = self._output_PSNR
         else:
-            cur_result = result.copy()
-        SE_map = (1. * self.img_rgb - cur_result)**2
-        cur_MSE = np.mean(SE_map)
-        cur_PSNR = 20 * np.log10(255. / np.sqrt(cur_MSE))
+            cur_PSNR, SE_map = self._compute_PSNR(result.copy())
         if return_SE_map:
             return(cur_PSNR, SE_map)
         else:
             return cur_PSNR
 
+    @property
+    def output_rgb(self):
+        # rgb of the point estimate, converted from output_ab the first time it is asked for
+        if self._output_rgb is None:
+            self._output_rgb = lab2rgb_transpose(self.img_l, self.output_ab)
+        return self._output_rgb
+
+    def _compute_PSNR(self, cur_result):
+        SE_map = (1. * self.img_rgb - cur_result)**2
+        cur_MSE = np.mean(SE_map)
+        return 20 * np.log10(255. / np.sqrt(cur_MSE)), SE_map
+
     def get_img_forward(self):
         # get image with point estimate
         return self.output_rgb
 
     def get_img_gray(self):
         # Get black and white image
-        return lab2rgb_transpose(self.img_l, np.zeros((2, self.Xd, self.Xd)))
+        return lab2rgb_transpose(self.img_l, np.zeros((2, ) + self.img_l.shape[1:]))
 
     def get_img_gray_fullres(self):
         # Get black and white image
-        return lab2rgb_transpose(self.img_l_fullres, np.zeros((2, self.img_l_fullres.shape[1], self.img_l_fullres.shape[2])))
+        return join_strips(iter_fullres_strips(self.img_rgb_fullres, np.zeros((2, 1, 1))), self.img_rgb_fullres.shape[:2])
 
     def get_img_fullres(self):
-        # This assumes self.img_l_fullres, self.output_ab are set.
+        # This assumes self.img_rgb_fullres, self.output_ab are set.
         # Typically, this means that set_image() and net_forward()
-        # have been called.
-        # bilinear upsample
-        zoom_factor = (1, 1. * self.img_l_fullres.shape[1] / self.output_ab.shape[1], 1. * self.img_l_fullres.shape[2] / self.output_ab.shape[2])
-        output_ab_fullres = zoom(self.output_ab, zoom_factor, order=1)
+        # have been called. The result is cached until the next forward.
+        if self._output_rgb_fullres is None:
+            # bilinear upsample and convert strip by strip, no full size float buffers
+            self._output_rgb_fullres = join_strips(self.iter_img_fullres_strips(), self.img_rgb_fullres.shape[:2])
+        return self._output_rgb_fullres
+
+    def iter_img_fullres_strips(self, strip_height=256):
+        # full resolution result as (first row, strip) pairs, see iter_fullres_strips
+        return iter_fullres_strips(self.img_rgb_fullres, self.output_ab, strip_height)
+
+    def save_img_fullres(self, path, strip_height=256):
+        # stream the full resolution result to a .png, .tif or .npy file;
+        # peak memory is a few strips regardless of the image size
+        if self._output_rgb_fullres is not None:
+            strips = [(0, self._output_rgb_fullres)]
+        else:
+            strips = self.iter_img_fullres_strips(strip_height)
+        self.save_fullres_strips(path, strips)
+
+    def save_fullres_strips(self, path, strips):
+        # write the (first row, strip) pairs of one of the iter_*_fullres_strips methods
+        writer = image_writer.open_strip_writer(path, self.img_rgb_fullres.shape[0], self.img_rgb_fullres.shape[1])
+        for top, strip in strips:
+            writer.write(strip)
+        writer.close()
 
-        return lab2rgb_transpose(self.img_l_fullres, output_ab_fullres)
+    def iter_input_img_fullres_strips(self, strip_height=256):
+        # the hints bilinearly upsampled onto the full resolution lightness
+        return iter_fullres_strips(self.img_rgb_fullres, self.input_ab, strip_height)
 
     def get_input_img_fullres(self):
-        zoom_factor = (1, 1. * self.img_l_fullres.shape[1] / self.input_ab.shape[1], 1. * self.img_l_fullres.shape[2] / self.input_ab.shape[2])
-        input_ab_fullres = zoom(self.input_ab, zoom_factor, order=1)
-        return lab2rgb_transpose(self.img_l_fullres, input_ab_fullres)
+        return join_strips(self.iter_input_img_fullres_strips(), self.img_rgb_fullres.shape[:2])
 
     def get_input_img(self):
         return lab2rgb_transpose(self.img_l, self.input_ab)
 
     def get_img_mask(self):
         # Get black and white image
-        return lab2rgb_transpose(100. * (1 - self.input_mask), np.zeros((2, self.Xd, self.Xd)))
+        return lab2rgb_transpose(100. * (1 - self.input_mask), np.zeros((2, ) + self.input_mask.shape[1:]))
+
+    def iter_img_mask_fullres_strips(self, strip_height=256):
+        # black where there are hints, white elsewhere
+        return iter_nearest_strips(100. * (1 - self.input_mask), np.zeros((2, ) + self.input_mask.shape[1:]),
+                                   self.img_rgb_fullres.shape[:2], strip_height)
 
     def get_img_mask_fullres(self):
         # Get black and white image
-        zoom_factor = (1, 1. * self.img_l_fullres.shape[1] / self.input_ab.shape[1], 1. * self.img_l_fullres.shape[2] / self.input_ab.shape[2])
-        input_mask_fullres = zoom(self.input_mask, zoom_factor, order=0)
-        return lab2rgb_transpose(100. * (1 - input_mask_fullres), np.zeros((2, input_mask_fullres.shape[1], input_mask_fullres.shape[2])))
+        return join_strips(self.iter_img_mask_fullres_strips(), self.img_rgb_fullres.shape[:2])
 
     def get_sup_img(self):
         return lab2rgb_transpose(50 * self.input_mask, self.input_ab)
 
+    def iter_sup_fullres_strips(self, strip_height=256):
+        return iter_nearest_strips(50 * self.input_mask, self.input_ab, self.img_rgb_fullres.shape[:2], strip_height)
+
     def get_sup_fullres(self):
-        zoom_factor = (1, 1. * self.img_l_fullres.shape[1] / self.output_ab.shape[1], 1. * self.img_l_fullres.shape[2] / self.output_ab.shape[2])
-        input_mask_fullres = zoom(self.input_mask, zoom_factor, order=0)
-        input_ab_fullres = zoom(self.input_ab, zoom_factor, order=0)
-        return lab2rgb_transpose(50 * input_mask_fullres, input_ab_fullres)
+        return join_strips(self.iter_sup_fullres_strips(), self.img_rgb_fullres.shape[:2])
 
     # ***** Private functions *****
     def _set_img_lab_fullres_(self):
@@ -169,13 +605,36 @@ class ColorizeImageBase():
                 zoom_factor = 1. * self.Xfullres_max / Yfullres
             self.img_rgb_fullres = zoom(self.img_rgb_fullres, (zoom_factor, zoom_factor, 1), order=1)
 
-        self.img_lab_fullres = color.rgb2lab(self.img_rgb_fullres).transpose((2, 0, 1))
-        self.img_l_fullres = self.img_lab_fullres[[0], :, :]
-        self.img_ab_fullres = self.img_lab_fullres[1:, :, :]
+        # Lab planes are converted on first access, see img_lab_fullres
+        self._img_lab_fullres = None
+        if self.lab_fullres_thread:
+            threading.Thread(target=self._compute_img_lab_fullres_, args=(self.img_rgb_fullres,), daemon=True).start()
+
+    def _compute_img_lab_fullres_(self, img_rgb_fullres):
+        with self._lab_fullres_lock:
+            if self._img_lab_fullres is not None and self._img_lab_fullres[1] is img_rgb_fullres:
+                return self._img_lab_fullres[0]
+            img_lab_fullres = rgb2lab_transpose(img_rgb_fullres)
+            # a new image may have been loaded in the meantime
+            if self.img_rgb_fullres is img_rgb_fullres:
+                self._img_lab_fullres = (img_lab_fullres, img_rgb_fullres)
+            return img_lab_fullres
+
+    @property
+    def img_lab_fullres(self):
+        return self._compute_img_lab_fullres_(self.img_rgb_fullres)
+
+    @property
+    def img_l_fullres(self):
+        return self.img_lab_fullres[0:1, :, :]
+
+    @property
+    def img_ab_fullres(self):
+        return self.img_lab_fullres[1:, :, :]
 
     def _set_img_lab_(self):
         # set self.img_lab from self.im_rgb
-        self.img_lab = color.rgb2lab(self.img_rgb).transpose((2, 0, 1))
+        self.img_lab = rgb2lab_transpose(self.img_rgb)
         self.img_l = self.img_lab[[0], :, :]
         self.img_ab = self.img_lab[1:, :, :]
 
@@ -193,9 +652,20 @@ class ColorizeImageBase():
     def _set_img_ab_(self):
         self.img_ab_mc = self.img_lab_mc[[1, 2], :, :]
 
-    def _set_out_ab_(self):
-        self.output_lab = rgb2lab_transpose(self.output_rgb)
-        self.output_ab = self.output_lab[1:, :, :]
+    def _set_out_ab_(self, output_ab):
+        # keep the network's ab prediction as is; rgb versions are built lazily
+        self.output_ab = output_ab
+        self._clear_out_rgb_()
+
+    def _clear_outputs_(self):
+        # a new image: the previous image's predictions no longer apply, and may have another shape
+        self.output_ab = None
+        self._clear_out_rgb_()
+
+    def _clear_out_rgb_(self):
+        self._output_rgb = None
+        self._output_rgb_fullres = None
+        self._output_PSNR = None
 
 
 class ColorizeImageTorch(ColorizeImageBase):
@@ -208,16 +678,43 @@ class ColorizeImageTorch(ColorizeImageBase):
         self.ab_mean = 0.
         self.mask_mult = 1.
         self.mask_cent = .5 if maskcent else 0
+        self.net_input = None  # 1x4xXdxXd, filled in place by _fill_net_input
+        self.net_input_img_id = None
+        # keep the first conv's response to the L plane and to hint planes without
+        # hints per image (SIGGRAPHGenerator.conv1_base_response) and add the response
+        # of the hint pixels to it (conv1_sparse), as long as those cover at most
+        # sparse_hint_fraction of the image; beyond that, or with sparse_conv1 off, the
+        # dense conv of forward_input runs
+        self.sparse_conv1 = True
+        self.sparse_hint_fraction = 1. / 16
+        self.conv1_base = None
+        self.conv1_base_key = (None, None)  # (img_id, net) conv1_base was computed for
 
         # Load grid properties
         self.pts_in_hull = np.array(np.meshgrid(np.arange(-110, 120, 10), np.arange(-110, 120, 10))).reshape((2, 529)).T
 
     # ***** Net preparation *****
-    def prep_net(self, gpu_id=None, path='', dist=False):
+    def prep_net(self, gpu_id=None, path='', dist=False, backend='eager', quantized=False, optimize=False, compile=False):
+        # backend 'torchscript' or 'onnx' runs a graph written by models/pytorch/export.py,
+        # path is then the exported file or the checkpoint it was exported from.
+        # quantized loads an int8 checkpoint written by models/pytorch/quantize.py, cpu only.
+        # optimize runs a batch norm folded, channels_last copy of the eager net, compile
+        # additionally passes it through torch.compile
         import torch
         import models.pytorch.model as model
         print('path = %s' % path)
         print('Model set! dist mode? ', dist)
+        if backend != 'eager':
+            from models.pytorch import export
+            self.net = export.load_exported(path, backend, dist, gpu_id=gpu_id)
+            self.net_set = True
+            return
+        if quantized:
+            from models.pytorch import quantize
+            self.net = quantize.load_quantized(path, dist=dist)
+            print('Using CPU mode (int8)')
+            self.net_set = True
+            return
         self.net = model.SIGGRAPHGenerator(dist=dist)
         state_dict = torch.load(path)
         if hasattr(state_dict, '_metadata'):
@@ -237,8 +734,23 @@ class ColorizeImageTorch(ColorizeImageBase):
         else:
             print('Using CPU mode')
         self.net.eval()
+        if optimize:
+            self.optimize_net(compile=compile)
         self.net_set = True
 
+    def optimize_net(self, compile=False):
+        # swap in an inference-only copy of the eager net (models/pytorch/optimize.py),
+        # keeping the eager one if the copy does not reproduce its outputs
+        from models.pytorch import optimize
+        eager_net = self.net
+        self.net = optimize.InferenceGenerator(eager_net, compile=compile)
+        diff = optimize.check_equivalence(eager_net, self.net, maskcent=self.mask_cent)
+        if diff > optimize.TOLERANCE:
+            print('Optimized model differs from the eager one by %.2e, using the eager model' % diff)
+            self.net = eager_net
+        else:
+            print('Optimized model set, max difference to eager %.2e' % diff)
+
     def __patch_instance_norm_state_dict(self, state_dict, module, keys, i=0):
         key = keys[i]
         if i + 1 == len(keys):  # at the end, pointing to a parameter/buffer
@@ -253,10 +765,69 @@ class ColorizeImageTorch(ColorizeImageBase):
             self.__patch_instance_norm_state_dict(state_dict, getattr(module, key), keys, i + 1)
 
     # ***** Call forward *****
-    def net_forward(self, input_ab, input_mask):
+    def _fill_net_input(self, input_ab, input_mask):
+        # write the normalized L, ab and mask planes into the preallocated net input;
+        # the L plane is only rewritten when another image has been loaded
+        import torch
+        shape = (1, 4) + self.img_l_mc.shape[1:]
+        if self.net_input is None or tuple(self.net_input.shape) != shape:
+            self.net_input = torch.empty(shape)
+            self.net_input_img_id = None
+        planes = self.net_input.numpy()[0]
+        if self.net_input_img_id != self.img_id:
+            np.multiply(self.img_l_mc, 1. / 100, out=planes[0:1])
+            self.net_input_img_id = self.img_id
+        np.subtract(input_ab, self.ab_mean, out=planes[1:3])
+        planes[1:3] *= 1. / (self.ab_norm * 110)
+        np.multiply(input_mask, self.mask_mult, out=planes[3:4])
+        planes[3:4] -= self.mask_cent
+        return self.net_input
+
+    def _hint_const(self):
+        # the hint planes of the net input where no hint has been given
+        return np.array([-self.ab_mean / (self.ab_norm * 110)] * 2 + [-self.mask_cent], dtype=np.float32)
+
+    def _hint_pixels(self, input_ab, input_mask):
+        # (ys, xs) of the pixels carrying a hint, None if there are too many for conv1_sparse
+        hinted = input_mask[0] != 0
+        hinted |= input_ab[0] != 0
+        hinted |= input_ab[1] != 0
+        ys, xs = np.nonzero(hinted)
+        if len(ys) > self.sparse_hint_fraction * hinted.size:
+            return None
+        return ys, xs
+
+    def _run_net(self, input_ab, input_mask):
+        # the net's outputs for the loaded image and these hints, as float32 arrays
+        # without the batch axis that share memory with the output tensors
+        import torch
+        if hasattr(self.net, 'forward_input'):
+            net_input = self._fill_net_input(input_ab, input_mask)
+            with torch.inference_mode():
+                if isinstance(self.net, torch.nn.Module):
+                    net_input = net_input.to(next(self.net.parameters()).device)
+                hint_pixels = self._hint_pixels(input_ab, input_mask) \
+                    if self.sparse_conv1 and hasattr(self.net, 'conv1_sparse') else None
+                if hint_pixels is not None:
+                    if self.conv1_base_key[0] != self.img_id or self.conv1_base_key[1] is not self.net:
+                        self.conv1_base = self.net.conv1_base_response(net_input[:, :1], self._hint_const())
+                        self.conv1_base_key = (self.img_id, self.net)
+                    ys, xs = (torch.from_numpy(a).to(net_input.device) for a in hint_pixels)
+                    hints = net_input[0, 1:, ys, xs].t() - torch.from_numpy(self._hint_const()).to(net_input.device)
+                    output = self.net.forward_conv1(self.net.conv1_sparse(self.conv1_base, ys, xs, hints))
+                else:
+                    output = self.net.forward_input(net_input)
+        else:  # exported models take the planes separately
+            output = self.net.forward(self.img_l_mc, self.input_ab_mc, self.input_mask_mult, self.mask_cent)
+        if not isinstance(output, tuple):
+            output = (output, )
+        return tuple(out[0].cpu().numpy() for out in output)
+
+    def net_forward(self, input_ab, input_mask, return_rgb=True):
         # INPUTS
         #     ab         2xXxX     input color patches (non-normalized)
         #     mask     1xXxX    input mask, indicating which points have been provided
+        #     return_rgb        return the rgb result; if False only output_ab is set and 0 is returned
         # assumes self.img_l_mc has been set
 
         if ColorizeImageBase.net_forward(self, input_ab, input_mask) == -1:
@@ -267,12 +838,113 @@ class ColorizeImageTorch(ColorizeImageBase):
         # return prediction
         # self.net.blobs['data_l_ab_mask'].data[...] = net_input_prepped
         # embed()
-        output_ab = self.net.forward(self.img_l_mc, self.input_ab_mc, self.input_mask_mult, self.mask_cent)[0, :, :, :].cpu().data.numpy()
-        self.output_rgb = lab2rgb_transpose(self.img_l, output_ab)
-        # self.output_rgb = lab2rgb_transpose(self.img_l, self.net.blobs[self.pred_ab_layer].data[0, :, :, :])
-
-        self._set_out_ab_()
-        return self.output_rgb
+        cache_key = self.cache.key(self.img_id, input_ab, input_mask)
+        cached = self.cache.get(cache_key)
+        if cached is None:
+            (output_ab, ) = self._run_net(input_ab, input_mask)
+            self.cache.put(cache_key, (output_ab, ))
+        else:
+            (output_ab, ) = cached
+        self._set_out_ab_(output_ab)
+        return self.output_rgb if return_rgb else 0
+
+    def net_forward_preview(self, input_ab, input_mask, size):
+        # a quick approximation of net_forward's ab output: the net runs on the image and
+        # hints shrunk to about size x size pixels and its output is scaled back up.
+        # Returns the 2xHxW ab, output_ab and the other outputs are left alone.
+        # Both sides are multiples of 8, what the net's skip connections need
+        import torch
+        if(not self.img_l_set or not self.net_set):
+            return -1
+        H, W = self.img_l_mc.shape[1:]
+        h, w = working_size(H, W, size * size)
+        if h * w >= H * W:
+            self.net_forward(input_ab, input_mask, return_rgb=False)
+            return self.output_ab
+        dsize = (w, h)
+        img_l_mc = cv2.resize(self.img_l_mc[0], dsize, interpolation=cv2.INTER_AREA)
+        # a hinted pixel stays a hinted pixel, with the mean color of the hints it covers
+        mask = cv2.resize(input_mask[0].astype(np.float32), dsize, interpolation=cv2.INTER_AREA)
+        ab_sum = cv2.resize((input_ab * input_mask).astype(np.float32).transpose((1, 2, 0)), dsize, interpolation=cv2.INTER_AREA)
+        hinted = mask > 0
+        ab = np.zeros_like(ab_sum)
+        ab[hinted] = ab_sum[hinted] / mask[hinted, np.newaxis]
+        with torch.inference_mode():
+            output = self.net.forward(img_l_mc[np.newaxis], (ab.transpose((2, 0, 1)) - self.ab_mean) / self.ab_norm,
+                                      hinted[np.newaxis] * self.mask_mult, self.mask_cent)
+        if isinstance(output, tuple):
+            output = output[0]
+        output_ab = cv2.resize(output[0].cpu().numpy().transpose((1, 2, 0)), (W, H), interpolation=cv2.INTER_CUBIC)
+        return output_ab.transpose((2, 0, 1))
+
+    def net_forward_batch(self, imgs, hints=None, batch_size=None, mem_budget=2**30):
+        ''' Colorize several images, stacking them into batched forward passes
+        INPUTS
+            imgs          list of XxYx3 uint8 rgb images (any size) or image paths
+            hints         list of (input_ab 2xHxW, input_mask 1xHxW) tuples, None entries mean no hints;
+                          hints of another size are resized to the image's load_shape (resize_hints)
+            batch_size    images per forward pass, chosen from mem_budget (bytes) when None
+        OUTPUTS
+            list of HxWx3 rgb results, list of 2xHxW ab predictions, HxW the load_shape of each image
+        With keep_aspect the images of a chunk are split into one forward pass per load_shape.
+        Does not touch the image currently loaded with load_image/set_image.
+        '''
+        import torch
+        if(not self.net_set):
+            print('I need to have a net!')
+            return -1
+        if hints is None:
+            hints = [None] * len(imgs)
+        if batch_size is None:
+            batch_size = self.batch_size_for_budget(mem_budget)
+
+        out_rgbs = []
+        out_abs = []
+        for start in range(0, len(imgs), batch_size):
+            # (img_l, img_l_mc, input_ab_mc, input_mask_mult) per load_shape, in input order
+            groups = {}
+            order = []
+            for im, hint in zip(imgs[start:start + batch_size], hints[start:start + batch_size]):
+                if isinstance(im, str):
+                    im = cv2.cvtColor(cv2.imread(im, 1), cv2.COLOR_BGR2RGB)
+                shape = self.load_shape(im.shape[0], im.shape[1])
+                im = cv2.resize(im, (shape[1], shape[0]))
+                cur_l = rgb2lab_transpose(im)[[0], :, :]
+                if hint is None:
+                    hint = (np.zeros((2,) + shape), np.zeros((1,) + shape))
+                else:
+                    hint = resize_hints(hint[0], hint[1], shape)
+                group = groups.setdefault(shape, ([], [], [], []))
+                order.append((shape, len(group[0])))
+                group[0].append(cur_l)
+                group[1].append((cur_l - self.l_mean) / self.l_norm)
+                group[2].append((hint[0] - self.ab_mean) / self.ab_norm)
+                group[3].append(hint[1] * self.mask_mult)
+
+            results = {}
+            for shape, (img_l, img_l_mc, input_ab_mc, input_mask_mult) in groups.items():
+                with torch.inference_mode():
+                    output = self.net.forward(np.stack(img_l_mc).astype('float32'), np.stack(input_ab_mc).astype('float32'),
+                                              np.stack(input_mask_mult).astype('float32'), self.mask_cent)
+                if isinstance(output, tuple):  # dist model, keep the point estimate
+                    output = output[0]
+                results[shape] = (img_l, output.cpu().numpy())
+            for shape, n in order:
+                img_l, output = results[shape]
+                out_abs.append(output[n])
+                out_rgbs.append(lab2rgb_transpose(img_l[n], output[n]))
+        return out_rgbs, out_abs
+
+    def batch_size_for_budget(self, mem_budget, dist=None):
+        # rough activation footprint of one image: ~512 float32 channels live at
+        # Xd x Xd (skip connections plus the full resolution decoder), and the
+        # 529-way softmax and its upsampled copy when the dist head is on
+        if dist is None:
+            dist = self.net.dist
+        bytes_per_pixel = 4 * 512
+        if dist:
+            bytes_per_pixel += 4 * 529 * 2
+        return max(1, int(mem_budget // (bytes_per_pixel * self.Xd * self.Xd)))
 
     def get_img_forward(self):
         # get image with point estimate
@@ -280,10 +952,14 @@ class ColorizeImageTorch(ColorizeImageBase):
 
     def get_img_gray(self):
         # Get black and white image
-        return lab2rgb_transpose(self.img_l, np.zeros((2, self.Xd, self.Xd)))
+        return lab2rgb_transpose(self.img_l, np.zeros((2, ) + self.img_l.shape[1:]))
 
 
 class ColorizeImageTorchDist(ColorizeImageTorch):
+    # Colorization and distribution prediction from one set of weights. The ab
+    # regression head and the distribution head share the conv1-conv8 trunk, so
+    # a single forward pass fills both output_rgb/output_ab and dist_ab, and one
+    # instance can serve as both the color model and the dist model.
     def __init__(self, Xd=256, maskcent=False):
         ColorizeImageTorch.__init__(self, Xd)
         self.dist_ab_set = False
@@ -296,69 +972,75 @@ class ColorizeImageTorchDist(ColorizeImageTorch):
         self.dist_ab_grid = np.zeros((self.A, self.B, self.Xd, self.Xd))
         self.dist_entropy = np.zeros((self.Xd, self.Xd))
         self.mask_cent = .5 if maskcent else 0
+        self.dist_key = None
+        self.suggest_map = None  # optional SuggestionMap, refreshed after every forward pass
 
-    def prep_net(self, gpu_id=None, path='', dist=True, S=.2):
-        ColorizeImageTorch.prep_net(self, gpu_id=gpu_id, path=path, dist=dist)
+    def prep_net(self, gpu_id=None, path='', dist=True, S=.2, backend='eager', quantized=False, optimize=False, compile=False):
+        ColorizeImageTorch.prep_net(self, gpu_id=gpu_id, path=path, dist=dist, backend=backend, quantized=quantized,
+                                    optimize=optimize, compile=compile)
         # set S somehow
 
-    def net_forward(self, input_ab, input_mask):
+    def _clear_outputs_(self):
+        ColorizeImageTorch._clear_outputs_(self)
+        self.dist_ab_set = False
+
+    def net_forward(self, input_ab, input_mask, return_rgb=True):
         # INPUTS
         #     ab         2xXxX     input color patches (non-normalized)
         #     mask     1xXxX    input mask, indicating which points have been provided
+        #     return_rgb        return the rgb result; if False only output_ab is set and 0 is returned
         # assumes self.img_l_mc has been set
 
         # embed()
         if ColorizeImageBase.net_forward(self, input_ab, input_mask) == -1:
             return -1
 
-        # set distribution
-        (function_return, self.dist_ab) = self.net.forward(self.img_l_mc, self.input_ab_mc, self.input_mask_mult, self.mask_cent)
-        function_return = function_return[0, :, :, :].cpu().data.numpy()
-        self.dist_ab = self.dist_ab[0, :, :, :].cpu().data.numpy()
+        # one trunk pass gives both the point estimate and the distribution
+        # the distribution head ends in a nearest 4x upsample, so the cache keeps only
+        # every 4th pixel of dist_ab (16x smaller) and a hit repeats it back
+        cache_key = self.cache.key(self.img_id, input_ab, input_mask)
+        cached = self.cache.get(cache_key)
+        if cached is None:
+            (output_ab, self.dist_ab) = self._run_net(input_ab, input_mask)
+            self.cache.put(cache_key, (output_ab, np.ascontiguousarray(self.dist_ab[:, ::4, ::4])))
+        else:
+            (output_ab, dist_ab) = cached
+            self.dist_ab = np.repeat(np.repeat(dist_ab, 4, axis=1), 4, axis=2)
         self.dist_ab_set = True
+        self.dist_key = cache_key
+        if self.suggest_map is not None:
+            self.suggest_map.start(self.pts_in_hull, self.dist_ab, self.dist_key)
 
-        # full grid, ABxXxX, AB = 529
+        # point estimate
+        self._set_out_ab_(output_ab)
+
+        # full grid, ABxHxW, AB = 529
+        if self.dist_ab_full.shape[1:] != self.dist_ab.shape[1:]:
+            self.dist_ab_full = np.zeros((self.AB, ) + self.dist_ab.shape[1:])
         self.dist_ab_full[self.in_hull, :, :] = self.dist_ab
 
-        # gridded, AxBxXxX, A = 23
-        self.dist_ab_grid = self.dist_ab_full.reshape((self.A, self.B, self.Xd, self.Xd))
+        # gridded, AxBxHxW, A = 23
+        self.dist_ab_grid = self.dist_ab_full.reshape((self.A, self.B) + self.dist_ab.shape[1:])
 
         # return
-        return function_return
+        return self.output_rgb if return_rgb else 0
 
-    def get_ab_reccs(self, h, w, K=5, N=25000, return_conf=False):
+    def get_ab_reccs(self, h, w, K=5, N=25000, return_conf=False, method='modes'):
         ''' Recommended colors at point (h,w)
         Call this after calling net_forward
+        method 'modes' clusters the histogram bins directly (ab_modes),
+        'sample' runs KMeans on N random draws from it (sample_ab_reccs)
         '''
         if not self.dist_ab_set:
             print('Need to set prediction first')
             return 0
+        return self.dist_snapshot().get_ab_reccs(h, w, K=K, N=N, return_conf=return_conf, method=method)
 
-        # randomly sample from pdf
-        cmf = np.cumsum(self.dist_ab[:, h, w])  # CMF
-        cmf = cmf / cmf[-1]
-        cmf_bins = cmf
-
-        # randomly sample N points
-        rnd_pts = np.random.uniform(low=0, high=1.0, size=N)
-        inds = np.digitize(rnd_pts, bins=cmf_bins)
-        rnd_pts_ab = self.pts_in_hull[inds, :]
-
-        # run k-means
-        kmeans = KMeans(n_clusters=K).fit(rnd_pts_ab)
-
-        # sort by cluster occupancy
-        k_label_cnt = np.histogram(kmeans.labels_, np.arange(0, K + 1))[0]
-        k_inds = np.argsort(k_label_cnt, axis=0)[::-1]
-
-        cluster_per = 1. * k_label_cnt[k_inds] / N  # percentage of points within cluster
-        cluster_centers = kmeans.cluster_centers_[k_inds, :]  # cluster centers
-
-        # cluster_centers = np.random.uniform(low=-100,high=100,size=(N,2))
-        if return_conf:
-            return cluster_centers, cluster_per
-        else:
-            return cluster_centers
+    def dist_snapshot(self):
+        # the current distribution, to suggest colors from on another thread while net_forward moves on
+        if not self.dist_ab_set:
+            return None
+        return DistSnapshot(self.pts_in_hull, self.dist_ab, self.dist_key, self.suggest_map)
 
     def compute_entropy(self):
         # compute the distribution entropy (really slow right now)
@@ -399,12 +1081,8 @@ class ColorizeImageCaffe(ColorizeImageBase):
     def prep_net(self, gpu_id, prototxt_path='', caffemodel_path=''):
         import caffe
         print('gpu_id = %d, net_path = %s, model_path = %s' % (gpu_id, prototxt_path, caffemodel_path))
-        if gpu_id == -1:
-            caffe.set_mode_cpu()
-        else:
-            caffe.set_device(gpu_id)
-            caffe.set_mode_gpu()
         self.gpu_id = gpu_id
+        self.prepare_thread()
         self.net = caffe.Net(prototxt_path, caffemodel_path, caffe.TEST)
         self.net_set = True
 
@@ -419,11 +1097,21 @@ class ColorizeImageCaffe(ColorizeImageBase):
                 print('Setting upsampling layer kernel: %s' % layer)
                 self.net.params[layer][0].data[:, 0, :, :] = np.array(((.25, .5, .25, 0), (.5, 1., .5, 0), (.25, .5, .25, 0), (0, 0, 0, 0)))[np.newaxis, :, :]
 
+    def prepare_thread(self):
+        # caffe's cpu/gpu mode and device are per thread
+        import caffe
+        if self.gpu_id == -1:
+            caffe.set_mode_cpu()
+        else:
+            caffe.set_device(self.gpu_id)
+            caffe.set_mode_gpu()
+
     # ***** Call forward *****
-    def net_forward(self, input_ab, input_mask):
+    def net_forward(self, input_ab, input_mask, return_rgb=True):
         # INPUTS
         #     ab         2xXxX     input color patches (non-normalized)
         #     mask     1xXxX    input mask, indicating which points have been provided
+        #     return_rgb        return the rgb result; if False only output_ab is set and 0 is returned
         # assumes self.img_l_mc has been set
 
         if ColorizeImageBase.net_forward(self, input_ab, input_mask) == -1:
@@ -434,11 +1122,9 @@ class ColorizeImageCaffe(ColorizeImageBase):
         self.net.blobs['data_l_ab_mask'].data[...] = net_input_prepped
         self.net.forward()
 
-        # return prediction
-        self.output_rgb = lab2rgb_transpose(self.img_l, self.net.blobs[self.pred_ab_layer].data[0, :, :, :])
-
-        self._set_out_ab_()
-        return self.output_rgb
+        # return prediction, copied since caffe reuses the blob
+        self._set_out_ab_(self.net.blobs[self.pred_ab_layer].data[0, :, :, :].copy())
+        return self.output_rgb if return_rgb else 0
 
     def get_img_forward(self):
         # get image with point estimate
@@ -446,7 +1132,7 @@ class ColorizeImageCaffe(ColorizeImageBase):
 
     def get_img_gray(self):
         # Get black and white image
-        return lab2rgb_transpose(self.img_l, np.zeros((2, self.Xd, self.Xd)))
+        return lab2rgb_transpose(self.img_l, np.zeros((2, ) + self.img_l.shape[1:]))
 
 
 class ColorizeImageCaffeGlobDist(ColorizeImageCaffe):
@@ -456,7 +1142,7 @@ class ColorizeImageCaffeGlobDist(ColorizeImageCaffe):
         self.glob_mask_mult = 1.
         self.glob_layer = 'glob_ab_313_mask'
 
-    def net_forward(self, input_ab, input_mask, glob_dist=-1):
+    def net_forward(self, input_ab, input_mask, glob_dist=-1, return_rgb=True):
         # glob_dist is 313 array, or -1
         if np.array(glob_dist).flatten()[0] == -1:  # run without this, zero it out
             self.net.blobs[self.glob_layer].data[0, :-1, 0, 0] = 0.
@@ -465,9 +1151,7 @@ class ColorizeImageCaffeGlobDist(ColorizeImageCaffe):
             self.net.blobs[self.glob_layer].data[0, :-1, 0, 0] = glob_dist
             self.net.blobs[self.glob_layer].data[0, -1, 0, 0] = self.glob_mask_mult
 
-        self.output_rgb = ColorizeImageCaffe.net_forward(self, input_ab, input_mask)
-        self._set_out_ab_()
-        return self.output_rgb
+        return ColorizeImageCaffe.net_forward(self, input_ab, input_mask, return_rgb=return_rgb)
 
 
 class ColorizeImageCaffeDist(ColorizeImageCaffe):
@@ -485,19 +1169,26 @@ class ColorizeImageCaffeDist(ColorizeImageCaffe):
         self.dist_ab_full = np.zeros((self.AB, self.Xd, self.Xd))
         self.dist_ab_grid = np.zeros((self.A, self.B, self.Xd, self.Xd))
         self.dist_entropy = np.zeros((self.Xd, self.Xd))
+        self.dist_key = 0
+        self.suggest_map = None  # optional SuggestionMap, refreshed after every forward pass
 
     def prep_net(self, gpu_id, prototxt_path='', caffemodel_path='', S=.2):
         ColorizeImageCaffe.prep_net(self, gpu_id, prototxt_path=prototxt_path, caffemodel_path=caffemodel_path)
         self.S = S
         self.net.params[self.scale_S_layer][0].data[...] = S
 
-    def net_forward(self, input_ab, input_mask):
+    def _clear_outputs_(self):
+        ColorizeImageCaffe._clear_outputs_(self)
+        self.dist_ab_set = False
+
+    def net_forward(self, input_ab, input_mask, return_rgb=True):
         # INPUTS
         #     ab         2xXxX     input color patches (non-normalized)
         #     mask     1xXxX    input mask, indicating which points have been provided
+        #     return_rgb        return the rgb result; if False only output_ab is set and 0 is returned
         # assumes self.img_l_mc has been set
 
-        function_return = ColorizeImageCaffe.net_forward(self, input_ab, input_mask)
+        function_return = ColorizeImageCaffe.net_forward(self, input_ab, input_mask, return_rgb=return_rgb)
         if np.array(function_return).flatten()[0] == -1:  # errored out
             return -1
 
@@ -505,6 +1196,10 @@ class ColorizeImageCaffeDist(ColorizeImageCaffe):
         # in-gamut, CxXxX, C = 313
         self.dist_ab = self.net.blobs[self.dist_ab_S_layer].data[0, :, :, :]
         self.dist_ab_set = True
+        self.dist_key += 1
+        if self.suggest_map is not None:
+            # the blob is overwritten by the next forward pass
+            self.suggest_map.start(self.pts_in_hull, self.dist_ab.copy(), self.dist_key)
 
         # full grid, ABxXxX, AB = 529
         self.dist_ab_full[self.in_hull, :, :] = self.dist_ab
@@ -515,39 +1210,22 @@ class ColorizeImageCaffeDist(ColorizeImageCaffe):
         # return
         return function_return
 
-    def get_ab_reccs(self, h, w, K=5, N=25000, return_conf=False):
+    def get_ab_reccs(self, h, w, K=5, N=25000, return_conf=False, method='modes'):
         ''' Recommended colors at point (h,w)
         Call this after calling net_forward
+        method 'modes' clusters the histogram bins directly (ab_modes),
+        'sample' runs KMeans on N random draws from it (sample_ab_reccs)
         '''
         if not self.dist_ab_set:
             print('Need to set prediction first')
             return 0
+        return self.dist_snapshot().get_ab_reccs(h, w, K=K, N=N, return_conf=return_conf, method=method)
 
-        # randomly sample from pdf
-        cmf = np.cumsum(self.dist_ab[:, h, w])  # CMF
-        cmf = cmf / cmf[-1]
-        cmf_bins = cmf
-
-        # randomly sample N points
-        rnd_pts = np.random.uniform(low=0, high=1.0, size=N)
-        inds = np.digitize(rnd_pts, bins=cmf_bins)
-        rnd_pts_ab = self.pts_in_hull[inds, :]
-
-        # run k-means
-        kmeans = KMeans(n_clusters=K).fit(rnd_pts_ab)
-
-        # sort by cluster occupancy
-        k_label_cnt = np.histogram(kmeans.labels_, np.arange(0, K + 1))[0]
-        k_inds = np.argsort(k_label_cnt, axis=0)[::-1]
-
-        cluster_per = 1. * k_label_cnt[k_inds] / N  # percentage of points within cluster
-        cluster_centers = kmeans.cluster_centers_[k_inds, :]  # cluster centers
-
-        # cluster_centers = np.random.uniform(low=-100,high=100,size=(N,2))
-        if return_conf:
-            return cluster_centers, cluster_per
-        else:
-            return cluster_centers
+    def dist_snapshot(self):
+        # the current distribution, copied since the blob is overwritten by the next forward pass
+        if not self.dist_ab_set:
+            return None
+        return DistSnapshot(self.pts_in_hull, self.dist_ab.copy(), self.dist_key, self.suggest_map)
 
     def compute_entropy(self):
         # compute the distribution entropy (really slow right now)
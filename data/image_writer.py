@@ -0,0 +1,79 @@
+''' Writers that take an RGB image a strip of rows at a time, so a full
+resolution result never has to be held in memory at once.
+
+    writer = open_strip_writer('out.png', height, width)
+    for strip in strips:  # each strip is hxwidthx3 uint8, top to bottom
+        writer.write(strip)
+    writer.close()
+
+.png is compressed as it streams, .tif/.tiff (needs tifffile) and .npy are
+written through a memory map.
+'''
+import os
+import struct
+import zlib
+import numpy as np
+
+
+class PNGStripWriter():
+    # 8-bit RGB PNG, each row stored with the Sub filter
+    def __init__(self, path, height, width, compress_level=6):
+        self.height = height
+        self.width = width
+        self.rows_written = 0
+        self.f = open(path, 'wb')
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        self.compressor = zlib.compressobj(compress_level)
+
+    def _write_chunk(self, chunk_type, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(chunk_type)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+    def write(self, strip):
+        strip = np.ascontiguousarray(strip, dtype=np.uint8).reshape((strip.shape[0], self.width * 3))
+        filtered = np.empty((strip.shape[0], self.width * 3 + 1), np.uint8)
+        filtered[:, 0] = 1  # Sub: each byte minus the same channel of the previous pixel
+        filtered[:, 1:4] = strip[:, :3]
+        np.subtract(strip[:, 3:], strip[:, :-3], out=filtered[:, 4:])
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+        self.rows_written += strip.shape[0]
+
+    def close(self):
+        if self.rows_written != self.height:
+            print('WARNING: wrote %d rows of %d' % (self.rows_written, self.height))
+        self._write_chunk(b'IDAT', self.compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self.f.close()
+
+
+class MemmapStripWriter():
+    # fills a memory mapped HxWx3 uint8 array top to bottom
+    def __init__(self, memmap):
+        self.memmap = memmap
+        self.rows_written = 0
+
+    def write(self, strip):
+        self.memmap[self.rows_written:self.rows_written + strip.shape[0]] = strip
+        self.rows_written += strip.shape[0]
+
+    def close(self):
+        self.memmap.flush()
+        del self.memmap
+
+
+def open_strip_writer(path, height, width):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.png':
+        return PNGStripWriter(path, height, width)
+    elif ext in ('.tif', '.tiff'):
+        import tifffile
+        return MemmapStripWriter(tifffile.memmap(path, shape=(height, width, 3), dtype=np.uint8, photometric='rgb'))
+    elif ext == '.npy':
+        return MemmapStripWriter(np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 3)))
+    else:
+        raise ValueError('no streaming writer for [%s], use .png, .tif or .npy' % ext)
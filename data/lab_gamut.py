@@ -1,6 +1,8 @@
+import os
 import numpy as np
 from skimage import color
 import warnings
+from data import color_space
 
 
 def qcolor2lab_1d(qc):
@@ -25,36 +27,127 @@ def lab2rgb_1d(in_lab, clip=True, dtype='uint8'):
     return tmp_rgb
 
 
-def snap_ab(input_l, input_rgb, return_type='rgb'):
-    ''' given an input lightness and rgb, snap the color into a region where l,a,b is in-gamut
-    '''
-    T = 20
+def _snap_lab_many(lab, T=20):
+    # the snap_ab iteration on N starting Lab colors at once: alternate clipping
+    # into rgb and converting back, with L held fixed, until the Lab color moves
+    # by less than 1. Each color stops at its own iteration, like the loop in snap_ab
     warnings.filterwarnings("ignore")
-    input_lab = rgb2lab_1d(np.array(input_rgb))  # convert input to lab
-    conv_lab = input_lab.copy()  # keep ab from input
+    input_l = lab[:, 0].copy()
+    conv_lab = lab.copy()
+    active = np.arange(lab.shape[0])
     for t in range(T):
-        conv_lab[0] = input_l  # overwrite input l with input ab
-        old_lab = conv_lab
-        tmp_rgb = color.lab2rgb(conv_lab[np.newaxis, np.newaxis, :]).flatten()
-        tmp_rgb = np.clip(tmp_rgb, 0, 1)
-        conv_lab = color.rgb2lab(tmp_rgb[np.newaxis, np.newaxis, :]).flatten()
-        dif_lab = np.sum(np.abs(conv_lab - old_lab))
-        if dif_lab < 1:
+        conv_lab[active, 0] = input_l[active]  # overwrite l, keep ab
+        old_lab = conv_lab[active]
+        tmp_rgb = np.clip(color.lab2rgb(old_lab[:, np.newaxis, :]), 0, 1)
+        new_lab = color.rgb2lab(tmp_rgb)[:, 0, :]
+        conv_lab[active] = new_lab
+        active = active[np.sum(np.abs(new_lab - old_lab), axis=1) >= 1]
+        if len(active) == 0:
             break
-        # print(conv_lab)
-
-    conv_rgb_ingamut = lab2rgb_1d(conv_lab, clip=True, dtype='uint8')
+    return np.round(np.clip(color.lab2rgb(conv_lab[:, np.newaxis, :]), 0, 1)[:, 0, :] * 255).astype('uint8')
+
+
+def snap_ab_many(input_l, input_rgb, return_type='rgb'):
+    ''' snap_ab for arrays of colors
+        INPUTS
+            input_l     N         lightness to snap each color at
+            input_rgb   Nx3       uint8 colors
+        OUTPUTS
+            Nx3 in-gamut uint8 rgb, or Nx3 lab if return_type is 'lab' '''
+    input_rgb = np.asarray(input_rgb, dtype='uint8').reshape((-1, 3))
+    input_lab = color.rgb2lab(input_rgb[:, np.newaxis, :])[:, 0, :]  # convert input to lab
+    input_lab[:, 0] = input_l
+    conv_rgb_ingamut = _snap_lab_many(input_lab)
     if (return_type == 'rgb'):
         return conv_rgb_ingamut
 
     elif(return_type == 'lab'):
-        conv_lab_ingamut = rgb2lab_1d(conv_rgb_ingamut)
-        return conv_lab_ingamut
+        return color.rgb2lab(conv_rgb_ingamut[:, np.newaxis, :])[:, 0, :]
+
+
+def snap_ab(input_l, input_rgb, return_type='rgb'):
+    ''' given an input lightness and rgb, snap the color into a region where l,a,b is in-gamut
+    '''
+    return snap_ab_many(np.array([input_l]), np.array(input_rgb), return_type=return_type)[0]
+
+
+SNAP_TABLE_PATH = './data/color_bins/snap_table.npy'
+
+
+class SnapTable():
+    ''' snap_ab precomputed over a quantized (L, a, b) grid.
+
+    table[i, j, k] is the in-gamut uint8 rgb of L = i * L_step,
+    a = j * ab_step - gamut_size, b = k * ab_step - gamut_size. Lookups round to
+    the nearest grid point, so the result can differ from snap_ab by the
+    quantization step. Build once with `python -m data.lab_gamut`.
+    '''
+    def __init__(self, table, gamut_size=110):
+        self.table = table
+        self.gamut_size = gamut_size
+        self.L_step = 100. / (table.shape[0] - 1)
+        self.ab_step = 2. * gamut_size / (table.shape[1] - 1)
+
+    @classmethod
+    def build(cls, L_step=1, ab_step=2, gamut_size=110, chunk=2**16):
+        vals_l = np.arange(0, 100 + L_step / 2., L_step)
+        vals_ab = np.arange(-gamut_size, gamut_size + ab_step / 2., ab_step)
+        grid_l, grid_a, grid_b = np.meshgrid(vals_l, vals_ab, vals_ab, indexing='ij')
+        lab = np.stack((grid_l.ravel(), grid_a.ravel(), grid_b.ravel()), axis=1)
+        table = np.zeros((lab.shape[0], 3), np.uint8)
+        for n in range(0, lab.shape[0], chunk):
+            table[n:n + chunk] = _snap_lab_many(lab[n:n + chunk])
+        return cls(table.reshape(grid_l.shape + (3,)), gamut_size=gamut_size)
+
+    @classmethod
+    def load(cls, path=SNAP_TABLE_PATH):
+        return cls(np.load(path))
+
+    def save(self, path=SNAP_TABLE_PATH):
+        np.save(path, self.table)
+
+    def snap_lab(self, lab):
+        # Nx3 Lab -> Nx3 in-gamut uint8 rgb
+        i = np.clip(np.round(lab[:, 0] / self.L_step), 0, self.table.shape[0] - 1).astype(int)
+        j = np.clip(np.round((lab[:, 1] + self.gamut_size) / self.ab_step), 0, self.table.shape[1] - 1).astype(int)
+        k = np.clip(np.round((lab[:, 2] + self.gamut_size) / self.ab_step), 0, self.table.shape[2] - 1).astype(int)
+        return self.table[i, j, k]
+
+    def snap(self, input_l, input_rgb):
+        # same arguments as snap_ab_many
+        input_rgb = np.asarray(input_rgb, dtype='uint8').reshape((-1, 3))
+        lab = color_space.rgb2lab(input_rgb[:, np.newaxis, :])[:, 0, :]
+        lab[:, 0] = input_l
+        return self.snap_lab(lab)
+
+
+_snap_table = None
+
+
+def get_snap_table(path=SNAP_TABLE_PATH):
+    # the saved table, loaded on first use; None if it has not been built
+    global _snap_table
+    if _snap_table is None and os.path.exists(path):
+        _snap_table = SnapTable.load(path)
+    return _snap_table
+
+
+def snap_ab_fast(input_l, input_rgb):
+    ''' snap_ab through the precomputed table when it exists, computed otherwise.
+    Returns the in-gamut uint8 rgb '''
+    table = get_snap_table()
+    if table is None:
+        return snap_ab(input_l, input_rgb)
+    return table.snap(np.array([input_l]), np.array(input_rgb))[0]
+
+
+GAMUT_CACHE_PATH = './data/color_bins/gamut_cache_%d.npz'  # % gamut_size
 
 
 class abGrid():
     def __init__(self, gamut_size=110, D=1):
         self.D = D
+        self.gamut_cache = {}  # integer L -> (masked_rgb, mask), see get_gamut
         self.vals_b, self.vals_a = np.meshgrid(np.arange(-gamut_size, gamut_size + D, D),
                                                np.arange(-gamut_size, gamut_size + D, D))
         self.pts_full_grid = np.concatenate((self.vals_a[:, :, np.newaxis], self.vals_b[:, :, np.newaxis]), axis=2)
@@ -67,15 +160,57 @@ class abGrid():
         warnings.filterwarnings("ignore")
         thresh = 1.0
         pts_lab = np.concatenate((l_in + np.zeros((self.A, self.B, 1)), self.pts_full_grid), axis=2)
-        self.pts_rgb = (255 * np.clip(color.lab2rgb(pts_lab), 0, 1)).astype('uint8')
-        pts_lab_back = color.rgb2lab(self.pts_rgb)
+        pts_rgb = (255 * np.clip(color.lab2rgb(pts_lab), 0, 1)).astype('uint8')
+        pts_lab_back = color.rgb2lab(pts_rgb)
         pts_lab_diff = np.linalg.norm(pts_lab - pts_lab_back, axis=2)
 
-        self.mask = pts_lab_diff < thresh
-        mask3 = np.tile(self.mask[..., np.newaxis], [1, 1, 3])
-        self.masked_rgb = self.pts_rgb.copy()
-        self.masked_rgb[np.invert(mask3)] = 255
-        return self.masked_rgb, self.mask
+        mask = pts_lab_diff < thresh
+        mask3 = np.tile(mask[..., np.newaxis], [1, 1, 3])
+        masked_rgb = pts_rgb.copy()
+        masked_rgb[np.invert(mask3)] = 255
+        # locals first: get_gamut may run this from the precompute thread too
+        self.pts_rgb, self.mask, self.masked_rgb = pts_rgb, mask, masked_rgb
+        return masked_rgb, mask
+
+    def get_gamut(self, l_in):
+        ''' update_gamut with l_in rounded to an integer in [0, 100], memoized.
+        Returns (masked_rgb, mask), which must not be modified '''
+        L = int(np.clip(np.round(l_in), 0, 100))
+        gamut = self.gamut_cache.get(L)
+        if gamut is None:
+            gamut = self.update_gamut(L)
+            self.gamut_cache[L] = gamut
+        return gamut
+
+    def cache_path(self):
+        return GAMUT_CACHE_PATH % self.gamut_size
+
+    def load_cache(self, path=None):
+        # returns False if there is no usable cache file
+        path = self.cache_path() if path is None else path
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as f:
+            if f['masked_rgb'].shape[1:3] != (self.A, self.B):
+                return False
+            for L, masked_rgb, mask in zip(f['L'], f['masked_rgb'], f['mask']):
+                self.gamut_cache[int(L)] = (masked_rgb, mask)
+        return True
+
+    def save_cache(self, path=None):
+        path = self.cache_path() if path is None else path
+        Ls = sorted(self.gamut_cache.keys())
+        with open(path + '.tmp', 'wb') as f:  # renamed when complete, so a partial file is never loaded
+            np.savez_compressed(f, L=np.array(Ls),
+                                masked_rgb=np.stack([self.gamut_cache[L][0] for L in Ls]),
+                                mask=np.stack([self.gamut_cache[L][1] for L in Ls]))
+        os.replace(path + '.tmp', path)
+
+    def precompute(self, path=None):
+        # fill the cache for every integer L and write it to disk
+        for L in range(101):
+            self.get_gamut(L)
+        self.save_cache(path)
 
     def ab2xy(self, a, b):
         y = self.gamut_size + a
@@ -88,3 +223,15 @@ class abGrid():
         b = x - self.gamut_size
         # print('xy2ab (%d, %d) -> (%d, %d)' % (x, y, a, b))
         return a, b
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='build the snap_ab lookup table')
+    parser.add_argument('--L_step', type=float, default=1)
+    parser.add_argument('--ab_step', type=float, default=2)
+    parser.add_argument('--path', type=str, default=SNAP_TABLE_PATH)
+    args = parser.parse_args()
+    snap_table = SnapTable.build(L_step=args.L_step, ab_step=args.ab_step)
+    snap_table.save(args.path)
+    print('saved %s table to [%s]' % (str(snap_table.table.shape), args.path))
@@ -1,12 +1,6 @@
 from __future__ import print_function
 import sys
 import argparse
-import qdarkstyle
-# ✅ Updated for PyQt5
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtGui import QIcon
-from PyQt5.QtCore import Qt
-from ui import gui_design
 from data import colorize_image as CI
 
 sys.path.append('./caffe_files')
@@ -39,7 +33,17 @@ def parse_args():
     parser.add_argument('--dist_model', dest='color_model', help='colorization distribution prediction model', type=str,
                         default='./models/pytorch/caffemodel.pth')
 
-    parser.add_argument('--backend', dest='backend', type=str, help='caffe or pytorch', default='caffe')
+    parser.add_argument('--backend', dest='backend', type=str, default='caffe',
+                        help="caffe, pytorch, or the exported pytorch model run by torchscript or onnx (onnxruntime on the cpu), see models/pytorch/export.py")
+    parser.add_argument('--quantized', dest='quantized', help='--color_model is an int8 checkpoint written by models/pytorch/quantize.py (pytorch backend, cpu)', action='store_true')
+    parser.add_argument('--optimize', dest='optimize', help='run a batch norm folded, channels_last copy of the pytorch model under inference_mode', action='store_true')
+    parser.add_argument('--compile', dest='compile', help='with --optimize, also run the model through torch.compile (slow first prediction)', action='store_true')
+    parser.add_argument('--cache_mb', dest='cache_mb', type=int, help='memory cap of the pytorch prediction cache in MB, 0 disables it', default=512)
+    parser.add_argument('--suggest_map', dest='suggest_map', help='precompute color suggestions for every pixel in the background after each prediction', action='store_true')
+    parser.add_argument('--preview_sizes', dest='preview_sizes', type=int, nargs='*', default=[128],
+                        help='working sizes of the quick previews shown while a point is dragged (pytorch backend), none for full forwards only')
+    parser.add_argument('--keep_aspect', dest='keep_aspect', action='store_true',
+                        help='pytorch backends: run at about load_size^2 pixels with the aspect ratio of the image instead of load_size x load_size')
     parser.add_argument('--pytorch_maskcent', dest='pytorch_maskcent', help='need to center mask (activate for siggraph_pretrained but not for converted caffemodel)', action='store_true')
 
     # ***** DEPRECATED *****
@@ -50,6 +54,18 @@ def parse_args():
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        # headless: python ideepcolor.py batch <images or dirs> --out_dir <dir>
+        from data import batch_colorize
+        sys.exit(batch_colorize.main(sys.argv[2:]))
+
+    import qdarkstyle
+    # ✅ Updated for PyQt5
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtGui import QIcon
+    from PyQt5.QtCore import Qt
+    from ui import gui_design
+
     args = parse_args()
 
     for arg in vars(args):
@@ -67,15 +83,21 @@ if __name__ == '__main__':
 
         distModel = CI.ColorizeImageCaffeDist(Xd=args.load_size)
         distModel.prep_net(args.gpu, args.dist_prototxt, args.dist_caffemodel)
-    elif args.backend == 'pytorch':
-        colorModel = CI.ColorizeImageTorch(Xd=args.load_size,maskcent=args.pytorch_maskcent)
-        colorModel.prep_net(gpu_id=args.gpu, path=args.color_model)
-
-        distModel = CI.ColorizeImageTorchDist(Xd=args.load_size,maskcent=args.pytorch_maskcent)
-        distModel.prep_net(gpu_id=args.gpu, path=args.color_model, dist=True)
+    elif args.backend in ('pytorch', 'torchscript', 'onnx'):
+        # a single network produces both the colorization and the distribution
+        colorModel = CI.ColorizeImageTorchDist(Xd=args.load_size, maskcent=args.pytorch_maskcent)
+        colorModel.prep_net(gpu_id=args.gpu, path=args.color_model, dist=True,
+                            backend='eager' if args.backend == 'pytorch' else args.backend, quantized=args.quantized,
+                            optimize=args.optimize, compile=args.compile)
+        colorModel.cache.max_bytes = args.cache_mb * 2**20
+        colorModel.keep_aspect = args.keep_aspect
+        distModel = colorModel
     else:
         print('backend type [%s] not found!' % args.backend)
 
+    if args.suggest_map:
+        distModel.suggest_map = CI.SuggestionMap(K=9)  # the GUI asks for 9 suggestions
+
     # initialize application
     app = QApplication(sys.argv)
     
@@ -96,6 +118,7 @@ if __name__ == '__main__':
     
     window = gui_design.GUIDesign(color_model=colorModel, dist_model=distModel,
                                   img_file=args.image_file, load_size=args.load_size, win_size=args.win_size)
+    window.drawWidget.preview_sizes = args.preview_sizes
     app.setStyleSheet(qdarkstyle.load_stylesheet(pyside=False))  # comment this if you do not like dark stylesheet
     app.setWindowIcon(QIcon('imgs/logo.png'))  # load logo
     window.setWindowTitle('iColor - Interactive Deep Colorization')
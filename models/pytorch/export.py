@@ -0,0 +1,162 @@
+''' Export SIGGRAPHGenerator to TorchScript and ONNX, and run the exported graphs.
+
+    python -m models.pytorch.export --color_model ./models/pytorch/caffemodel.pth
+
+writes caffemodel.ts, caffemodel_dist.ts, caffemodel.onnx and caffemodel_dist.onnx
+next to the checkpoint and checks each of them against the eager model.
+ColorizeImageTorch.prep_net(backend='torchscript' or 'onnx') loads them back.
+Only forward_tensors is exported: the mask centering and numpy conversion stay
+outside the graph, so one file serves both the converted and the siggraph weights.
+Height and width are dynamic, the exported graphs take any multiple of 8.
+'''
+from __future__ import print_function
+import argparse
+import os
+import numpy as np
+import torch
+
+BACKENDS = ('torchscript', 'onnx')
+EXTENSIONS = {'torchscript': '.ts', 'onnx': '.onnx'}
+INPUT_NAMES = ['input_A', 'input_B', 'mask_B']
+
+
+class _Traceable(torch.nn.Module):
+    # forward_tensors as forward, which is what trace and the onnx exporter call
+    def __init__(self, net):
+        super(_Traceable, self).__init__()
+        self.net = net
+
+    def forward(self, input_A, input_B, mask_B):
+        return self.net.forward_tensors(input_A, input_B, mask_B)
+
+
+def exported_path(path, backend, dist):
+    # model.pth -> model.ts / model_dist.onnx; other paths are taken as they are
+    root, ext = os.path.splitext(path)
+    if ext != '.pth':
+        return path
+    return root + ('_dist' if dist else '') + EXTENSIONS[backend]
+
+
+def example_inputs(Xd=256, N=1, seed=0):
+    rng = np.random.RandomState(seed)
+    input_A = rng.uniform(-50, 50, (N, 1, Xd, Xd))
+    input_B = rng.uniform(-110, 110, (N, 2, Xd, Xd))
+    mask_B = (rng.rand(N, 1, Xd, Xd) < .01).astype('float32')
+    return [torch.from_numpy(np.ascontiguousarray(a, dtype='float32')) for a in (input_A, input_B, mask_B)]
+
+
+def export_torchscript(net, path, Xd=256):
+    net.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(_Traceable(net).eval(), tuple(example_inputs(Xd)), check_trace=False)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return path
+
+
+def export_onnx(net, path, Xd=256, opset=17):
+    net.eval()
+    output_names = ['out_reg', 'out_cl'] if net.dist else ['out_reg']
+    dynamic_axes = dict((name, {0: 'N', 2: 'H', 3: 'W'}) for name in INPUT_NAMES + output_names)
+    with torch.no_grad():
+        torch.onnx.export(_Traceable(net).eval(), tuple(example_inputs(Xd)), path, input_names=INPUT_NAMES,
+                          output_names=output_names, dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False)
+    return path
+
+
+def _as_batch(input_A, input_B, mask_B, maskcent):
+    # the numpy side of SIGGRAPHGenerator.forward: float32, NxCxHxW, centered mask
+    arrays = []
+    for a in (input_A, input_B, mask_B):
+        a = a.cpu().numpy() if torch.is_tensor(a) else np.asarray(a)
+        if a.ndim == 3:
+            a = a[np.newaxis]
+        arrays.append(np.ascontiguousarray(a, dtype='float32'))
+    if maskcent:
+        arrays[2] = arrays[2] - np.float32(maskcent)
+    return arrays
+
+
+class TorchScriptGenerator(object):
+    ''' A traced SIGGRAPHGenerator with the same forward signature and outputs '''
+    def __init__(self, path, dist, gpu_id=None):
+        self.dist = dist
+        self.device = torch.device('cpu')
+        if gpu_id is not None and gpu_id >= 0 and torch.cuda.is_available():
+            self.device = torch.device('cuda', gpu_id)
+        self.module = torch.jit.load(path, map_location=self.device)
+        self.module.eval()
+
+    def forward(self, input_A, input_B, mask_B, maskcent=0):
+        inputs = [torch.from_numpy(a).to(self.device) for a in _as_batch(input_A, input_B, mask_B, maskcent)]
+        with torch.no_grad():
+            return self.module(*inputs)
+
+
+class OnnxGenerator(object):
+    ''' An exported SIGGRAPHGenerator run by onnxruntime on the CPU '''
+    def __init__(self, path, dist, num_threads=None):
+        import onnxruntime
+        if num_threads is None:  # follow torch.set_num_threads, which batch workers use to split the cores
+            num_threads = torch.get_num_threads()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.dist = dist
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def forward(self, input_A, input_B, mask_B, maskcent=0):
+        feed = dict(zip(INPUT_NAMES, _as_batch(input_A, input_B, mask_B, maskcent)))
+        outputs = [torch.from_numpy(out) for out in self.session.run(None, feed)]
+        return tuple(outputs) if self.dist else outputs[0]
+
+
+def load_exported(path, backend, dist, gpu_id=None):
+    path = exported_path(path, backend, dist)
+    print('loading %s model %s' % (backend, path))
+    if backend == 'torchscript':
+        return TorchScriptGenerator(path, dist, gpu_id=gpu_id)
+    elif backend == 'onnx':
+        return OnnxGenerator(path, dist)
+    raise ValueError('unknown backend [%s], expected one of %s' % (backend, ', '.join(BACKENDS)))
+
+
+def max_abs_diff(ref, out):
+    if not isinstance(ref, tuple):
+        ref, out = (ref, ), (out, )
+    return max(float(torch.max(torch.abs(r.cpu() - o.cpu()))) for r, o in zip(ref, out))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='export the pytorch colorization model')
+    parser.add_argument('--color_model', dest='color_model', type=str, default='./models/pytorch/caffemodel.pth')
+    parser.add_argument('--backends', dest='backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--Xd', dest='Xd', type=int, default=256, help='size of the example input used for tracing')
+    parser.add_argument('--opset', dest='opset', type=int, default=17)
+    return parser.parse_args()
+
+
+def main():
+    from models.pytorch.model import SIGGRAPHGenerator
+    args = parse_args()
+    state_dict = torch.load(args.color_model, map_location='cpu')
+    check_inputs = example_inputs(args.Xd, seed=1)
+    for dist in (False, True):
+        net = SIGGRAPHGenerator(dist=dist)
+        net.load_state_dict(state_dict)
+        net.eval()
+        with torch.no_grad():
+            ref = net.forward(*check_inputs)
+        for backend in args.backends:
+            path = exported_path(args.color_model, backend, dist)
+            if backend == 'torchscript':
+                export_torchscript(net, path, Xd=args.Xd)
+            else:
+                export_onnx(net, path, Xd=args.Xd, opset=args.opset)
+            out = load_exported(path, backend, dist).forward(*check_inputs)
+            print('%s dist=%s: max abs difference to eager %.2e' % (path, dist, max_abs_diff(ref, out)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class SIGGRAPHGenerator(nn.Module):
@@ -135,10 +136,15 @@ class SIGGRAPHGenerator(nn.Module):
         # input_A \in [-50,+50]
         # input_B \in [-110, +110]
         # mask_B \in [0, +1.0]
-
-        input_A = torch.Tensor(input_A)[None, :, :, :]
-        input_B = torch.Tensor(input_B)[None, :, :, :]
-        mask_B = torch.Tensor(mask_B)[None, :, :, :]
+        # inputs are either CxHxW for one image or NxCxHxW for a batch
+
+        input_A = torch.Tensor(input_A)
+        input_B = torch.Tensor(input_B)
+        mask_B = torch.Tensor(mask_B)
+        if input_A.dim() == 3:
+            input_A = input_A[None, :, :, :]
+            input_B = input_B[None, :, :, :]
+            mask_B = mask_B[None, :, :, :]
         mask_B = mask_B - maskcent
         
         # Move to same device as model
@@ -146,8 +152,59 @@ class SIGGRAPHGenerator(nn.Module):
         input_A = input_A.to(device)
         input_B = input_B.to(device)
         mask_B = mask_B.to(device)
-
-        conv1_2 = self.model1(torch.cat((input_A / 100., input_B / 110., mask_B), dim=1))
+        return self.forward_tensors(input_A, input_B, mask_B)
+
+    def forward_tensors(self, input_A, input_B, mask_B):
+        # NxCxHxW tensors on the model's device, mask already centered;
+        # this is the part that gets traced for export
+        return self.forward_input(torch.cat((input_A / 100., input_B / 110., mask_B), dim=1))
+
+    def conv1_l_response(self, input_L):
+        # the L channel's share of the first conv, bias included: Nx1xHxW L / 100 -> Nx64xHxW
+        conv = self.model1[0]
+        return F.conv2d(input_L, conv.weight[:, :1].contiguous(), conv.bias, conv.stride, conv.padding, conv.dilation)
+
+    def conv1_hint_response(self, hints):
+        # the share of the ab and mask channels, Nx3xHxW -> Nx64xHxW
+        conv = self.model1[0]
+        # a strided weight slice costs a reorder inside the conv, a contiguous copy is tiny
+        return F.conv2d(hints, conv.weight[:, 1:].contiguous(), None, conv.stride, conv.padding, conv.dilation)
+
+    def conv1_base_response(self, input_L, hint_const):
+        # conv1_l_response plus the response to hint planes holding the 3 values hint_const
+        # everywhere (the centered mask is -maskcent where there are no hints), padding included
+        const = input_L.new_empty((input_L.shape[0], 3) + tuple(input_L.shape[2:]))
+        const[:] = torch.as_tensor(hint_const, dtype=const.dtype, device=const.device).view(1, 3, 1, 1)
+        return self.conv1_l_response(input_L).add_(self.conv1_hint_response(const))
+
+    def conv1_sparse(self, conv1_base, ys, xs, hints):
+        # pre-ReLU output of the first conv for a single image whose hint planes differ from
+        # the constant of conv1_base only at the n pixels (ys, xs), by the nx3 values hints.
+        # Each of them adds its 3x3 kernel response around it, the rest is conv1_base
+        conv = self.model1[0]
+        out = conv1_base.clone(memory_format=torch.contiguous_format)
+        if len(ys) == 0:
+            return out
+        C, H, W = out.shape[1:]
+        k = conv.kernel_size[0]  # stride 1, dilation 1, same padding
+        pad = conv.padding[0]
+        # tap (i, j) of the pixel at (y, x) lands on the output at (y + pad - i, x + pad - j)
+        taps = torch.einsum('nc,ocij->nijo', hints, conv.weight[:, 1:])
+        shift = pad - torch.arange(k, device=ys.device)
+        out_y = ys[:, None, None] + shift[None, :, None]
+        out_x = xs[:, None, None] + shift[None, None, :]
+        valid = (out_y >= 0) & (out_y < H) & (out_x >= 0) & (out_x < W)
+        out.view(C, H * W).index_add_(1, (out_y * W + out_x)[valid], taps[valid].t())
+        return out
+
+    def forward_input(self, input):
+        # Nx4xHxW: L / 100, ab / 110 and the centered mask, as ColorizeImageTorch fills it in place.
+        # The dense path; with few hints ColorizeImageTorch uses conv1_sparse instead of model1[0]
+        return self.forward_conv1(self.model1[0](input))
+
+    def forward_conv1(self, conv1_1):
+        # the rest of the net from the pre-ReLU output of the first conv
+        conv1_2 = self.model1[1:](conv1_1)
         conv2_2 = self.model2(conv1_2[:, :, ::2, ::2])
         conv3_3 = self.model3(conv2_2[:, :, ::2, ::2])
         conv4_3 = self.model4(conv3_3[:, :, ::2, ::2])
@@ -165,7 +222,7 @@ class SIGGRAPHGenerator(nn.Module):
             conv9_3 = self.model9(conv9_up)
             conv10_up = self.model10up(conv9_3) + self.model1short10(conv1_2)
             conv10_2 = self.model10(conv10_up)
-            out_reg = self.model_out(conv10_2) * 110
+            out_reg = self.model_out(conv10_2)
 
             return (out_reg * 110, out_cl)
         else:
@@ -0,0 +1,77 @@
+''' An inference-only copy of SIGGRAPHGenerator, what prep_net(optimize=True) runs.
+
+The copy has its BatchNorm layers folded into the convs that read them
+(quantize.fold_bn), uses the channels_last memory format and runs under
+torch.inference_mode. With compile=True its forward also goes through
+torch.compile, which fuses the ReLU/LeakyReLU/Tanh and offset adds into the
+surrounding kernels. check_equivalence compares it against the eager model.
+'''
+from __future__ import print_function
+import copy
+import torch
+
+from models.pytorch.quantize import fold_bn
+
+TOLERANCE = 1e-2  # on the ab output, which is in [-110, 110]
+
+
+class InferenceGenerator(object):
+    ''' Same forward signature and outputs as SIGGRAPHGenerator '''
+    def __init__(self, net, channels_last=True, compile=False):
+        self.dist = net.dist
+        self.net = fold_bn(copy.deepcopy(net)).eval()
+        for param in self.net.parameters():
+            param.requires_grad_(False)
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.net.to(memory_format=self.memory_format)
+        self.device = next(self.net.parameters()).device
+        # the first conv stays eager, it is cheap and ColorizeImageTorch may run it sparsely
+        self.compiled = torch.compile(self.net.forward_conv1) if compile else None
+        self.sizes = set()  # input sizes the offset maps of the folded convs exist for
+
+    def forward(self, input_A, input_B, mask_B, maskcent=0):
+        inputs = []
+        for a in (input_A, input_B, mask_B):
+            a = torch.as_tensor(a, dtype=torch.float32)
+            inputs.append(a[None] if a.dim() == 3 else a)
+        with torch.inference_mode():
+            return self.forward_input(torch.cat((inputs[0] / 100., inputs[1] / 110., inputs[2] - maskcent), dim=1))
+
+    def _prep(self, input):
+        return input.to(self.device).contiguous(memory_format=self.memory_format)
+
+    def forward_input(self, input):
+        with torch.inference_mode():
+            return self.forward_conv1(self.net.model1[0](self._prep(input)))
+
+    def forward_conv1(self, conv1_1):
+        with torch.inference_mode():
+            conv1_1 = self._prep(conv1_1)
+            size = tuple(conv1_1.shape[2:])
+            if self.compiled is None or size not in self.sizes:
+                # an eager pass fills the offset maps for this size, so the
+                # compiled graph finds them instead of recompiling after adding them
+                self.sizes.add(size)
+                return self.net.forward_conv1(conv1_1)
+            return self.compiled(conv1_1)
+
+    def conv1_base_response(self, input_L, hint_const):
+        with torch.inference_mode():
+            return self.net.conv1_base_response(self._prep(input_L), hint_const)
+
+    def conv1_sparse(self, conv1_base, ys, xs, hints):
+        with torch.inference_mode():
+            return self.net.conv1_sparse(conv1_base, ys.to(self.device), xs.to(self.device), hints.to(self.device))
+
+
+def check_equivalence(ref_net, opt_net, Xd=64, maskcent=0):
+    # largest difference of the outputs on random inputs
+    from models.pytorch.export import example_inputs, max_abs_diff
+    inputs = [a.numpy() for a in example_inputs(Xd, seed=2)]
+    with torch.no_grad():
+        ref = ref_net.forward(*inputs, maskcent=maskcent)
+    out = opt_net.forward(*inputs, maskcent=maskcent)
+    if isinstance(ref, tuple):
+        # the distribution is in [0, 1], scale it like the ab output
+        return max(max_abs_diff(ref[0], out[0]), 110 * max_abs_diff(ref[1], out[1]))
+    return max_abs_diff(ref, out)
@@ -0,0 +1,269 @@
+''' Int8 post-training quantization of SIGGRAPHGenerator for CPU inference.
+
+    python -m models.pytorch.quantize --color_model ./models/pytorch/caffemodel.pth \
+        --calib_dir <grayscale images> --val_dir <color images>
+
+folds the BatchNorm layers away, calibrates activation ranges on calib_dir,
+converts the convolutions to int8 and writes caffemodel_int8.pth, which
+ColorizeImageTorch.prep_net(quantized=True) loads. It then reports the latency
+and the PSNR (get_result_PSNR) of the float and the int8 model on val_dir, and
+the PSNR of the int8 result against the float one.
+
+Every BatchNorm here sits after a ReLU, so it cannot go into the conv before
+it. Its scale s is folded into the input channels of the layers reading its
+output instead, and its shift t becomes an offset: the response of the
+original layer to the constant map t. Away from the borders that is a constant
+per output channel, which goes into the bias; at the borders zero padding makes
+it vary, so a map for the border pixels is computed once per input size from a
+1 channel kernel and cached. Transposed convs add their whole offset map.
+Folding is exact in float (fold_bn, which the optimize=True path of prep_net
+uses as well); prepare_generator and convert_generator then run each folded
+conv in int8 between float activations.
+'''
+from __future__ import print_function
+import argparse
+import os
+import time
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.quantization as tq
+
+from models.pytorch.model import SIGGRAPHGenerator
+
+# each batch norm (last layer of a block) and the blocks whose first layer reads its output
+BN_CONSUMERS = (('model1', ('model2', 'model1short10')),
+                ('model2', ('model3', 'model2short9')),
+                ('model3', ('model4', 'model3short8')),
+                ('model4', ('model5', )),
+                ('model5', ('model6', )),
+                ('model6', ('model7', )),
+                ('model7', ('model8up', )),
+                ('model8', ('model_class', 'model9up')),
+                ('model9', ('model10up', )))
+# kept in float: the 4 channel input conv is cheap and the output conv sets the colors
+FLOAT_LAYERS = ('model1.0', 'model_out.0')
+
+
+class FoldedConv(nn.Module):
+    ''' A conv or transposed conv with an optional batch norm shift folded in as
+    an offset map, and quant/dequant stubs that make it run in int8 once converted '''
+    def __init__(self, layer):
+        super(FoldedConv, self).__init__()
+        self.quant = tq.QuantStub()
+        self.layer = layer
+        self.dequant = tq.DeQuantStub()
+        self.transposed = isinstance(layer, nn.ConvTranspose2d)
+        self.geometry = dict(stride=layer.stride, padding=layer.padding, dilation=layer.dilation)
+        if self.transposed:
+            self.geometry['output_padding'] = layer.output_padding
+        # a same size conv only sees the padding within this many pixels of the border
+        same = not self.transposed and layer.stride == (1, 1) and \
+            all(p == d * (k - 1) // 2 for p, d, k in zip(layer.padding, layer.dilation, layer.kernel_size))
+        self.border = layer.padding[0] if same and layer.padding[0] == layer.padding[1] else None
+        self.register_buffer('offset_kernel', None)
+        self.offsets = {}  # (H, W) of the input -> offset map
+
+    def fold(self, scale, shift):
+        # the layer reads s * x + t; scale its input channels by s and keep t as an offset
+        weight = self.layer.weight.data
+        if self.transposed:  # in x out x k x k
+            kernel = torch.einsum('cokl,c->okl', weight, shift)[np.newaxis]
+            self.layer.weight.data = weight * scale[:, None, None, None]
+        else:  # out x in x k x k
+            kernel = torch.einsum('ockl,c->okl', weight, shift)[:, np.newaxis]
+            self.layer.weight.data = weight * scale[None, :, None, None]
+            if self.border is not None:
+                # away from the borders every tap sees t, that part is a bias
+                self.layer.bias.data = self.layer.bias.data + kernel.sum((1, 2, 3))
+        self.offset_kernel = kernel.contiguous()
+        self.offsets = {}
+
+    def offset(self, size):
+        if size not in self.offsets:
+            ones = self.offset_kernel.new_ones((1, 1) + size)
+            if self.transposed:
+                self.offsets[size] = F.conv_transpose2d(ones, self.offset_kernel, **self.geometry)
+            else:
+                self.offsets[size] = F.conv2d(ones, self.offset_kernel, **self.geometry)
+                if self.border is not None:  # what the bias does not cover, 0 inside the border
+                    self.offsets[size] -= self.offset_kernel.sum((1, 2, 3))[:, None, None]
+        return self.offsets[size]
+
+    def forward(self, x):
+        out = self.dequant(self.layer(self.quant(x)))
+        if self.offset_kernel is None or self.border == 0:
+            return out
+        size = tuple(x.shape[2:])
+        offset = self.offset(size)
+        r = self.border
+        if r is None or 2 * r >= min(size):
+            return out + offset
+        out[:, :, :r] += offset[:, :, :r]
+        out[:, :, -r:] += offset[:, :, -r:]
+        out[:, :, r:-r, :r] += offset[:, :, r:-r, :r]
+        out[:, :, r:-r, -r:] += offset[:, :, r:-r, -r:]
+        return out
+
+
+def _set_layer(net, name, module):
+    block, index = name.split('.')
+    getattr(net, block)[int(index)] = module
+
+
+def fold_bn(net):
+    ''' Wrap every conv of net in a FoldedConv and fold the batch norms into
+    them, in place. The result computes the same function as before in float. '''
+    net.eval()
+    for name, module in list(net.named_modules()):
+        if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d)) and name not in FLOAT_LAYERS:
+            _set_layer(net, name, FoldedConv(module))
+    for bn_block, consumers in BN_CONSUMERS:
+        bn = getattr(net, bn_block)[-1]
+        scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias.data - bn.running_mean * scale
+        for consumer in consumers:
+            getattr(net, consumer)[0].fold(scale, shift)
+        getattr(net, bn_block)[-1] = nn.Identity()
+    return net
+
+
+def _qconfigs(net):
+    conv_qconfig = tq.get_default_qconfig('x86')
+    # int8 transposed convs only take per tensor weights
+    transposed_qconfig = tq.QConfig(activation=conv_qconfig.activation, weight=tq.default_weight_observer)
+    for module in net.modules():
+        if isinstance(module, FoldedConv):
+            module.qconfig = transposed_qconfig if module.transposed else conv_qconfig
+
+
+def prepare_generator(net):
+    # fold and insert observers; run calibration data through the result, then convert_generator
+    fold_bn(net)
+    _qconfigs(net)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return tq.prepare(net, inplace=True)
+
+
+def convert_generator(net):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        net = tq.convert(net, inplace=True)
+    for module in net.modules():
+        if isinstance(module, FoldedConv):
+            module.offsets = {}
+    return net.eval()
+
+
+def quantized_path(path):
+    # model.pth -> model_int8.pth
+    root, ext = os.path.splitext(path)
+    return root + '_int8' + ext
+
+
+def load_quantized(path, dist=False):
+    ''' An int8 generator from a checkpoint written by this module. The layers
+    are rebuilt the same way and then take the saved weights and ranges. '''
+    net = prepare_generator(SIGGRAPHGenerator(dist=dist))
+    with torch.no_grad():
+        net.forward(np.zeros((1, 1, 16, 16)), np.zeros((1, 2, 16, 16)), np.zeros((1, 1, 16, 16)))
+    net = convert_generator(net)
+    net.load_state_dict(torch.load(path, map_location='cpu'))
+    return net
+
+
+def random_hints(rng, Xd, n):
+    # square hints of random colors, for grayscale images that have no colors of their own
+    input_ab = np.zeros((2, Xd, Xd))
+    input_mask = np.zeros((1, Xd, Xd))
+    for y, x in rng.randint(0, Xd - 4, (n, 2)):
+        input_ab[:, y:y + 4, x:x + 4] = rng.uniform(-80, 80, (2, 1, 1))
+        input_mask[:, y:y + 4, x:x + 4] = 1
+    return input_ab, input_mask
+
+
+def gt_hints(rng, img_ab, n):
+    # hints revealing the true colors of n random 3x3 patches
+    Xd = img_ab.shape[1]
+    input_ab = np.zeros((2, Xd, Xd))
+    input_mask = np.zeros((1, Xd, Xd))
+    for y, x in rng.randint(0, Xd - 3, (n, 2)):
+        input_ab[:, y:y + 3, x:x + 3] = img_ab[:, y:y + 3, x:x + 3]
+        input_mask[:, y:y + 3, x:x + 3] = 1
+    return input_ab, input_mask
+
+
+def list_images(img_dir):
+    exts = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+    return [os.path.join(img_dir, name) for name in sorted(os.listdir(img_dir)) if name.lower().endswith(exts)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='int8 post-training quantization of the pytorch colorization model')
+    parser.add_argument('--color_model', dest='color_model', type=str, default='./models/pytorch/caffemodel.pth')
+    parser.add_argument('--calib_dir', dest='calib_dir', type=str, required=True, help='images used to calibrate activation ranges')
+    parser.add_argument('--val_dir', dest='val_dir', type=str, default=None, help='color images to report PSNR and latency on')
+    parser.add_argument('--out', dest='out', type=str, default=None, help='defaults to <color_model>_int8.pth')
+    parser.add_argument('--load_size', dest='load_size', type=int, default=256)
+    parser.add_argument('--hints', dest='hints', type=int, default=10, help='hint patches per calibration and validation image')
+    parser.add_argument('--pytorch_maskcent', dest='pytorch_maskcent', action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    from data import colorize_image as CI
+    args = parse_args()
+    out_path = args.out or quantized_path(args.color_model)
+
+    model = CI.ColorizeImageTorchDist(Xd=args.load_size, maskcent=args.pytorch_maskcent)
+    model.prep_net(gpu_id=-1, path=args.color_model)
+    float_net = model.net
+    net = SIGGRAPHGenerator(dist=True)
+    net.load_state_dict(float_net.state_dict())
+    model.net = prepare_generator(net)
+    # the observers see the trunk with and without hints
+    rng = np.random.RandomState(0)
+    calib_files = list_images(args.calib_dir)
+    for n, img_file in enumerate(calib_files):
+        model.load_image(img_file)
+        with torch.no_grad():
+            model.net_forward(np.zeros((2, args.load_size, args.load_size)), np.zeros((1, args.load_size, args.load_size)), return_rgb=False)
+            model.net_forward(*random_hints(rng, args.load_size, args.hints), return_rgb=False)
+        print('calibrated on %d/%d images' % (n + 1, len(calib_files)), end='\r')
+    print('')
+    quant_net = convert_generator(model.net)
+    torch.save(quant_net.state_dict(), out_path)
+    print('saved %s (%.1f MB, float checkpoint %.1f MB)' % (out_path, os.path.getsize(out_path) / 2.**20,
+                                                           os.path.getsize(args.color_model) / 2.**20))
+    if args.val_dir is None:
+        return
+
+    results = {}
+    float_rgbs = []
+    for name, net in (('float', float_net), ('int8', load_quantized(out_path, dist=True))):
+        model.net = net
+        rng = np.random.RandomState(1)
+        psnrs, agree, times = [], [], []
+        for n, img_file in enumerate(list_images(args.val_dir)):
+            model.load_image(img_file)
+            hints = gt_hints(rng, model.img_ab, args.hints)
+            t = time.time()
+            model.net_forward(*hints, return_rgb=False)
+            times.append(time.time() - t)
+            psnrs.append(model.get_result_PSNR())
+            if name == 'float':
+                float_rgbs.append(model.get_img_forward())
+            else:  # how closely int8 reproduces the float colorization, meaningful for any weights
+                mse = np.mean((1. * model.get_img_forward() - float_rgbs[n])**2)
+                agree.append(20 * np.log10(255. / np.sqrt(max(mse, 1e-10))))
+        results[name] = (np.mean(psnrs), 1000 * np.median(times[1:] or times))
+        print('%-6s PSNR %6.2f dB   %7.1f ms/forward' % ((name, ) + results[name]))
+    print('int8: %.2fx faster, PSNR %+.2f dB, %.2f dB against the float result' %
+          (results['float'][1] / results['int8'][1], results['int8'][0] - results['float'][0], np.mean(agree)))
+
+
+if __name__ == '__main__':
+    main()
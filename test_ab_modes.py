@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Deterministic color suggestions from a binned ab distribution
+import numpy as np
+import torch
+from data import colorize_image as CI
+from models.pytorch.model import SIGGRAPHGenerator
+
+pts_grid = np.array(np.meshgrid(np.arange(-110, 120, 10), np.arange(-110, 120, 10))).reshape((2, 529)).T
+
+
+def mixture(centers, weights, sigma=8.):
+    probs = np.zeros(len(pts_grid))
+    for center, weight in zip(centers, weights):
+        g = np.exp(-np.sum((pts_grid - center)**2, axis=1) / (2 * sigma**2))
+        probs += weight * g / g.sum()
+    return probs + 1e-8
+
+
+def test_finds_separated_modes():
+    centers = np.array([[-60, 40], [50, 50], [20, -70]])
+    probs = mixture(centers, [0.5, 0.3, 0.2])
+    ab, conf = CI.ab_modes(pts_grid, probs, K=3)
+    assert np.abs(ab - centers).max() < 2
+    assert np.abs(conf - [0.5, 0.3, 0.2]).max() < 0.01
+
+
+def test_deterministic_and_sorted():
+    probs = np.random.RandomState(0).rand(len(pts_grid))
+    ab0, conf0 = CI.ab_modes(pts_grid, probs, K=9)
+    ab1, conf1 = CI.ab_modes(pts_grid, probs, K=9)
+    assert np.array_equal(ab0, ab1) and np.array_equal(conf0, conf1)
+    assert np.all(np.diff(conf0) <= 0)
+    assert abs(conf0.sum() - 1) < 1e-9
+
+
+def test_more_colors_than_modes():
+    probs = np.zeros(len(pts_grid))
+    probs[[10, 200]] = [0.7, 0.3]
+    ab, conf = CI.ab_modes(pts_grid, probs, K=5)
+    assert ab.shape == (5, 2)
+    assert np.array_equal(ab[:2], pts_grid[[10, 200]])
+    assert np.allclose(conf, [0.7, 0.3, 0, 0, 0])
+
+
+def test_suggestion_map_lookup():
+    rng = np.random.RandomState(1)
+    dist_ab = rng.rand(len(pts_grid), 16, 16)**4
+    sugg = CI.SuggestionMap(K=5, block=4, chunk=7)
+    sugg.start(pts_grid, dist_ab, 'a')
+    sugg.wait()
+    for h, w in [(0, 0), (5, 9), (15, 15)]:
+        ab, conf = sugg.lookup(h, w, 5, 'a')
+        ref_ab, ref_conf = CI.ab_modes(pts_grid, dist_ab[:, h // 4 * 4, w // 4 * 4], K=5)
+        assert np.abs(ab - ref_ab).max() < 0.1
+        assert np.abs(conf - ref_conf).max() < 1e-3
+    # only answers for the distribution it was computed from
+    assert sugg.lookup(0, 0, 5, 'b') is None
+    assert sugg.lookup(0, 0, 3, 'a') is None
+
+
+def test_suggestion_map_matches_synchronous_reccs():
+    # the engine's background map against get_ab_reccs without one, on the net's distribution
+    torch.manual_seed(0)
+    rng = np.random.RandomState(2)
+    model = CI.ColorizeImageTorchDist(Xd=64)
+    model.net = SIGGRAPHGenerator(dist=True).eval()
+    model.net_set = True
+    model.set_image(rng.randint(0, 256, (64, 64, 3)).astype(np.uint8))
+    sugg = CI.SuggestionMap(K=9, block=4)
+    for it in range(2):
+        input_ab = np.zeros((2, 64, 64))
+        input_mask = np.zeros((1, 64, 64))
+        input_ab[:, 8 * it:8 * it + 4, 20:24] = 40.
+        input_mask[:, 8 * it:8 * it + 4, 20:24] = 1
+        model.suggest_map = sugg
+        model.net_forward(input_ab, input_mask, return_rgb=False)
+        sugg.wait()
+        for h, w in [(0, 0), (9, 22), (33, 50), (63, 63)]:
+            model.suggest_map = sugg
+            assert sugg.lookup(h, w, 9, model.dist_key) is not None
+            ab, conf = model.get_ab_reccs(h, w, K=9, return_conf=True)
+            model.suggest_map = None
+            ref_ab, ref_conf = model.get_ab_reccs(h, w, K=9, return_conf=True)
+            assert np.abs(ab - ref_ab).max() < 0.1
+            assert np.abs(conf - ref_conf).max() < 1e-3
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# Headless batch colorization: hint files are checked and fitted per image
+import os
+import tempfile
+import numpy as np
+import cv2
+import torch
+from data import batch_colorize
+from data import colorize_image as CI
+from models.pytorch.model import SIGGRAPHGenerator
+
+torch.manual_seed(0)
+rng = np.random.RandomState(0)
+
+
+def make_checkpoint(root):
+    path = os.path.join(root, 'model.pth')
+    torch.save(SIGGRAPHGenerator().state_dict(), path)
+    return path
+
+
+def save_hints(root, name, input_ab, input_mask):
+    os.makedirs(os.path.join(root, name))
+    np.save(os.path.join(root, name, 'im_ab.npy'), input_ab)
+    np.save(os.path.join(root, name, 'im_mask.npy'), input_mask)
+
+
+def square_hints(size, y, x, ab):
+    input_ab = np.zeros((2, size, size))
+    input_mask = np.zeros((1, size, size))
+    input_ab[:, y:y + 4, x:x + 4] = np.array(ab)[:, None, None]
+    input_mask[:, y:y + 4, x:x + 4] = 1
+    return input_ab, input_mask
+
+
+def test_resize_hints():
+    input_ab, input_mask = square_hints(128, 40, 80, (30., -20.))
+    ab, mask = CI.resize_hints(input_ab, input_mask, (64, 64))
+    assert ab.shape == (2, 64, 64) and mask.shape == (1, 64, 64)
+    assert set(np.unique(mask)) == {0., 1.}
+    assert np.array_equal(np.argwhere(mask[0])[[0, -1]], [[20, 40], [21, 41]])
+    assert np.allclose(ab[:, 20:22, 40:42], np.array([30., -20.])[:, None, None])
+    # already the right size: returned as is
+    assert CI.resize_hints(ab, mask, (64, 64))[0] is ab
+    for bad in ((np.zeros((3, 64, 64)), mask), (ab, np.zeros((1, 32, 64))), (ab[0], mask)):
+        try:
+            CI.resize_hints(bad[0], bad[1], (64, 64))
+            assert False
+        except ValueError:
+            pass
+
+
+def test_find_hints_matches_gui_folders():
+    root = tempfile.mkdtemp()
+    img_path = os.path.join(root, 'park.jpg')
+    save_hints(root, 'park_2_with_dist_991231_235959', *square_hints(64, 0, 0, (1., 1.)))  # park_2.jpg's
+    save_hints(root, 'park_with_dist_backup', *square_hints(64, 0, 0, (2., 2.)))
+    assert batch_colorize.find_hints(img_path) is None
+    save_hints(root, 'park_with_dist_240101_120000', *square_hints(64, 0, 0, (3., 3.)))
+    save_hints(root, 'park_with_dist_240315_080000', *square_hints(64, 0, 0, (4., 4.)))
+    save_hints(root, 'park_with_dist_231231_235959', *square_hints(64, 0, 0, (5., 5.)))
+    assert batch_colorize.find_hints(img_path)[0][0, 0, 0] == 4.
+    assert batch_colorize.find_hints(img_path, method='other') is None
+    # an explicit hints_dir comes first
+    save_hints(os.path.join(root, 'hints'), 'park', *square_hints(64, 0, 0, (6., 6.)))
+    assert batch_colorize.find_hints(img_path, os.path.join(root, 'hints'))[0][0, 0, 0] == 6.
+
+
+def test_bad_hint_file_fails_only_its_image():
+    root = tempfile.mkdtemp()
+    img_dir = os.path.join(root, 'imgs')
+    hints_dir = os.path.join(root, 'hints')
+    out_dir = os.path.join(root, 'out')
+    os.makedirs(img_dir)
+    for name in ('a', 'b', 'c'):
+        cv2.imwrite(os.path.join(img_dir, name + '.png'), rng.randint(0, 256, (48, 80, 3)).astype(np.uint8))
+    save_hints(hints_dir, 'a', *square_hints(64, 10, 10, (40., 40.)))
+    save_hints(hints_dir, 'b', *square_hints(128, 20, 20, (-40., 40.)))  # saved with another --load_size
+    save_hints(hints_dir, 'c', np.zeros((2, 64, 64)), np.zeros((1, 32, 32)))  # planes that do not match
+
+    opts = batch_colorize.parse_args([img_dir, '--out_dir', out_dir, '--hints_dir', hints_dir, '--color_model', make_checkpoint(root),
+                                      '--workers', '0', '--batch_size', '3', '--load_size', '64', '--no_fullres'])
+    os.makedirs(out_dir)
+    batch_colorize.init_worker(opts)
+    done, failed = batch_colorize.colorize_chunk([(os.path.join(img_dir, name + '.png'), name) for name in ('a', 'b', 'c')])
+    assert [os.path.basename(p) for p in done] == ['a.png', 'b.png']
+    assert [os.path.basename(p) for p, err in failed] == ['c.png'] and 'bad hints' in failed[0][1]
+    assert batch_colorize.run(opts) == 1
+    assert sorted(os.listdir(out_dir)) == ['a_64.png', 'b_64.png', 'progress.txt']
+
+
+def test_output_names():
+    names = batch_colorize.output_names(['x/a/img.jpg', 'x/b/img.jpg', 'x/img.png', 'x/img.bmp', 'x/c/other.png',
+                                         'y/a_img_jpg.png', 'x/a/img.jpg'])
+    assert names == ['a_img_jpg', 'b_img_jpg', 'img_png', 'img_bmp', 'other', 'a_img_jpg_2', 'a_img_jpg']
+
+
+def test_duplicate_names_and_resume():
+    root = tempfile.mkdtemp()
+    img_dir = os.path.join(root, 'imgs')
+    out_dir = os.path.join(root, 'out')
+    for sub_dir in ('a', 'b'):
+        os.makedirs(os.path.join(img_dir, sub_dir))
+        cv2.imwrite(os.path.join(img_dir, sub_dir, 'img.png'), rng.randint(0, 256, (32, 40, 3)).astype(np.uint8))
+    for ext in ('.png', '.bmp'):
+        cv2.imwrite(os.path.join(img_dir, 'img' + ext), rng.randint(0, 256, (32, 40, 3)).astype(np.uint8))
+    # a folder where one result should go makes its write fail
+    os.makedirs(os.path.join(out_dir, 'img_bmp.png'))
+    model_path = make_checkpoint(root)
+
+    def run(inputs):
+        return batch_colorize.run(batch_colorize.parse_args(inputs + ['--out_dir', out_dir, '--color_model', model_path,
+                                                                      '--workers', '0', '--batch_size', '2', '--load_size', '32']))
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        assert run(['imgs/a', 'imgs/b', 'imgs', 'imgs/a/img.png']) == 1
+    finally:
+        os.chdir(cwd)
+    assert sorted(os.listdir(out_dir)) == ['a_img_png.png', 'a_img_png_32.png', 'b_img_png.png', 'b_img_png_32.png',
+                                           'img_bmp.png', 'img_bmp_32.png', 'img_png.png', 'img_png_32.png', 'progress.txt']
+    with open(os.path.join(out_dir, 'progress.txt')) as f:
+        finished = f.read().split()
+    assert sorted(finished) == [os.path.join(img_dir, name) for name in ('a/img.png', 'b/img.png', 'img.png')]
+    # the same job with absolute paths only redoes the image that failed to save
+    os.rmdir(os.path.join(out_dir, 'img_bmp.png'))
+    assert run([os.path.join(img_dir, 'a'), os.path.join(img_dir, 'b'), img_dir]) == 0
+    with open(os.path.join(out_dir, 'progress.txt')) as f:
+        assert f.read().split() == finished + [os.path.join(img_dir, 'img.bmp')]
+    assert os.path.isfile(os.path.join(out_dir, 'img_bmp.png'))
+
+
+def test_batch_matches_single_forward():
+    root = tempfile.mkdtemp()
+    path = make_checkpoint(root)
+    imgs = [rng.randint(0, 256, shape).astype(np.uint8) for shape in ((48, 80, 3), (64, 64, 3), (100, 30, 3))]
+    img_path = os.path.join(root, 'c.png')
+    cv2.imwrite(img_path, imgs[2][:, :, ::-1])
+    hints = [square_hints(64, 10, 20, (50., -20.)), None, square_hints(64, 40, 8, (-10., 60.))]
+    for engine in (CI.ColorizeImageTorch, CI.ColorizeImageTorchDist):
+        model = engine(Xd=64, maskcent=True)
+        model.prep_net(path=path)
+        model.cache.max_bytes = 0
+        # the last image by path, and a second batch of one
+        out_rgbs, out_abs = model.net_forward_batch(imgs[:2] + [img_path], hints, batch_size=2)
+        for im, hint, out_rgb, out_ab in zip(imgs, hints, out_rgbs, out_abs):
+            model.set_image(im)
+            if hint is None:
+                hint = (np.zeros((2, 64, 64)), np.zeros((1, 64, 64)))
+            single_rgb = model.net_forward(*hint)
+            assert out_ab.shape == (2, 64, 64)
+            assert np.abs(out_ab - model.output_ab).max() < 1e-3
+            assert np.abs(out_rgb.astype(int) - single_rgb).max() <= 1
+
+
+def test_keep_aspect_batch_matches_single_forward():
+    root = tempfile.mkdtemp()
+    model = CI.ColorizeImageTorch(Xd=64)
+    model.prep_net(path=make_checkpoint(root))
+    model.keep_aspect = True
+    model.cache.max_bytes = 0
+    imgs = [rng.randint(0, 256, shape).astype(np.uint8) for shape in ((40, 120, 3), (64, 64, 3), (40, 120, 3), (90, 30, 3))]
+    # hints as a --keep_aspect GUI session saves them, and one from a square session
+    hints = [None] * 4
+    hints[0] = (np.full((2, 40, 112), 20.), np.ones((1, 40, 112)))
+    hints[3] = square_hints(64, 8, 8, (-30., 30.))
+    out_rgbs, out_abs = model.net_forward_batch(imgs, hints, batch_size=3)
+    assert [ab.shape for ab in out_abs] == [(2, 40, 112), (2, 64, 64), (2, 40, 112), (2, 112, 40)]
+    for im, hint, out_rgb, out_ab in zip(imgs, hints, out_rgbs, out_abs):
+        model.set_image(im)
+        shape = model.load_shape(*im.shape[:2])
+        if hint is None:
+            hint = (np.zeros((2,) + shape), np.zeros((1,) + shape))
+        single_rgb = model.net_forward(*CI.resize_hints(hint[0], hint[1], shape))
+        assert np.abs(out_ab - model.output_ab).max() < 1e-3
+        assert np.abs(out_rgb.astype(int) - single_rgb).max() <= 1
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Parity of data/color_space.py against skimage.color
+import warnings
+import numpy as np
+from skimage import color
+from data import color_space
+from data import colorize_image as CI
+
+warnings.filterwarnings('ignore')
+rng = np.random.RandomState(0)
+
+
+def random_lab(h, w):
+    return np.concatenate((rng.uniform(0, 100, (h, w, 1)), rng.uniform(-110, 110, (h, w, 2))), axis=2)
+
+
+def test_rgb2lab_uint8():
+    im = rng.randint(0, 256, (97, 131, 3)).astype(np.uint8)
+    assert np.abs(color_space.rgb2lab(im) - color.rgb2lab(im)).max() < 1e-3
+
+
+def test_rgb2lab_float():
+    im = rng.rand(64, 64, 3)
+    assert np.abs(color_space.rgb2lab(im) - color.rgb2lab(im)).max() < 1e-3
+
+
+def test_rgb2lab_all_uint8_colors():
+    # every code value of each channel, including the linear segment near black
+    im = np.stack(np.meshgrid(np.arange(256), np.arange(256), [0, 1, 128, 255]), axis=-1).reshape((256, -1, 3)).astype(np.uint8)
+    assert np.abs(color_space.rgb2lab(im) - color.rgb2lab(im)).max() < 1e-3
+
+
+def test_lab2rgb():
+    lab = random_lab(97, 131)
+    ref = np.clip(color.lab2rgb(lab), 0, 1)
+    assert np.abs(color_space.lab2rgb(lab) - ref).max() < 1e-4
+
+
+def test_lab2rgb_uint8():
+    lab = random_lab(97, 131)
+    ref = (np.clip(color.lab2rgb(lab), 0, 1) * 255).astype('uint8')
+    diff = np.abs(color_space.lab2rgb_uint8(lab).astype(int) - ref)
+    # float32 rounding can only move a value across a truncation boundary
+    assert diff.max() <= 1
+    assert np.mean(diff > 0) < 1e-3
+
+
+def test_out_parameter():
+    im = rng.randint(0, 256, (32, 48, 3)).astype(np.uint8)
+    out = np.empty((32, 48, 3), np.float32)
+    assert color_space.rgb2lab(im, out=out) is out
+    out_rgb = np.empty((32, 48, 3), np.uint8)
+    assert color_space.lab2rgb_uint8(out, out=out_rgb) is out_rgb
+    assert np.abs(out_rgb.astype(int) - im).max() <= 1
+
+
+def test_planes_match_transpose_helpers():
+    lab = random_lab(40, 56).transpose((2, 0, 1))
+    ref = (np.clip(color.lab2rgb(lab.transpose((1, 2, 0))), 0, 1) * 255).astype('uint8')
+    assert np.abs(CI.lab2rgb_transpose(lab[[0], :, :], lab[1:, :, :]).astype(int) - ref).max() <= 1
+    im = rng.randint(0, 256, (40, 56, 3)).astype(np.uint8)
+    assert np.abs(CI.rgb2lab_transpose(im) - color.rgb2lab(im).transpose((2, 0, 1))).max() < 1e-3
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
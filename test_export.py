@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Exported TorchScript and ONNX graphs against the eager SIGGRAPHGenerator
+import os
+import tempfile
+import numpy as np
+import pytest
+import torch
+from data import colorize_image as CI
+from models.pytorch import export
+from models.pytorch.model import SIGGRAPHGenerator
+
+tmp_dir = tempfile.mkdtemp()
+torch.manual_seed(0)
+state_dict = SIGGRAPHGenerator(dist=True).state_dict()
+model_path = os.path.join(tmp_dir, 'model.pth')
+torch.save(state_dict, model_path)
+
+
+def eager_net(dist):
+    net = SIGGRAPHGenerator(dist=dist)
+    net.load_state_dict(state_dict)
+    return net.eval()
+
+
+def check_parity(backend, dist):
+    net = eager_net(dist)
+    path = export.exported_path(model_path, backend, dist)
+    if backend == 'torchscript':
+        export.export_torchscript(net, path, Xd=64)
+    else:
+        export.export_onnx(net, path, Xd=64)
+    exported = export.load_exported(path, backend, dist)
+    # the traced size, another size, a batch and a centered mask
+    for Xd, N, maskcent in [(64, 1, 0), (96, 1, .5), (64, 3, 0)]:
+        input_A, input_B, mask_B = [a.numpy() for a in export.example_inputs(Xd, N=N, seed=Xd + N)]
+        with torch.no_grad():
+            ref = net.forward(input_A, input_B, mask_B, maskcent)
+        out = exported.forward(input_A, input_B, mask_B, maskcent)
+        if dist:
+            assert out[0].shape == ref[0].shape and out[1].shape == ref[1].shape
+        else:
+            assert out.shape == ref.shape
+        assert export.max_abs_diff(ref, out) < 1e-3
+
+
+def test_torchscript_parity():
+    check_parity('torchscript', False)
+    check_parity('torchscript', True)
+
+
+def test_onnx_parity():
+    pytest.importorskip('onnxruntime')
+    check_parity('onnx', False)
+    check_parity('onnx', True)
+
+
+def test_engine_backends_agree():
+    pytest.importorskip('onnxruntime')
+    img = np.random.RandomState(0).randint(0, 256, (80, 120, 3)).astype(np.uint8)
+    input_ab = np.zeros((2, 64, 64))
+    input_mask = np.zeros((1, 64, 64))
+    input_ab[:, 20:24, 30:34] = [[[40.]], [[-60.]]]
+    input_mask[:, 20:24, 30:34] = 1
+    export.export_torchscript(eager_net(True), export.exported_path(model_path, 'torchscript', True), Xd=64)
+    export.export_onnx(eager_net(True), export.exported_path(model_path, 'onnx', True), Xd=64)
+    outputs = {}
+    for backend in ('eager', 'torchscript', 'onnx'):
+        # prep_net maps model.pth to the exported model_dist.ts / model_dist.onnx
+        model = CI.ColorizeImageTorchDist(Xd=64)
+        model.prep_net(path=model_path, backend=backend)
+        model.set_image(img)
+        model.net_forward(input_ab, input_mask, return_rgb=False)
+        outputs[backend] = (model.output_ab, model.dist_ab)
+    for backend in ('torchscript', 'onnx'):
+        assert np.abs(outputs[backend][0] - outputs['eager'][0]).max() < 1e-3
+        assert np.abs(outputs[backend][1] - outputs['eager'][1]).max() < 1e-5
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Streamed full resolution output: the strip writers and iter_fullres_strips
+# against the whole image zoom + skimage lab2rgb they replace
+import os
+import tempfile
+import warnings
+import numpy as np
+import cv2
+from scipy.ndimage import zoom
+from skimage import color
+from data import colorize_image as CI
+from data import image_writer
+
+warnings.filterwarnings('ignore')
+rng = np.random.RandomState(0)
+
+
+def write_strips(path, img, heights):
+    writer = image_writer.open_strip_writer(path, img.shape[0], img.shape[1])
+    top = 0
+    for h in heights:
+        writer.write(img[top:top + h])
+        top += h
+    writer.close()
+
+
+def test_png_decodes_to_the_same_pixels():
+    path = os.path.join(tempfile.mkdtemp(), 'out.png')
+    img = rng.randint(0, 256, (45, 37, 3)).astype(np.uint8)
+    img[:20, :20] = (200, 30, 90)  # flat areas, where the Sub filter makes zeros
+    write_strips(path, img, (16, 16, 13))
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED)[:, :, ::-1], img)
+
+
+def test_npy_memmap():
+    path = os.path.join(tempfile.mkdtemp(), 'out.npy')
+    img = rng.randint(0, 256, (30, 20, 3)).astype(np.uint8)
+    write_strips(path, img, (8, 8, 8, 6))
+    assert np.array_equal(np.load(path), img)
+    try:
+        image_writer.open_strip_writer(path[:-4] + '.jpg', 30, 20)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_fullres_strips_match_zoom():
+    img = rng.randint(0, 256, (70, 90, 3)).astype(np.uint8)
+    ab = cv2.resize(rng.uniform(-80, 80, (4, 4, 2)), (16, 16)).transpose((2, 0, 1))
+    strips = list(CI.iter_fullres_strips(img, ab, strip_height=32))
+    # the last strip has the 6 rows left
+    assert [(top, strip.shape) for top, strip in strips] == [(0, (32, 90, 3)), (32, (32, 90, 3)), (64, (6, 90, 3))]
+    ab_fullres = zoom(ab, (1, 70. / 16, 90. / 16), order=1)
+    lab = np.concatenate((color.rgb2lab(img).transpose((2, 0, 1))[[0]], ab_fullres), axis=0).transpose((1, 2, 0))
+    ref = (np.clip(color.lab2rgb(lab), 0, 1) * 255).astype('uint8')
+    assert np.abs(np.concatenate([strip for top, strip in strips]).astype(int) - ref).max() <= 1
+
+
+def test_fullres_inputs_match_zoom():
+    model = CI.ColorizeImageTorch(Xd=16)
+    model.set_image(rng.randint(0, 256, (70, 90, 3)).astype(np.uint8))
+    model.input_mask = (rng.rand(1, 16, 16) < .3).astype(float)
+    model.input_ab = rng.uniform(-80, 80, (2, 16, 16)) * model.input_mask
+    factor = (1, 70. / 16, 90. / 16)
+    img_l = color.rgb2lab(model.img_rgb_fullres).transpose((2, 0, 1))[[0]]
+    mask = zoom(model.input_mask, factor, order=0)
+
+    def old(l, ab):
+        # what the get_*_fullres methods did on the whole image
+        return (np.clip(color.lab2rgb(np.concatenate((l, ab), axis=0).transpose((1, 2, 0))), 0, 1) * 255).astype('uint8')
+    refs = ((model.get_input_img_fullres(), old(img_l, zoom(model.input_ab, factor, order=1))),
+            (model.get_img_mask_fullres(), old(100. * (1 - mask), np.zeros((2, 70, 90)))),
+            (model.get_sup_fullres(), old(50 * mask, zoom(model.input_ab, factor, order=0))),
+            (model.get_img_gray_fullres(), old(img_l, np.zeros((2, 70, 90)))))
+    for out, ref in refs:
+        assert out.shape == (70, 90, 3)
+        assert np.abs(out.astype(int) - ref).max() <= 1
+    # streamed to disk in strips
+    path = os.path.join(tempfile.mkdtemp(), 'input_fullres.png')
+    model.save_fullres_strips(path, model.iter_input_img_fullres_strips(strip_height=32))
+    assert np.array_equal(cv2.imread(path)[:, :, ::-1], refs[0][0])
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
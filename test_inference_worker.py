@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# InferenceWorker's latest-wins requests and preview ladders, without a display
+import threading
+import numpy as np
+from PyQt5.QtCore import QCoreApplication, Qt
+from ui.inference_worker import InferenceWorker
+
+app = QCoreApplication.instance() or QCoreApplication([])
+
+
+class GatedModel(object):
+    # answers with the request's input_ab; each forward first waits for the gate
+    def __init__(self):
+        self.img_l = None
+        self.gate = threading.Semaphore(0)
+        self.started = threading.Semaphore(0)
+        self.calls = []
+        self.thread = None
+        self.load_thread = None
+
+    def prepare_thread(self):
+        self.thread = threading.current_thread()
+
+    def load_image(self, img_l):
+        self.load_thread = threading.current_thread()
+        self.img_l = img_l
+
+    def dist_snapshot(self):
+        return 'dist'
+
+    def _run(self, input_ab, size):
+        self.started.release()
+        self.gate.acquire()
+        self.calls.append((int(input_ab[0, 0, 0]), size))
+        return input_ab
+
+    def net_forward(self, input_ab, input_mask, return_rgb=True):
+        self.output_ab = self._run(input_ab, None)
+        return 0
+
+    def net_forward_preview(self, input_ab, input_mask, size):
+        return self._run(input_ab, size)
+
+
+def request(n):
+    return np.full((2, 4, 4), float(n)), np.zeros((1, 4, 4))
+
+
+def start_worker():
+    model = GatedModel()
+    worker = InferenceWorker(model)
+    results = []
+    # delivered in the worker thread, no event loop needed
+    worker.result_ready.connect(lambda img_id, output_ab: results.append((img_id, int(output_ab[0, 0, 0]))), Qt.DirectConnection)
+    worker.start()
+    return model, worker, results
+
+
+def test_latest_request_wins():
+    model, worker, results = start_worker()
+    worker.submit(*request(1))
+    model.started.acquire()  # 1 is running
+    for n in (2, 3, 4):
+        worker.submit(*request(n))
+    assert not worker.idle()
+    model.gate.release()
+    model.started.acquire()
+    model.gate.release()
+    worker.wait_idle()
+    # 2 and 3 were replaced while 1 ran
+    assert model.calls == [(1, None), (4, None)]
+    assert results == [(0, 1), (0, 4)]
+    assert model.thread is not threading.current_thread()
+    worker.stop()
+
+
+def test_ladder_stops_for_newer_request():
+    model, worker, results = start_worker()
+    worker.submit(*request(1), sizes=(16, 32, None))
+    for it in range(3):
+        model.started.acquire()
+        model.gate.release()
+    worker.wait_idle()
+    assert model.calls == [(1, 16), (1, 32), (1, None)]
+    # a newer request during the first rung drops the rest of the ladder
+    worker.submit(*request(2), sizes=(16, 32, None))
+    model.started.acquire()
+    worker.submit(*request(3))
+    model.gate.release()
+    model.started.acquire()
+    model.gate.release()
+    worker.wait_idle()
+    assert model.calls[3:] == [(2, 16), (3, None)]
+    assert [n for img_id, n in results] == [1, 1, 1, 2, 3]
+    worker.stop()
+
+
+def test_request_for_replaced_image_is_skipped():
+    model, worker, results = start_worker()
+    worker.submit(*request(1), sizes=(16, None))
+    model.started.acquire()
+    worker.submit(*request(2))
+    worker.load(model.load_image, 'l')  # a new image while 1 ran
+    model.gate.release()
+    worker.wait_idle()
+    # 1's result carries its image id for show_result to drop, its full forward and 2 are never run
+    assert model.calls == [(1, 16)]
+    assert results == [(0, 1)]
+    assert worker.img_id == 1 and worker.latest is None
+    worker.stop()
+
+
+def test_load_and_latest():
+    model, worker, results = start_worker()
+    worker.load(model.load_image, 'l')
+    worker.submit(*request(1), sizes=(16, None))
+    for it in range(2):
+        model.started.acquire()
+        model.gate.release()
+    worker.wait_idle()
+    assert model.load_thread is model.thread and model.thread is not threading.current_thread()
+    # only the full forward is published, with the image and the distribution it came from
+    img_id, img_l, output_ab, dist = worker.latest
+    assert (img_id, img_l, int(output_ab[0, 0, 0]), dist) == (1, 'l', 1, 'dist')
+    assert results == [(1, 1), (1, 1)]
+    worker.load(model.load_image, 'l2')
+    assert worker.latest is None
+    worker.wait_idle()
+    assert model.img_l == 'l2' and worker.idle()
+    worker.stop()
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Batched gamut snapping against the one-color-at-a-time iteration
+import os
+import tempfile
+import warnings
+import numpy as np
+from skimage import color
+from data import lab_gamut
+
+warnings.filterwarnings('ignore')
+rng = np.random.RandomState(0)
+
+
+def snap_ab_loop(input_l, input_rgb):
+    # the original single color snap_ab
+    conv_lab = color.rgb2lab(input_rgb[np.newaxis, np.newaxis, :]).flatten()
+    for t in range(20):
+        conv_lab[0] = input_l
+        old_lab = conv_lab
+        tmp_rgb = np.clip(color.lab2rgb(conv_lab[np.newaxis, np.newaxis, :]).flatten(), 0, 1)
+        conv_lab = color.rgb2lab(tmp_rgb[np.newaxis, np.newaxis, :]).flatten()
+        if np.sum(np.abs(conv_lab - old_lab)) < 1:
+            break
+    return lab_gamut.lab2rgb_1d(conv_lab, clip=True, dtype='uint8')
+
+
+def test_snap_ab_many_matches_loop():
+    input_l = rng.uniform(0, 100, 300)
+    input_rgb = rng.randint(0, 256, (300, 3)).astype(np.uint8)
+    ref = np.array([snap_ab_loop(l, rgb) for l, rgb in zip(input_l, input_rgb)])
+    assert np.array_equal(lab_gamut.snap_ab_many(input_l, input_rgb), ref)
+    assert np.array_equal(lab_gamut.snap_ab(input_l[0], input_rgb[0]), ref[0])
+
+
+def test_snap_table_on_grid_points():
+    snap_table = lab_gamut.SnapTable.build(L_step=10, ab_step=20)
+    # colors exactly on the grid look up their own snap
+    lab = np.array([[50., -30., 70.], [20., 90., -110.], [100., 10., -10.]])
+    assert np.array_equal(snap_table.snap_lab(lab), lab_gamut._snap_lab_many(lab))
+
+
+def test_snap_table_close_to_snap():
+    snap_table = lab_gamut.SnapTable.build()
+    input_l = rng.uniform(0, 100, 300)
+    input_rgb = rng.randint(0, 256, (300, 3)).astype(np.uint8)
+    diff = np.abs(snap_table.snap(input_l, input_rgb).astype(int) - lab_gamut.snap_ab_many(input_l, input_rgb))
+    assert np.mean(diff) < 2
+    assert np.percentile(diff, 99) <= 12
+
+
+def test_gamut_cache():
+    ab_grid = lab_gamut.abGrid(gamut_size=40)
+    masked_rgb, mask = ab_grid.get_gamut(63.4)
+    ref_rgb, ref_mask = lab_gamut.abGrid(gamut_size=40).update_gamut(63)
+    assert np.array_equal(masked_rgb, ref_rgb) and np.array_equal(mask, ref_mask)
+    assert ab_grid.get_gamut(62.6)[0] is masked_rgb
+
+    path = os.path.join(tempfile.mkdtemp(), 'gamut_cache_40.npz')
+    ab_grid.save_cache(path)
+    loaded = lab_gamut.abGrid(gamut_size=40)
+    assert loaded.load_cache(path)
+    assert np.array_equal(loaded.gamut_cache[63][0], ref_rgb) and np.array_equal(loaded.gamut_cache[63][1], ref_mask)
+    # a cache for another grid size is ignored
+    assert not lab_gamut.abGrid(gamut_size=50).load_cache(path)
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Outputs the engines build on first use against computing them eagerly
+import numpy as np
+import torch
+from data import colorize_image as CI
+from models.pytorch.model import SIGGRAPHGenerator
+
+torch.manual_seed(0)
+rng = np.random.RandomState(0)
+
+
+def make_model():
+    model = CI.ColorizeImageTorch(Xd=64)
+    model.net = SIGGRAPHGenerator().eval()
+    model.net_set = True
+    return model
+
+
+def hints(y, x, ab):
+    input_ab = np.zeros((2, 64, 64))
+    input_mask = np.zeros((1, 64, 64))
+    input_ab[:, y:y + 4, x:x + 4] = np.array(ab)[:, None, None]
+    input_mask[:, y:y + 4, x:x + 4] = 1
+    return input_ab, input_mask
+
+
+def test_output_rgb():
+    model = make_model()
+    model.set_image(rng.randint(0, 256, (80, 100, 3)).astype(np.uint8))
+    for it, ab in enumerate(((40., -30.), (-60., 20.))):
+        assert model.net_forward(*hints(10 * it, 20, ab), return_rgb=False) == 0
+        assert model._output_rgb is None
+        eager = CI.lab2rgb_transpose(model.img_l, model.output_ab)
+        assert np.array_equal(model.output_rgb, eager)
+        assert model.get_img_forward() is model.output_rgb  # converted once per forward
+        SE_map = (1. * model.img_rgb - eager)**2
+        assert model.get_result_PSNR() == 20 * np.log10(255. / np.sqrt(np.mean(SE_map)))
+        # the full resolution result from the same output_ab
+        fullres = model.get_img_fullres()
+        assert fullres.shape == (80, 100, 3)
+        assert np.array_equal(fullres, np.concatenate([strip for top, strip in model.iter_img_fullres_strips(32)]))
+    assert np.array_equal(model.net_forward(*hints(0, 0, (0., 0.))), CI.lab2rgb_transpose(model.img_l, model.output_ab))
+
+
+def test_img_lab_fullres():
+    for thread in (False, True):
+        model = make_model()
+        model.lab_fullres_thread = thread
+        model.Xfullres_max = 90
+        for shape in ((80, 100, 3), (60, 50, 3)):
+            img = rng.randint(0, 256, shape).astype(np.uint8)
+            model.set_image(img)
+            # the larger image was shrunk to fit Xfullres_max first
+            assert max(model.img_rgb_fullres.shape[:2]) <= 90
+            eager = CI.rgb2lab_transpose(model.img_rgb_fullres)
+            assert np.array_equal(model.img_lab_fullres, eager)
+            assert model.img_lab_fullres is model.img_lab_fullres  # converted once per image
+            assert np.array_equal(model.img_l_fullres, eager[:1]) and np.array_equal(model.img_ab_fullres, eager[1:])
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# The preallocated net input of ColorizeImageTorch and the per image first conv with sparse hints
+# against SIGGRAPHGenerator.forward on the separate planes
+import numpy as np
+import torch
+from data import colorize_image as CI
+from models.pytorch.model import SIGGRAPHGenerator
+
+torch.manual_seed(0)
+rng = np.random.RandomState(0)
+
+
+def make_model(maskcent):
+    model = CI.ColorizeImageTorchDist(Xd=64, maskcent=maskcent)
+    model.net = SIGGRAPHGenerator(dist=True).eval()
+    model.net_set = True
+    model.cache.max_bytes = 0
+    return model
+
+
+def random_hints():
+    input_ab = np.zeros((2, 64, 64))
+    input_mask = np.zeros((1, 64, 64))
+    for y, x in rng.randint(0, 60, (5, 2)):
+        input_ab[:, y:y + 4, x:x + 4] = rng.uniform(-100, 100, (2, 1, 1))
+        input_mask[:, y:y + 4, x:x + 4] = 1
+    return input_ab, input_mask
+
+
+def test_matches_forward_on_planes():
+    for maskcent in (False, True):
+        model = make_model(maskcent)
+        for it in range(4):
+            if it % 2 == 0:  # a new image replaces the cached L plane
+                model.set_image(rng.randint(0, 256, (64, 80, 3)).astype(np.uint8))
+            input_ab, input_mask = random_hints()
+            input_ab_copy = input_ab.copy()
+            model.net_forward(input_ab, input_mask, return_rgb=False)
+            with torch.no_grad():
+                ref_ab, ref_dist = model.net.forward(model.img_l_mc, input_ab, input_mask, model.mask_cent)
+            assert np.abs(model.output_ab - ref_ab[0].numpy()).max() < 1e-3
+            assert np.abs(model.dist_ab - ref_dist[0].numpy()).max() < 1e-6
+            assert model.output_ab.dtype == np.float32 and model.dist_ab.dtype == np.float32
+            assert np.array_equal(input_ab, input_ab_copy)
+
+
+def test_input_buffer_is_reused():
+    model = make_model(False)
+    model.set_image(rng.randint(0, 256, (64, 64, 3)).astype(np.uint8))
+    model.net_forward(*random_hints(), return_rgb=False)
+    ptr = model.net_input.data_ptr()
+    l_plane = model.net_input[0, 0].clone()
+    model.net_forward(*random_hints(), return_rgb=False)
+    assert model.net_input.data_ptr() == ptr
+    assert torch.equal(model.net_input[0, 0], l_plane)
+
+
+def test_conv1_base_is_exact():
+    # in float64 splitting the first conv into the L and hint shares only reorders a sum
+    net = SIGGRAPHGenerator(dist=True).eval().double()
+    input_L = torch.from_numpy(rng.uniform(-.5, .5, (1, 1, 48, 64)))
+    hint_const = [.1, -.2, -.5]
+    net_input = torch.cat((input_L, torch.tensor(hint_const, dtype=torch.float64).view(1, 3, 1, 1).expand(1, 3, 48, 64)), dim=1)
+    with torch.no_grad():
+        assert torch.abs(net.conv1_base_response(input_L, hint_const) - net.model1[0](net_input)).max() < 1e-12
+
+
+def test_conv1_sparse_is_exact():
+    # hints at the borders and corners as well, maskcent or not
+    net = SIGGRAPHGenerator(dist=True).eval().double()
+    H, W = 48, 64
+    input_L = torch.from_numpy(rng.uniform(-.5, .5, (1, 1, H, W)))
+    for maskcent in (0, .5):
+        mask = np.zeros((H, W))
+        mask[:3, :4] = mask[-2:, -5:] = mask[20, 30] = mask[10:13, -1] = 1
+        ys, xs = np.nonzero(mask)
+        hints = np.zeros((3, H, W))
+        hints[:2, ys, xs] = rng.uniform(-1, 1, (2, len(ys)))
+        hints[2] = mask
+        net_input = torch.cat((input_L, torch.from_numpy(hints[None] - [[[0]], [[0]], [[maskcent]]])), dim=1)
+        with torch.no_grad():
+            base = net.conv1_base_response(input_L, [0, 0, -maskcent])
+            ys, xs = torch.from_numpy(ys), torch.from_numpy(xs)
+            out = net.conv1_sparse(base, ys, xs, torch.from_numpy(hints)[:, ys, xs].t())
+            assert torch.abs(out - net.model1[0](net_input)).max() < 1e-12
+            # no hints at all
+            assert torch.equal(net.conv1_sparse(base, ys[:0], xs[:0], torch.zeros(0, 3, dtype=torch.float64)), base)
+
+
+def test_conv1_base_follows_image_and_net():
+    model = make_model(True)
+    model.sparse_conv1 = True
+    reference = make_model(True)
+    reference.net = model.net
+    reference.sparse_conv1 = False
+    for it in range(5):
+        if it % 2 == 0:
+            img = rng.randint(0, 256, (64, 64, 3)).astype(np.uint8)
+            model.set_image(img)
+            reference.set_image(img)
+        if it == 3:  # swapping the net drops the cached response
+            model.net = reference.net = SIGGRAPHGenerator(dist=True).eval()
+        hints = random_hints()
+        if it == 4:  # too many hints for the sparse path
+            hints[1][:, :32] = 1
+        model.net_forward(*hints, return_rgb=False)
+        reference.net_forward(*hints, return_rgb=False)
+        assert (model.conv1_base_key[0] == model.img_id) == (it < 4)
+        assert np.abs(model.output_ab - reference.output_ab).max() < 1e-3
+        assert np.abs(model.dist_ab - reference.dist_ab).max() < 1e-6
+
+
+def test_keep_aspect():
+    # a 40x120 image runs at 40x112 instead of being squashed to 64x64
+    model = make_model(True)
+    model.keep_aspect = True
+    assert CI.working_size(40, 120, 64 * 64) == (40, 112)
+    model.set_image(rng.randint(0, 256, (40, 120, 3)).astype(np.uint8))
+    assert model.img_l_mc.shape == (1, 40, 112)
+    input_ab = np.zeros((2, 40, 112))
+    input_mask = np.zeros((1, 40, 112))
+    input_ab[:, 10:14, 90:94] = 40
+    input_mask[:, 10:14, 90:94] = 1
+    model.net_forward(input_ab, input_mask, return_rgb=False)
+    with torch.no_grad():
+        ref_ab, ref_dist = model.net.forward(model.img_l_mc, input_ab, input_mask, model.mask_cent)
+    assert np.abs(model.output_ab - ref_ab[0].numpy()).max() < 1e-3
+    assert model.dist_ab_grid.shape == (23, 23, 40, 112)
+    assert model.get_img_forward().shape == (40, 112, 3) and model.get_img_gray().shape == (40, 112, 3)
+    assert model.get_img_fullres().shape == (40, 120, 3)
+    assert len(model.get_ab_reccs(h=39, w=111, K=3)) == 3
+    assert model.net_forward_preview(input_ab, input_mask, 32).shape == (2, 40, 112)
+
+
+def test_cache_is_dropped_with_the_net():
+    model = make_model(False)
+    model.cache.max_bytes = 2**26
+    model.set_image(rng.randint(0, 256, (64, 64, 3)).astype(np.uint8))
+    input_ab, input_mask = random_hints()
+    model.net_forward(input_ab, input_mask, return_rgb=False)
+    first_ab = model.output_ab.copy()
+    model.net_forward(input_ab, input_mask, return_rgb=False)
+    assert model.cache.hits == 1
+    model.net = SIGGRAPHGenerator(dist=True).eval()
+    assert len(model.cache.entries) == 0
+    model.net_forward(input_ab, input_mask, return_rgb=False)
+    assert model.cache.hits == 1
+    with torch.no_grad():
+        ref_ab, _ = model.net.forward(model.img_l_mc, input_ab, input_mask, model.mask_cent)
+    assert np.abs(model.output_ab - ref_ab[0].numpy()).max() < 1e-3
+    assert np.abs(model.output_ab - first_ab).max() > 1e-2
+
+
+def test_dist_cache_keeps_the_small_grid():
+    model = make_model(False)
+    model.cache.max_bytes = 2**26
+    model.set_image(rng.randint(0, 256, (64, 64, 3)).astype(np.uint8))
+    hints = [random_hints() for it in range(2)]
+    model.net_forward(*hints[0], return_rgb=False)
+    first_ab, first_dist = model.output_ab, model.dist_ab.copy()
+    assert model.cache.nbytes == first_ab.nbytes + first_dist.nbytes // 16
+    model.net_forward(*hints[1], return_rgb=False)
+    model.net_forward(*hints[0], return_rgb=False)
+    assert model.cache.hits == 1
+    assert np.array_equal(model.dist_ab, first_dist) and model.output_ab is first_ab
+    # a hit hands out the stored arrays, which are read-only
+    try:
+        model.output_ab[0, 0, 0] = 1.
+        assert False
+    except ValueError:
+        pass
+
+
+def test_new_image_clears_outputs():
+    model = make_model(False)
+    model.set_image(rng.randint(0, 256, (64, 64, 3)).astype(np.uint8))
+    model.net_forward(*random_hints(), return_rgb=False)
+    assert model.dist_ab_set and model.output_ab is not None
+    # the previous image's predictions are not handed out for the next one
+    model.keep_aspect = True
+    model.set_image(rng.randint(0, 256, (40, 120, 3)).astype(np.uint8))
+    assert not model.dist_ab_set and model.output_ab is None
+    assert model.get_ab_reccs(10, 10) == 0
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
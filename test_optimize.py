@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# The inference-only copy built by prep_net(optimize=True) against the eager SIGGRAPHGenerator
+import os
+import tempfile
+import numpy as np
+import torch
+from data import colorize_image as CI
+from models.pytorch import optimize
+from models.pytorch.model import SIGGRAPHGenerator
+
+torch.manual_seed(0)
+net = SIGGRAPHGenerator(dist=True).eval()
+for module in net.modules():
+    if isinstance(module, torch.nn.BatchNorm2d):
+        module.running_mean.uniform_(-1, 1)
+        module.running_var.uniform_(.5, 2)
+        module.weight.data.uniform_(-2, 2)
+        module.bias.data.uniform_(-1, 1)
+
+
+def test_inference_generator_matches_eager():
+    for channels_last in (False, True):
+        opt_net = optimize.InferenceGenerator(net, channels_last=channels_last)
+        assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in opt_net.net.modules())
+        for Xd in (64, 40):
+            for maskcent in (0, .5):
+                assert optimize.check_equivalence(net, opt_net, Xd=Xd, maskcent=maskcent) < 1e-3
+    # the eager model is left as it was
+    assert any(isinstance(m, torch.nn.BatchNorm2d) for m in net.modules())
+
+
+def test_prep_net_optimize():
+    path = os.path.join(tempfile.mkdtemp(), 'model.pth')
+    torch.save(net.state_dict(), path)
+    img = np.random.RandomState(0).randint(0, 256, (64, 64, 3)).astype(np.uint8)
+    input_ab = np.zeros((2, 64, 64))
+    input_mask = np.zeros((1, 64, 64))
+    input_ab[:, 10:14, 20:24] = [[[-30.]], [[50.]]]
+    input_mask[:, 10:14, 20:24] = 1
+    outputs = []
+    for opt in (False, True):
+        model = CI.ColorizeImageTorchDist(Xd=64, maskcent=True)
+        model.prep_net(path=path, optimize=opt)
+        assert isinstance(model.net, optimize.InferenceGenerator) == opt
+        model.set_image(img)
+        model.net_forward(input_ab, input_mask, return_rgb=False)
+        outputs.append((model.output_ab, model.dist_ab))
+    assert np.abs(outputs[0][0] - outputs[1][0]).max() < 1e-3
+    assert np.abs(outputs[0][1] - outputs[1][1]).max() < 1e-6
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
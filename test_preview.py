@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# ColorizeImageTorch.net_forward_preview, the reduced size forward shown while a hint is dragged
+import numpy as np
+import torch
+from data import colorize_image as CI
+from models.pytorch.model import SIGGRAPHGenerator
+
+torch.manual_seed(0)
+rng = np.random.RandomState(0)
+
+
+class RecordingNet(object):
+    # keeps the planes it is given and answers with a constant color
+    def forward(self, input_A, input_B, mask_B, maskcent=0):
+        self.inputs = (input_A, input_B, mask_B, maskcent)
+        return torch.full((1, 2) + input_A.shape[1:], 7.)
+
+
+def make_model(net, dist=False):
+    model = (CI.ColorizeImageTorchDist if dist else CI.ColorizeImageTorch)(Xd=64, maskcent=True)
+    model.net = net
+    model.net_set = True
+    model.cache.max_bytes = 0
+    model.set_image(rng.randint(0, 256, (64, 64, 3)).astype(np.uint8))
+    return model
+
+
+def test_hints_are_shrunk():
+    model = make_model(RecordingNet())
+    input_ab = np.zeros((2, 64, 64))
+    input_mask = np.zeros((1, 64, 64))
+    input_ab[:, 10:12, 20:22] = [[[30.]], [[-40.]]]
+    input_mask[:, 10:12, 20:22] = 1
+    input_ab[:, 40, 41] = [-10., 20.]  # a single pixel still shows up at half size
+    input_mask[:, 40, 41] = 1
+    output_ab = model.net_forward_preview(input_ab, input_mask, 35)  # rounded to 32
+    input_A, input_B, mask_B, maskcent = model.net.inputs
+    assert input_A.shape == (1, 32, 32) and input_B.shape == (2, 32, 32) and mask_B.shape == (1, 32, 32)
+    assert np.abs(input_A[0] - model.img_l_mc[0].reshape(32, 2, 32, 2).mean((1, 3))).max() < 1e-4
+    assert np.array_equal(np.argwhere(mask_B[0]), [[5, 10], [20, 20]])
+    assert np.allclose(input_B[:, 5, 10], [30., -40.]) and np.allclose(input_B[:, 20, 20], [-10., 20.])
+    assert maskcent == .5
+    assert output_ab.shape == (2, 64, 64) and np.allclose(output_ab, 7.)
+
+
+def test_matches_full_forward_at_full_size():
+    model = make_model(SIGGRAPHGenerator(dist=True).eval(), dist=True)
+    input_ab = np.zeros((2, 64, 64))
+    input_mask = np.zeros((1, 64, 64))
+    input_ab[:, 30:33, 30:33] = 50
+    input_mask[:, 30:33, 30:33] = 1
+    output_ab = model.net_forward_preview(input_ab, input_mask, 64)
+    assert np.array_equal(output_ab, model.output_ab)
+    # a smaller size leaves the full outputs alone
+    preview_ab = model.net_forward_preview(input_ab, input_mask, 32)
+    assert preview_ab.shape == (2, 64, 64) and preview_ab.dtype == np.float32
+    assert model.output_ab is output_ab
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
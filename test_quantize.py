@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Batch norm folding and the int8 generator against the float SIGGRAPHGenerator
+import copy
+import os
+import tempfile
+import numpy as np
+import torch
+from data import colorize_image as CI
+from models.pytorch import quantize
+from models.pytorch.model import SIGGRAPHGenerator
+
+torch.manual_seed(0)
+net = SIGGRAPHGenerator(dist=True).eval()
+# batch norms that actually scale and shift, including negative scales
+for module in net.modules():
+    if isinstance(module, torch.nn.BatchNorm2d):
+        module.running_mean.uniform_(-1, 1)
+        module.running_var.uniform_(.5, 2)
+        module.weight.data.uniform_(-2, 2)
+        module.bias.data.uniform_(-1, 1)
+rng = np.random.RandomState(0)
+
+
+def random_inputs(H, W):
+    return rng.uniform(-50, 50, (1, 1, H, W)), rng.uniform(-110, 110, (1, 2, H, W)), (rng.rand(1, 1, H, W) < .02) * 1.
+
+
+def test_fold_bn_is_exact():
+    folded = quantize.fold_bn(copy.deepcopy(net))
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in folded.modules())
+    # the offset maps depend on the size, borders included
+    for H, W in [(64, 64), (48, 80), (64, 64)]:
+        inputs = random_inputs(H, W)
+        with torch.no_grad():
+            ref_ab, ref_dist = net.forward(*inputs, maskcent=.5)
+            out_ab, out_dist = folded.forward(*inputs, maskcent=.5)
+        assert torch.abs(out_ab - ref_ab).max() < 1e-3
+        assert torch.abs(out_dist - ref_dist).max() < 1e-6
+
+
+def test_int8_checkpoint():
+    prepared = quantize.prepare_generator(copy.deepcopy(net))
+    with torch.no_grad():
+        for it in range(4):
+            prepared.forward(*random_inputs(64, 64))
+    quant_net = quantize.convert_generator(prepared)
+    path = os.path.join(tempfile.mkdtemp(), 'model_int8.pth')
+    torch.save(quant_net.state_dict(), path)
+
+    inputs = random_inputs(64, 64)
+    with torch.no_grad():
+        ref_ab = net.forward(*inputs)[0]
+        out_ab = quant_net.forward(*inputs)[0]
+    # int8 stays close to float
+    assert torch.mean(torch.abs(out_ab - ref_ab)) < .05 * torch.mean(torch.abs(ref_ab))
+
+    # prep_net(quantized=True) rebuilds the same model from the checkpoint
+    model = CI.ColorizeImageTorch(Xd=64)
+    model.prep_net(path=path, quantized=True)
+    model.set_image(np.random.RandomState(1).randint(0, 256, (64, 64, 3)).astype(np.uint8))
+    model.net_forward(inputs[1][0], inputs[2][0], return_rgb=False)
+    with torch.no_grad():
+        ref = quant_net.forward(model.img_l_mc, inputs[1][0], inputs[2][0])[0][0].numpy()
+    assert np.array_equal(model.output_ab, ref)
+
+
+
+def test_calibrate_through_engine():
+    # what quantize.main does: calibrate in the engine, save, load_quantized
+    model = CI.ColorizeImageTorchDist(Xd=64)
+    model.net = quantize.prepare_generator(copy.deepcopy(net))
+    model.net_set = True
+    calib_rng = np.random.RandomState(2)
+    for it in range(3):
+        model.set_image(calib_rng.randint(0, 256, (64, 80, 3)).astype(np.uint8))
+        with torch.no_grad():
+            model.net_forward(*quantize.random_hints(calib_rng, 64, 10), return_rgb=False)
+    path = os.path.join(tempfile.mkdtemp(), 'model_int8.pth')
+    torch.save(quantize.convert_generator(model.net).state_dict(), path)
+
+    model.set_image(calib_rng.randint(0, 256, (64, 64, 3)).astype(np.uint8))
+    hints = quantize.random_hints(calib_rng, 64, 10)
+    outputs = []
+    for engine_net in (net, quantize.load_quantized(path, dist=True)):
+        model.net = engine_net
+        rgb = model.net_forward(*hints)
+        outputs.append((model.output_ab, model.dist_ab, rgb))
+    (ref_ab, ref_dist, ref_rgb), (out_ab, out_dist, out_rgb) = outputs
+    assert np.mean(np.abs(out_ab - ref_ab)) < .05 * np.mean(np.abs(ref_ab))
+    assert np.mean(np.abs(out_dist - ref_dist)) < .05 * np.mean(ref_dist)
+    assert np.mean(np.abs(out_rgb.astype(int) - ref_rgb)) < 2
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# One ColorizeImageTorchDist serving both the colorization and the distribution
+# against the plain ColorizeImageTorch on the same checkpoint
+import os
+import tempfile
+import numpy as np
+import torch
+from data import colorize_image as CI
+from models.pytorch.model import SIGGRAPHGenerator
+
+torch.manual_seed(0)
+rng = np.random.RandomState(0)
+
+
+def test_dist_engine_matches_plain_engine():
+    path = os.path.join(tempfile.mkdtemp(), 'model.pth')
+    torch.save(SIGGRAPHGenerator(dist=True).state_dict(), path)
+    plain = CI.ColorizeImageTorch(Xd=64, maskcent=True)
+    plain.prep_net(path=path)
+    shared = CI.ColorizeImageTorchDist(Xd=64, maskcent=True)
+    shared.prep_net(path=path)
+    img = rng.randint(0, 256, (64, 96, 3)).astype(np.uint8)
+    plain.set_image(img)
+    shared.set_image(img)
+    input_ab = np.zeros((2, 64, 64))
+    input_mask = np.zeros((1, 64, 64))
+    for it in range(2):
+        if it == 1:
+            input_ab[:, 20:24, 30:34] = [[[40.]], [[-30.]]]
+            input_mask[:, 20:24, 30:34] = 1
+        plain_rgb = plain.net_forward(input_ab, input_mask)
+        shared_rgb = shared.net_forward(input_ab, input_mask)
+        assert np.abs(shared.output_ab - plain.output_ab).max() < 1e-4
+        assert np.abs(shared_rgb.astype(int) - plain_rgb).max() <= 1
+        # and the distribution from the same pass
+        assert shared.dist_ab_set and shared.dist_ab.shape == (529, 64, 64)
+        assert np.abs(shared.dist_ab.sum(axis=0) - 1).max() < 1e-4
+        # suggestions from a snapshot survive the next forward pass
+        snapshot = shared.dist_snapshot()
+        ab, conf = snapshot.get_ab_reccs(30, 40, K=5, return_conf=True)
+        assert np.array_equal(ab, shared.get_ab_reccs(30, 40, K=5))
+    shared.net_forward(input_ab * 0, input_mask * 0)
+    assert np.array_equal(snapshot.get_ab_reccs(30, 40, K=5, return_conf=True)[1], conf)
+    assert plain.dist_snapshot() is None
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# TiledResult's tile by tile updates against rendering the whole window again
+import numpy as np
+import cv2
+from data import color_space
+from ui.tiled_result import TiledResult
+
+rng = np.random.RandomState(0)
+LOAD = 64
+
+
+def smooth_ab():
+    return cv2.resize(rng.uniform(-80, 80, (8, 8, 2)).astype(np.float32), (LOAD, LOAD)).transpose((2, 0, 1)).copy()
+
+
+def full_render(l_win, output_ab):
+    # what GUIDraw.show_result used to do
+    h, w = l_win.shape
+    ab_win = cv2.resize(output_ab.transpose((1, 2, 0)), (w, h), interpolation=cv2.INTER_CUBIC)
+    return color_space.lab2rgb_uint8(np.concatenate((l_win[..., np.newaxis], ab_win), axis=2))
+
+
+def make_tiled(h=100, w=128):
+    l_win = rng.uniform(20, 80, (h, w)).astype(np.float32)
+    return l_win, TiledResult(l_win, (LOAD, LOAD), tile=16)
+
+
+def make_full(l_win, ab):
+    tiled = TiledResult(l_win, (LOAD, LOAD), tile=16)
+    tiled.update(ab)
+    return tiled.rgb
+
+
+def test_full_matches_resize():
+    l_win, tiled = make_tiled()
+    ab = smooth_ab()
+    rects = tiled.update(ab)
+    assert rects == [(0, y, 128, min(16, 100 - y)) for y in range(0, 100, 16)]
+    # remap and resize may round the last float bit differently
+    assert np.abs(tiled.rgb.astype(int) - full_render(l_win, ab)).max() <= 1
+
+
+def test_local_edit_redraws_its_tiles():
+    l_win, tiled = make_tiled()
+    ab = smooth_ab()
+    tiled.update(ab)
+    ab[:, 30:33, 40:42] += 20
+    drawn = tiled.tiles_drawn
+    rects = tiled.update(ab)
+    # 3x2 changed source pixels plus the cubic footprint fit in 2x2 tiles
+    assert 1 <= tiled.tiles_drawn - drawn <= 4
+    x0 = min(x for x, y, w, h in rects)
+    y0 = min(y for x, y, w, h in rects)
+    assert x0 <= 40 * 128 / LOAD and y0 <= 30 * 100 / LOAD
+    assert np.array_equal(tiled.rgb, make_full(l_win, ab))
+    assert tiled.update(ab) == []
+
+
+def test_small_changes_stay_bounded():
+    l_win, tiled = make_tiled()
+    ab = smooth_ab()
+    tiled.update(ab)
+    for it in range(20):
+        ab = ab + rng.uniform(-.2, .2, ab.shape).astype(np.float32)
+        ab[:, it:it + 2, 2 * it:2 * it + 3] += 5
+        tiled.update(ab)
+        assert np.abs(tiled.ab - ab).max() <= tiled.ab_tol
+    exact = make_full(l_win, ab)
+    # a few levels at most from a render of the latest output, equal once forced
+    assert np.abs(tiled.rgb.astype(int) - exact).max() <= 4
+    tiled.update(ab, full=True)
+    assert np.array_equal(tiled.rgb, exact)
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
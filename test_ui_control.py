@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# UIControl's incrementally maintained hint planes against a full redraw of every edit
+import numpy as np
+import cv2
+from PyQt5.QtCore import QPoint
+from PyQt5.QtGui import QColor
+from ui.ui_control import UIControl
+from data import color_space
+from data.colorize_image import working_size
+
+rng = np.random.RandomState(0)
+
+
+def full_redraw(uiControl):
+    # what get_input used to do: rasterize every edit as rgb, then convert the whole image
+    H, W = uiControl.load_shape
+    im = np.zeros((H, W, 3), np.uint8)
+    mask = np.zeros((H, W, 1), np.uint8)
+    hints = uiControl.hints
+    for row in hints.rows():
+        w = int(hints.width[row] / uiControl.scale)
+        x = int((hints.pnt[row, 0] - uiControl.dw) / float(uiControl.img_w) * W)
+        y = int((hints.pnt[row, 1] - uiControl.dh) / float(uiControl.img_h) * H)
+        cv2.rectangle(mask, (x - w, y - w), (x + w, y + w), 255, -1)
+        cv2.rectangle(im, (x - w, y - w), (x + w, y + w), [int(v) for v in hints.color[row]], -1)
+    return color_space.rgb2lab_planes(im)[1:3], (mask > 0).transpose((2, 0, 1))
+
+
+def random_color():
+    return QColor(*[int(v) for v in rng.randint(0, 256, 3)])
+
+
+def random_point():
+    return QPoint(int(rng.randint(0, 512)), int(rng.randint(62, 450)))
+
+
+def random_hint(uiControl):
+    rows = uiControl.hints.rows()
+    return QPoint(*[int(v) for v in uiControl.hints.pnt[rows[rng.randint(len(rows))]]])
+
+
+def test_planes_match_full_redraw():
+    uiControl = UIControl(win_size=512, load_size=256)
+    uiControl.setImageSize((512, 388))
+    handed_out = []
+    for it in range(300):
+        r = rng.rand()
+        if r < 0.4 or uiControl.selected is None:
+            c = random_color()
+            uiControl.addPoint(random_point(), c, c, float(rng.choice([2, 4, 8, 20])))
+        elif r < 0.6:
+            uiControl.movePoint(random_point(), random_color(), random_color(), uiControl.hints.width[uiControl.selected])
+        elif r < 0.7:
+            uiControl.update_color(random_color(), random_color())
+        else:
+            if r < 0.8:
+                uiControl.erasePoint(random_hint(uiControl))
+            elif r < 0.9:
+                uiControl.undo()
+            else:
+                uiControl.redo()
+            rows = uiControl.hints.rows()
+            uiControl.selected = rows[-1] if len(rows) > 0 else None
+
+        im_ab, im_mask = uiControl.get_input()
+        ref_ab, ref_mask = full_redraw(uiControl)
+        assert np.array_equal(im_mask > 0, ref_mask)
+        assert np.array_equal(im_ab, ref_ab)
+        handed_out.append((im_ab, im_ab.copy()))
+
+    # later edits never write into planes that were already returned
+    for im_ab, im_ab_copy in handed_out:
+        assert np.array_equal(im_ab, im_ab_copy)
+
+
+def test_load_shape_keeps_aspect():
+    # hint planes at a 224x296 working size for a 512x388 window image
+    uiControl = UIControl(win_size=512, load_size=256)
+    uiControl.setImageSize((512, 388), working_size(388, 512, 256 * 256))
+    uiControl.reset()
+    assert uiControl.load_shape == (224, 296)
+    c = QColor(200, 30, 30)
+    uiControl.addPoint(QPoint(256, 256), c, c, 4.)
+    im_ab, im_mask = uiControl.get_input()
+    assert im_ab.shape == (2, 224, 296) and im_mask.shape == (1, 224, 296)
+    # the window center lands on the center of the planes, with square hints
+    ys, xs = np.nonzero(im_mask[0])
+    assert abs(ys.mean() - 112) <= 1 and abs(xs.mean() - 148) <= 1
+    assert ys.max() - ys.min() == xs.max() - xs.min()
+    for it in range(50):
+        c = random_color()
+        uiControl.addPoint(random_point(), c, c, float(rng.choice([2, 4, 8, 20])))
+    ref_ab, ref_mask = full_redraw(uiControl)
+    im_ab, im_mask = uiControl.get_input()
+    assert np.array_equal(im_mask > 0, ref_mask)
+    assert np.array_equal(im_ab, ref_ab)
+
+
+def edit_list(uiControl):
+    hints = uiControl.hints
+    return [(tuple(hints.pnt[row]), tuple(hints.color[row]), hints.width[row]) for row in hints.rows()]
+
+
+def test_undo_redo_round_trip():
+    uiControl = UIControl(win_size=512, load_size=256)
+    uiControl.setImageSize((512, 388))
+    # points on a grid coarser than the hit radius, so every add makes a new edit
+    grid = [QPoint(int(x), int(y)) for x in range(8, 512, 16) for y in range(70, 450, 16)]
+    states = [edit_list(uiControl)]
+    for it in range(100):
+        if rng.rand() < 0.7 or uiControl.num_points() == 0:
+            c = random_color()
+            uiControl.addPoint(grid[rng.randint(len(grid))], c, c, 4.)
+        else:
+            uiControl.erasePoint(random_hint(uiControl))
+        if edit_list(uiControl) != states[-1]:
+            states.append(edit_list(uiControl))
+
+    for state in states[-2::-1]:
+        assert uiControl.undo()
+        assert edit_list(uiControl) == state
+    assert not uiControl.can_undo()
+    for state in states[1:]:
+        assert uiControl.redo()
+        assert edit_list(uiControl) == state
+    assert not uiControl.can_redo()
+    ref_ab, ref_mask = full_redraw(uiControl)
+    im_ab, im_mask = uiControl.get_input()
+    assert np.array_equal(im_ab, ref_ab)
+
+
+def test_find_point_matches_linear_scan():
+    uiControl = UIControl(win_size=512, load_size=256)
+    uiControl.setImageSize((512, 388))
+    for it in range(2000):
+        c = random_color()
+        uiControl.addPoint(random_point(), c, c, float(rng.choice([2, 4, 8, 20, 50])))
+    for it in range(200):
+        uiControl.erasePoint(random_hint(uiControl))
+    hints = uiControl.hints
+    for it in range(2000):
+        pnt = random_point()
+        # what PointEdit.is_same over the edit list did
+        ref = None
+        for row in hints.rows():
+            if abs(hints.pnt[row, 0] - pnt.x()) <= hints.width[row] + 1 and abs(hints.pnt[row, 1] - pnt.y()) <= hints.width[row] + 1:
+                ref = row
+                break
+        assert uiControl.find_point(pnt) == ref
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print('%s passed' % name)
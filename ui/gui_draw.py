@@ -7,8 +7,11 @@ from PyQt5.QtWidgets import *
 # QString is not needed in PyQt5 as Python strings are used directly
 QString = str
 from .ui_control import UIControl
+from .inference_worker import InferenceWorker
+from .tiled_result import TiledResult
 
 from data import lab_gamut
+from data import color_space
 from skimage import color
 import os
 import datetime
@@ -47,6 +50,27 @@ class GUIDraw(QWidget):
         self.total_images = 0
         self.image_id = 0
         self.method = 'with_dist'
+        self.result = None
+        self.tiled_result = None  # renders self.result tile by tile, see show_result
+        self.result_qimg = None  # QImages sharing memory with self.result and self.gray_win
+        self.gray_qimg = None
+        # working sizes of the quick previews while a point is placed or dragged, run
+        # smallest first (model.net_forward_preview); the full forward follows on release.
+        # Empty runs the full forward on every move
+        self.preview_sizes = (128, )
+        self.previewed = False  # a preview has been shown since the last full forward
+
+        # forward passes run on their own thread so painting never waits on the network
+        self.worker = InferenceWorker(self.model)
+        self.worker.result_ready.connect(self.show_result)
+        self.worker.start()
+        QApplication.instance().aboutToQuit.connect(self.worker.stop)
+        # and a separate distribution model on another one
+        self.dist_worker = self.worker
+        if self.dist_model is not None and not self.shared_model():
+            self.dist_worker = InferenceWorker(self.dist_model)
+            self.dist_worker.start()
+            QApplication.instance().aboutToQuit.connect(self.dist_worker.stop)
 
     def clock_count(self):
         self.count_secs -= 1
@@ -84,7 +108,9 @@ class GUIDraw(QWidget):
         h, w, c = self.im_full.shape
         max_width = max(h, w)
         r = self.win_size / float(max_width)
-        self.scale = float(self.win_size) / self.load_size
+        # (H, W) the model works at, load_size x load_size unless it keeps the aspect ratio
+        self.load_shape = self.model.load_shape(h, w)
+        self.scale = float(self.win_size) / max(self.load_shape)
         print('scale = %f' % self.scale)
         rw = int(round(r * w / 4.0) * 4)
         rh = int(round(r * h / 4.0) * 4)
@@ -95,34 +121,36 @@ class GUIDraw(QWidget):
         self.dh = int((self.win_size - rh) // 2)
         self.win_w = rw
         self.win_h = rh
-        self.uiControl.setImageSize((rw, rh))
+        self.uiControl.setImageSize((rw, rh), self.load_shape)
         im_gray = cv2.cvtColor(im_bgr, cv2.COLOR_BGR2GRAY)
         self.im_gray3 = cv2.cvtColor(im_gray, cv2.COLOR_GRAY2BGR)
 
         self.gray_win = cv2.resize(self.im_gray3, (rw, rh), interpolation=cv2.INTER_CUBIC)
-        im_bgr = cv2.resize(im_bgr, (self.load_size, self.load_size), interpolation=cv2.INTER_CUBIC)
+        self.gray_qimg = QImage(self.gray_win.data, rw, rh, rw * 3, QImage.Format_RGB888)
+        im_bgr = cv2.resize(im_bgr, self.load_shape[::-1], interpolation=cv2.INTER_CUBIC)
         self.im_rgb = cv2.cvtColor(im_bgr, cv2.COLOR_BGR2RGB)
-        lab_win = color.rgb2lab(self.im_win[:, :, ::-1])
+        lab_win = color_space.rgb2lab(self.im_win[:, :, ::-1])
 
-        self.im_lab = color.rgb2lab(im_bgr[:, :, ::-1])
+        self.im_lab = color_space.rgb2lab(im_bgr[:, :, ::-1])
         self.im_l = self.im_lab[:, :, 0]
         self.l_win = lab_win[:, :, 0]
+        self.tiled_result = TiledResult(self.l_win, self.load_shape)
+        self.result_qimg = QImage(self.tiled_result.rgb.data, rw, rh, rw * 3, QImage.Format_RGB888)
         self.im_ab = self.im_lab[:, :, 1:]
         self.im_size = self.im_rgb.shape[0:2]
 
-        self.im_ab0 = np.zeros((2, self.load_size, self.load_size))
-        self.im_mask0 = np.zeros((1, self.load_size, self.load_size))
+        self.im_ab0 = np.zeros((2, ) + self.load_shape)
+        self.im_mask0 = np.zeros((1, ) + self.load_shape)
         self.brushWidth = 2 * self.scale
 
-        self.model.load_image(image_file)
+        self.worker.load(self.model.load_image, image_file)
 
-        if (self.dist_model is not None):
-            self.dist_model.set_image(self.im_rgb)
+        if (self.dist_model is not None and not self.shared_model()):
+            self.dist_worker.load(self.dist_model.set_image, self.im_rgb)
             self.predict_color()
 
     def update_im(self):
         self.update()
-        QApplication.processEvents()
 
     def update_ui(self, move_point=True):
         if self.ui_mode == 'none':
@@ -193,8 +221,8 @@ class GUIDraw(QWidget):
         return self.uiControl.can_redo()
 
     def scale_point(self, pnt):
-        x = int((pnt.x() - self.dw) / float(self.win_w) * self.load_size)
-        y = int((pnt.y() - self.dh) / float(self.win_h) * self.load_size)
+        x = int((pnt.x() - self.dw) / float(self.win_w) * self.load_shape[1])
+        y = int((pnt.y() - self.dh) / float(self.win_h) * self.load_shape[0])
         return x, y
 
     def valid_point(self, pnt):
@@ -241,7 +269,7 @@ class GUIDraw(QWidget):
         color_array = np.array((c.red(), c.green(), c.blue())).astype(
             'uint8')
         mean_L = self.im_l[y, x]
-        snap_color = lab_gamut.snap_ab(mean_L, color_array)
+        snap_color = lab_gamut.snap_ab_fast(mean_L, color_array)
         snap_qcolor = QColor(snap_color[0], snap_color[1], snap_color[2])
         return snap_qcolor
 
@@ -280,7 +308,12 @@ class GUIDraw(QWidget):
         if not os.path.exists(save_path):
             os.mkdir(save_path)
 
-        np.save(os.path.join(save_path, 'im_l.npy'), self.model.img_l)
+        # make sure the result reflects every hint placed so far
+        self.worker.wait_idle()
+        img_id, img_l, output_ab, dist = self.worker.latest
+        self.show_result(img_id, output_ab, full=True)
+
+        np.save(os.path.join(save_path, 'im_l.npy'), img_l)
         np.save(os.path.join(save_path, 'im_ab.npy'), self.im_ab0)
         np.save(os.path.join(save_path, 'im_mask.npy'), self.im_mask0)
 
@@ -288,55 +321,78 @@ class GUIDraw(QWidget):
         mask = self.im_mask0.transpose((1, 2, 0)).astype(np.uint8) * 255
         cv2.imwrite(os.path.join(save_path, 'input_mask.png'), mask)
         cv2.imwrite(os.path.join(save_path, 'ours.png'), result_bgr)
-        cv2.imwrite(os.path.join(save_path, 'ours_fullres.png'), self.model.get_img_fullres()[:, :, ::-1])
-        cv2.imwrite(os.path.join(save_path, 'input_fullres.png'), self.model.get_input_img_fullres()[:, :, ::-1])
-        cv2.imwrite(os.path.join(save_path, 'input.png'), self.model.get_input_img()[:, :, ::-1])
-        cv2.imwrite(os.path.join(save_path, 'input_ab.png'), self.model.get_sup_img()[:, :, ::-1])
+        with self.worker.lock:
+            self.model.save_img_fullres(os.path.join(save_path, 'ours_fullres.png'))
+            self.model.save_fullres_strips(os.path.join(save_path, 'input_fullres.png'), self.model.iter_input_img_fullres_strips())
+            cv2.imwrite(os.path.join(save_path, 'input.png'), self.model.get_input_img()[:, :, ::-1])
+            cv2.imwrite(os.path.join(save_path, 'input_ab.png'), self.model.get_sup_img()[:, :, ::-1])
 
     def enable_gray(self):
         self.use_gray = not self.use_gray
         self.update()
 
+    def shared_model(self):
+        # True when one engine produces both the colorization and the distribution
+        return self.dist_model is self.model
+
     def predict_color(self):
+        if self.shared_model():
+            # compute_result already refreshed the distribution in the same forward pass
+            return
         if self.dist_model is not None and self.image_loaded:
-            im, mask = self.uiControl.get_input()
-            im_mask0 = mask > 0.0
-            self.im_mask0 = im_mask0.transpose((2, 0, 1))
-            im_lab = color.rgb2lab(im).transpose((2, 0, 1))
-            self.im_ab0 = im_lab[1:3, :, :]
+            self.im_ab0, self.im_mask0 = self.uiControl.get_input()
 
-            self.dist_model.net_forward(self.im_ab0, self.im_mask0)
+            self.dist_worker.submit(self.im_ab0, self.im_mask0)
 
     def suggest_color(self, h, w, K=5):
         if self.dist_model is not None and self.image_loaded:
             print(f'Suggesting colors at position ({h}, {w})')
-            ab, conf = self.dist_model.get_ab_reccs(h=h, w=w, K=K, N=25000, return_conf=True)
+            # from what the workers published, right after a new image is loaded its
+            # first prediction may still be running
+            latest, dist_latest = self.worker.latest, self.dist_worker.latest
+            if latest is None or dist_latest is None or dist_latest[3] is None:
+                print('Cannot suggest colors: no prediction for this image yet')
+                return None
+            img_id, img_l, output_ab, dist = latest
+            ab, conf = dist_latest[3].get_ab_reccs(h=h, w=w, K=K, return_conf=True)
+            curr_rgb = color_space.lab_planes2rgb_uint8(img_l[:, h:h + 1, w:w + 1], output_ab[:, h:h + 1, w:w + 1])[0]
             L = np.tile(self.im_lab[h, w, 0], (K, 1))
             colors_lab = np.concatenate((L, ab), axis=1)
             colors_lab3 = colors_lab[:, np.newaxis, :]
             colors_rgb = np.clip(np.squeeze(color.lab2rgb(colors_lab3)), 0, 1)
-            colors_rgb_withcurr = np.concatenate((self.model.get_img_forward()[h, w, np.newaxis, :] / 255., colors_rgb), axis=0)
+            colors_rgb_withcurr = np.concatenate((curr_rgb / 255., colors_rgb), axis=0)
             print(f'Generated {colors_rgb_withcurr.shape[0]} color suggestions')
             return colors_rgb_withcurr
         else:
             print(f'Cannot suggest colors: dist_model={self.dist_model is not None}, image_loaded={self.image_loaded}')
             return None
 
-    def compute_result(self):
-        im, mask = self.uiControl.get_input()
-        im_mask0 = mask > 0.0
-        self.im_mask0 = im_mask0.transpose((2, 0, 1))
-        im_lab = color.rgb2lab(im).transpose((2, 0, 1))
-        self.im_ab0 = im_lab[1:3, :, :]
-
-        self.model.net_forward(self.im_ab0, self.im_mask0)
-        ab = self.model.output_ab.transpose((1, 2, 0))
-        ab_win = cv2.resize(ab, (self.win_w, self.win_h), interpolation=cv2.INTER_CUBIC)
-        pred_lab = np.concatenate((self.l_win[..., np.newaxis], ab_win), axis=2)
-        pred_rgb = (np.clip(color.lab2rgb(pred_lab), 0, 1) * 255).astype('uint8')
-        self.result = pred_rgb
-        self.update_result_signal.emit(self.result)
-        self.update()
+    def compute_result(self, preview=False):
+        self.im_ab0, self.im_mask0 = self.uiControl.get_input()
+
+        # evaluated on the inference thread, show_result receives the output
+        if preview and self.preview_sizes and hasattr(self.model, 'net_forward_preview'):
+            self.worker.submit(self.im_ab0, self.im_mask0, sorted(self.preview_sizes))
+            self.previewed = True
+        else:
+            self.worker.submit(self.im_ab0, self.im_mask0)
+            self.previewed = False
+
+    def show_result(self, img_id, output_ab, full=False):
+        # only the tiles where output_ab changed visibly are converted and repainted,
+        # full renders all of them from output_ab exactly
+        if img_id != self.worker.img_id:  # finished after another image was loaded
+            return
+        first = self.result is None
+        rects = self.tiled_result.update(output_ab, full=full or first)
+        self.result = self.tiled_result.rgb
+        if first or rects:
+            self.update_result_signal.emit(self.result)
+        if first or self.use_gray:
+            self.update()
+            return
+        for x, y, w, h in rects:
+            self.update(self.dw + x, self.dh + y, w, h)
 
     def paintEvent(self, event):
         painter = QPainter()
@@ -344,13 +400,14 @@ class GUIDraw(QWidget):
         painter.fillRect(event.rect(), QColor(49, 54, 49))
         painter.setRenderHint(QPainter.Antialiasing)
         if self.use_gray or self.result is None:
-            im = self.gray_win
+            qImg = self.gray_qimg
         else:
-            im = self.result
+            qImg = self.result_qimg
 
-        if im is not None:
-            qImg = QImage(im.tobytes(), im.shape[1], im.shape[0], im.shape[1] * 3, QImage.Format_RGB888)
-            painter.drawImage(self.dw, self.dh, qImg)
+        if qImg is not None:
+            # only the part of the image inside the region being repainted
+            target = event.rect().intersected(QRect(self.dw, self.dh, qImg.width(), qImg.height()))
+            painter.drawImage(target, qImg, target.translated(-self.dw, -self.dh))
 
         self.uiControl.update_painter(painter)
         painter.end()
@@ -381,17 +438,13 @@ class GUIDraw(QWidget):
                 self.ui_mode = 'point'
                 # Only update color suggestions for new points
                 # Check if this is a new point or existing point
-                is_new_point = True
-                for ue in self.uiControl.userEdits:
-                    if ue.is_same(pos):
-                        is_new_point = False
-                        break
-                
+                is_new_point = self.uiControl.find_point(pos) is None
                 if is_new_point:
                     # New point - show color suggestions
                     self.change_color(pos)
                 
                 self.update_ui(move_point=False)
+                # previews only once the hint is dragged, a plain click goes straight to the full pass
                 self.compute_result()
 
             if event.button() == Qt.RightButton:
@@ -411,12 +464,14 @@ class GUIDraw(QWidget):
                 if not self.is_same_point(self.pos, new_pos):
                     self.pos = new_pos
                     self.update_ui(move_point=True)
-                    self.compute_result()
+                    self.compute_result(preview=True)
 
     def mouseReleaseEvent(self, event):
         # Finalize point placement
         if self.ui_mode == 'point':
             self.ui_mode = 'none'
+            if self.previewed:  # replace the preview with the full result
+                self.compute_result()
         if self.ui_mode == 'erase':
             self.ui_mode = 'none'
 
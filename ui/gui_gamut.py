@@ -1,4 +1,5 @@
 import cv2
+import threading
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
@@ -16,11 +17,16 @@ class GUIGamut(QWidget):
         self.win_size = gamut_size * 2  # divided by 4
         self.setFixedSize(self.win_size, self.win_size)
         self.ab_grid = lab_gamut.abGrid(gamut_size=gamut_size, D=1)
+        if not self.ab_grid.load_cache():
+            # build the gamut of every L once, in the background, and keep it on disk
+            thread = threading.Thread(target=self.ab_grid.precompute)
+            thread.daemon = True
+            thread.start()
         self.reset()
 
     def set_gamut(self, l_in=50):
         self.l_in = l_in
-        self.ab_map, self.mask = self.ab_grid.update_gamut(l_in=l_in)
+        self.ab_map, self.mask = self.ab_grid.get_gamut(l_in)
         self.update()
 
     def set_ab(self, color):
@@ -0,0 +1,108 @@
+import threading
+import numpy as np
+from PyQt5.QtCore import *
+
+
+class InferenceWorker(QThread):
+    ''' Runs model.net_forward off the GUI thread.
+
+    Only the newest request is kept: submitting while the network is busy
+    replaces whatever was still waiting, so a drag evaluates the latest hint
+    state instead of queueing every mouse event. Results come back through
+    result_ready, which Qt delivers in the GUI thread.
+    A request can carry a ladder of working sizes (model.net_forward_preview),
+    None standing for the full net_forward. Each rung is emitted as soon as it
+    is done and the next one only runs while no newer request is waiting.
+    Loading an image goes through load() as well, so the GUI thread never waits
+    for a forward pass; every full forward publishes `latest` for it to read
+    instead of the model. Anything else touching the model from another thread
+    should hold `lock`.
+    '''
+    # (img_id, output_ab 2xXxX)
+    result_ready = pyqtSignal(int, np.ndarray)
+
+    def __init__(self, model):
+        QThread.__init__(self)
+        self.model = model
+        self.lock = threading.RLock()  # held while the model runs
+        self._cond = threading.Condition()
+        self._request = None
+        self._load = None
+        self._busy = False
+        self.img_id = 0  # bumped by every load, requests carry the one they were made for
+        # (img_id, img_l, output_ab, model.dist_snapshot()) of the last full forward, None right after a load
+        self.latest = None
+        self._stop = False
+
+    def load(self, fn, *args):
+        # run fn(*args), e.g. model.load_image, on the worker thread before any newer request
+        with self._cond:
+            self.img_id += 1
+            self._load = (fn, args)
+            self._request = None  # made for the previous image
+            self.latest = None
+            self._cond.notify()
+
+    def submit(self, input_ab, input_mask, sizes=(None, )):
+        with self._cond:
+            self._request = (self.img_id, input_ab, input_mask, tuple(sizes))
+            self._cond.notify()
+
+    def idle(self):
+        with self._cond:
+            return self._load is None and self._request is None and not self._busy
+
+    def wait_idle(self):
+        # block until every submitted load and request has been evaluated
+        with self._cond:
+            while self._load is not None or self._request is not None or self._busy:
+                self._cond.wait()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self.wait()
+
+    def run(self):
+        self.model.prepare_thread()  # e.g. caffe's gpu mode is per thread
+        while True:
+            with self._cond:
+                while self._load is None and self._request is None and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                load, self._load = self._load, None
+                if load is None:
+                    img_id, input_ab, input_mask, sizes = self._request
+                    self._request = None
+                else:
+                    sizes = ()
+                self._busy = True
+
+            if load is not None:
+                with self.lock:
+                    load[0](*load[1])
+
+            for size in sizes:
+                if img_id != self.img_id:  # skip requests for an image that was replaced
+                    break
+                with self.lock:
+                    if size is None:
+                        self.model.net_forward(input_ab, input_mask, return_rgb=False)
+                        output_ab = self.model.output_ab
+                        latest = (img_id, self.model.img_l, output_ab, self.model.dist_snapshot())
+                    else:
+                        output_ab = self.model.net_forward_preview(input_ab, input_mask, size)
+                if size is None:
+                    with self._cond:
+                        if img_id == self.img_id:
+                            self.latest = latest
+                self.result_ready.emit(img_id, output_ab)
+                with self._cond:
+                    if self._request is not None or self._stop:  # the rest of the ladder is outdated
+                        break
+
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
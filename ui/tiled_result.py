@@ -0,0 +1,79 @@
+import numpy as np
+import cv2
+
+from data import color_space
+
+
+class TiledResult(object):
+    ''' The colorized result at window size, updated tile by tile.
+
+    update diffs a new network output against the ab values the shown tiles
+    were rendered from and only resizes and converts the tiles whose cubic
+    footprint contains a pixel that moved by more than ab_tol. Moving a hint
+    changes the output everywhere a little, but visibly only around the hint,
+    so during a drag the work follows the area that actually changes. A tile
+    left alone is within 2 * ab_tol of the new output. The resize is a
+    cv2.remap with the maps cv2.resize would use, so any tile can be rendered
+    on its own and the full image equals the cv2.resize result.
+    '''
+    def __init__(self, l_win, load_shape, tile=32, ab_tol=.5):
+        # l_win        hxw L channel of the window sized image
+        # load_shape   (H, W) of the network output
+        self.l_win = np.ascontiguousarray(l_win, dtype=np.float32)
+        h, w = self.l_win.shape
+        self.tile = tile
+        self.ab_tol = ab_tol
+        self.rgb = np.zeros((h, w, 3), np.uint8)
+        self.ab = None  # 2xHxW, what the shown tiles were rendered from
+        self.tiles_drawn = 0  # counts tiles rendered, for profiling
+        # source coordinate of each window pixel, as in cv2.resize
+        H, W = load_shape
+        map_x = ((np.arange(w) + .5) * W / w - .5).astype(np.float32)
+        map_y = ((np.arange(h) + .5) * H / h - .5).astype(np.float32)
+        self.map_x = np.tile(map_x, (h, 1))
+        self.map_y = np.tile(map_y[:, np.newaxis], (1, w))
+        # source rows / columns each tile row / column reads, the 4 cubic taps
+        self.row_src = self._footprint(map_y, H)
+        self.col_src = self._footprint(map_x, W)
+
+    def _footprint(self, coords, n):
+        starts = np.arange(0, len(coords), self.tile)
+        lo = np.floor(coords[starts]).astype(int) - 1
+        hi = np.floor(coords[np.minimum(starts + self.tile, len(coords)) - 1]).astype(int) + 3
+        return np.clip(lo, 0, n), np.clip(hi, 0, n)
+
+    def update(self, output_ab, full=False):
+        ''' INPUTS
+                output_ab   2xHxW   network output
+                full                render every tile, and from output_ab exactly
+            OUTPUTS
+                list of (x, y, w, h) window rectangles that changed '''
+        if full or self.ab is None:
+            self.ab = np.array(output_ab, dtype=np.float32)
+            dirty = np.ones((len(self.row_src[0]), len(self.col_src[0])), bool)
+        else:
+            changed = (np.abs(output_ab - self.ab) > self.ab_tol).any(axis=0)
+            if not changed.any():
+                return []
+            self.ab[:, changed] = output_ab[:, changed]
+            # changed pixels per tile footprint from the summed area table
+            sat = np.zeros((changed.shape[0] + 1, changed.shape[1] + 1), np.int32)
+            np.cumsum(np.cumsum(changed, axis=0), axis=1, out=sat[1:, 1:])
+            (r0, r1), (c0, c1) = self.row_src, self.col_src
+            dirty = (sat[r1[:, None], c1] - sat[r0[:, None], c1] - sat[r1[:, None], c0] + sat[r0[:, None], c0]) > 0
+        ab = np.ascontiguousarray(output_ab.transpose((1, 2, 0)), dtype=np.float32)
+        rects = []
+        for ty, row in enumerate(dirty):
+            # one rectangle per run of dirty tiles in a tile row
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.int8), [0]))))
+            for tx0, tx1 in zip(edges[::2], edges[1::2]):
+                rects.append(self._render(ab, ty * self.tile, tx0 * self.tile, self.tile, (tx1 - tx0) * self.tile))
+                self.tiles_drawn += tx1 - tx0
+        return rects
+
+    def _render(self, ab, y, x, h, w):
+        win = (slice(y, y + h), slice(x, x + w))
+        ab_win = cv2.remap(ab, self.map_x[win], self.map_y[win], cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        out = self.rgb[win]
+        color_space.lab_planes2rgb_uint8(self.l_win[win][np.newaxis], ab_win.transpose((2, 0, 1)), out=out)
+        return (x, y, out.shape[1], out.shape[0])
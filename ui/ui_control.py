@@ -1,265 +1,317 @@
 import numpy as np
+from collections import deque
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
-import cv2
 
+from data import color_space
 
-class UserEdit(object):
-    def __init__(self, mode, win_size, load_size, img_size):
-        self.mode = mode
-        self.win_size = win_size
-        self.img_size = img_size
-        self.load_size = load_size
-        print('image_size', self.img_size)
-        max_width = np.max(self.img_size)
-        self.scale = float(max_width) / self.load_size
-        self.dw = int((self.win_size - img_size[0]) // 2)
-        self.dh = int((self.win_size - img_size[1]) // 2)
-        self.img_w = img_size[0]
-        self.img_h = img_size[1]
-        self.ui_count = 0
-        print(self)
 
-    def scale_point(self, in_x, in_y, w):
-        x = int((in_x - self.dw) / float(self.img_w) * self.load_size) + w
-        y = int((in_y - self.dh) / float(self.img_h) * self.load_size) + w
-        return x, y
+class HintStore(object):
+    ''' Point hints kept as parallel arrays, one row per hint.
 
-    def __str__(self):
-        return "add (%s) with win_size %3.3f, load_size %3.3f" % (self.mode, self.win_size, self.load_size)
+    Rows are only ever appended and keep their position: erasing a hint just
+    clears alive[row], so undo can bring it back in place and the row order is
+    always the drawing order. A uniform grid over window coordinates lists,
+    for every cell, the rows whose hit box touches it, so hit-testing looks at
+    a handful of candidates no matter how many hints there are.
+    '''
+    # name, dtype, shape of one row
+    FIELDS = (('pnt', np.int32, (2,)),          # window x, y
+              ('width', np.float64, ()),        # half size in window pixels
+              ('color', np.uint8, (3,)),        # gamut snapped rgb
+              ('user_color', np.uint8, (3,)),   # rgb as picked by the user
+              ('ab', np.float32, (2,)),         # Lab ab of color
+              ('rect', np.int32, (4,)),         # y1, y2, x1, x2 in load_shape coordinates
+              ('ui_count', np.int64, ()),
+              ('alive', bool, ()))
 
+    def __init__(self, cell_size=32, capacity=64):
+        self.cell_size = cell_size
+        self.n = 0
+        for name, dtype, shape in self.FIELDS:
+            setattr(self, name, np.zeros((capacity,) + shape, dtype))
+        self.grid = {}  # (cell x, cell y) -> set of rows
 
-class PointEdit(UserEdit):
-    def __init__(self, win_size, load_size, img_size):
-        UserEdit.__init__(self, 'point', win_size, load_size, img_size)
+    def __len__(self):
+        return int(np.count_nonzero(self.alive[:self.n]))
 
-    def add(self, pnt, color, userColor, width, ui_count):
-        self.pnt = pnt
-        self.color = color
-        self.userColor = userColor
-        self.width = width
-        self.ui_count = ui_count
+    def rows(self):
+        # alive rows in drawing order
+        return np.flatnonzero(self.alive[:self.n])
 
-    def select_old(self, pnt, ui_count):
-        self.pnt = pnt
-        self.ui_count = ui_count
-        return self.userColor, self.width
+    def append(self, **values):
+        if self.n == self.alive.shape[0]:
+            for name, dtype, shape in self.FIELDS:
+                arr = getattr(self, name)
+                setattr(self, name, np.concatenate((arr, np.zeros_like(arr))))
+        row = self.n
+        self.n += 1
+        for name, value in values.items():
+            getattr(self, name)[row] = value
+        self.set_alive(row, True)
+        return row
 
-    def update_color(self, color, userColor):
-        self.color = color
-        self.userColor = userColor
-
-    def updateInput(self, im, mask, vis_im):
-        w = int(self.width / self.scale)
-        pnt = self.pnt
-        x1, y1 = self.scale_point(pnt.x(), pnt.y(), -w)
-        tl = (x1, y1)
-        x2, y2 = self.scale_point(pnt.x(), pnt.y(), w)
-        br = (x2, y2)
-        c = (self.color.red(), self.color.green(), self.color.blue())
-        uc = (self.userColor.red(), self.userColor.green(), self.userColor.blue())
-        cv2.rectangle(mask, tl, br, 255, -1)
-        cv2.rectangle(im, tl, br, c, -1)
-        cv2.rectangle(vis_im, tl, br, uc, -1)
-
-    def is_same(self, pnt):
-        dx = abs(self.pnt.x() - pnt.x())
-        dy = abs(self.pnt.y() - pnt.y())
-        return dx <= self.width + 1 and dy <= self.width + 1
+    def _cells(self, row):
+        x, y = self.pnt[row]
+        r = self.width[row] + 1
+        cs = self.cell_size
+        return [(cx, cy) for cx in range(int((x - r) // cs), int((x + r) // cs) + 1)
+                for cy in range(int((y - r) // cs), int((y + r) // cs) + 1)]
 
-    def update_painter(self, painter):
-        w = max(3, self.width)
-        c = self.color
-        r = c.red()
-        g = c.green()
-        b = c.blue()
-        ca = QColor(c.red(), c.green(), c.blue(), 255)
-        d_to_black = r * r + g * g + b * b
-        d_to_white = (255 - r) * (255 - r) + (255 - g) * (255 - g) + (255 - r) * (255 - r)
-        if d_to_black > d_to_white:
-            painter.setPen(QPen(Qt.black, 1))
-        else:
-            painter.setPen(QPen(Qt.white, 1))
-        painter.setBrush(ca)
-        painter.drawRoundedRect(self.pnt.x() - w, self.pnt.y() - w, 1 + 2 * w, 1 + 2 * w, 2, 2)
+    def set_alive(self, row, alive):
+        self.alive[row] = alive
+        for cell in self._cells(row):
+            if alive:
+                self.grid.setdefault(cell, set()).add(row)
+            else:
+                self.grid[cell].discard(row)
+
+    def move(self, row, pnt, width):
+        # change the hit box of a row, keeping the grid in sync
+        self.set_alive(row, False)
+        self.pnt[row] = pnt
+        self.width[row] = width
+        self.set_alive(row, True)
+
+    def find(self, x, y):
+        ''' First row in drawing order whose hit box, width + 1 around its point,
+        contains window position (x, y). None if no hint is hit. '''
+        cands = self.grid.get((x // self.cell_size, y // self.cell_size))
+        if not cands:
+            return None
+        cands = np.fromiter(cands, np.int64, len(cands))
+        r = self.width[cands] + 1
+        hit = (np.abs(self.pnt[cands, 0] - x) <= r) & (np.abs(self.pnt[cands, 1] - y) <= r)
+        if not hit.any():
+            return None
+        return int(cands[hit].min())
+
+    def overlapping(self, rect):
+        # alive rows whose rect intersects rect, in drawing order
+        y1, y2, x1, x2 = rect
+        rows = self.rows()
+        rects = self.rect[rows]
+        return rows[(rects[:, 0] < y2) & (rects[:, 1] > y1) & (rects[:, 2] < x2) & (rects[:, 3] > x1)]
 
 
 class UIControl:
     def __init__(self, win_size=256, load_size=512):
         self.win_size = win_size
         self.load_size = load_size
+        self.load_shape = (load_size, load_size)  # (H, W) of the hint planes, see setImageSize
+        self.max_history = None  # Maximum number of undo steps, None keeps everything
         self.reset()
-        self.userEdit = None
-        self.userEdits = []
-        self.ui_count = 0
-        
-        # Undo/Redo stacks
-        self.undo_stack = []
-        self.redo_stack = []
-        self.max_history = 50  # Maximum number of undo steps
 
-    def setImageSize(self, img_size):
+    def setImageSize(self, img_size, load_shape=None):
+        # img_size (w, h) of the image in the window; load_shape (H, W) of the hint
+        # planes, the model's load_shape for the image, square load_size by default.
+        # Call reset afterwards
         self.img_size = img_size
+        print('image_size', self.img_size)
+        self.load_shape = tuple(load_shape) if load_shape is not None else (self.load_size, self.load_size)
+        self.scale = float(np.max(img_size)) / max(self.load_shape)
+        self.dw = int((self.win_size - img_size[0]) // 2)
+        self.dh = int((self.win_size - img_size[1]) // 2)
+        self.img_w = img_size[0]
+        self.img_h = img_size[1]
+
+    def hint_rect(self, pnt, width):
+        # (y1, y2, x1, x2) slice bounds of a hint square in load_shape coordinates,
+        # the pixels a filled cv2.rectangle would cover
+        H, W = self.load_shape
+        w = int(width / self.scale)
+        x = int((pnt[0] - self.dw) / float(self.img_w) * W)
+        y = int((pnt[1] - self.dh) / float(self.img_h) * H)
+        return (max(y - w, 0), min(y + w + 1, H), max(x - w, 0), min(x + w + 1, W))
 
     def addStroke(self, prevPnt, nextPnt, color, userColor, width):
         pass
 
+    def find_point(self, pnt):
+        # row of the hint under window position pnt, or None
+        return self.hints.find(pnt.x(), pnt.y())
+
+    def num_points(self):
+        return len(self.hints)
+
     def erasePoint(self, pnt):
-        isErase = False
-        for id, ue in enumerate(self.userEdits):
-            if ue.is_same(pnt):
-                # Save state before erasing
-                self.save_state()
-                self.userEdits.remove(ue)
-                print('remove user edit %d\n' % id)
-                isErase = True
-                break
-        return isErase
+        row = self.find_point(pnt)
+        if row is None:
+            return False
+        self.hints.set_alive(row, False)
+        if self.selected == row:
+            self.selected = None
+        self.save_state('erase', row)
+        self.redraw(self.hints.rect[row])
+        print('remove user edit %d\n' % row)
+        return True
 
     def addPoint(self, pnt, color, userColor, width):
         self.ui_count += 1
         print('process add Point')
-        self.userEdit = None
-        isNew = True
-        for id, ue in enumerate(self.userEdits):
-            if ue.is_same(pnt):
-                self.userEdit = ue
-                isNew = False
-                print('select user edit %d\n' % id)
-                break
-
-        if self.userEdit is None:
-            # Save state before adding new point
-            self.save_state()
-            self.userEdit = PointEdit(self.win_size, self.load_size, self.img_size)
-            self.userEdits.append(self.userEdit)
-            print('add user edit %d\n' % len(self.userEdits))
-            self.userEdit.add(pnt, color, userColor, width, self.ui_count)
-            return userColor, width, isNew
+        self.selected = self.find_point(pnt)
+        if self.selected is None:
+            pnt = (pnt.x(), pnt.y())
+            self.selected = self.hints.append(pnt=pnt, width=width, rect=self.hint_rect(pnt, width), ui_count=self.ui_count)
+            self.set_colors(self.selected, color, userColor)
+            self.save_state('add', self.selected)
+            print('add user edit %d\n' % self.num_points())
+            self.paint(self.selected, self.hints.rect[self.selected])  # newest hint is on top
+            return userColor, width, True
         else:
-            userColor, width = self.userEdit.select_old(pnt, self.ui_count)
-            return userColor, width, isNew
+            print('select user edit %d\n' % self.selected)
+            row = self.selected
+            self.hints.ui_count[row] = self.ui_count
+            width = float(self.hints.width[row])
+            self.place(row, (pnt.x(), pnt.y()), width)
+            uc = self.hints.user_color[row]
+            return QColor(int(uc[0]), int(uc[1]), int(uc[2])), width, False
+
+    def place(self, row, pnt, width):
+        # move a hint and repaint where it was and where it is now
+        old_rect = self.hints.rect[row].copy()
+        self.hints.move(row, pnt, width)
+        self.hints.rect[row] = self.hint_rect(pnt, width)
+        self.redraw(old_rect)
+        self.redraw(self.hints.rect[row])
 
     def movePoint(self, pnt, color, userColor, width):
-        self.userEdit.add(pnt, color, userColor, width, self.ui_count)
+        if self.selected is None:  # its point was undone
+            return
+        self.set_colors(self.selected, color, userColor)
+        self.hints.ui_count[self.selected] = self.ui_count
+        self.place(self.selected, (pnt.x(), pnt.y()), width)
+
+    def set_colors(self, row, color, userColor):
+        c = np.array([color.red(), color.green(), color.blue()], np.uint8)
+        self.hints.color[row] = c
+        self.hints.user_color[row] = (userColor.red(), userColor.green(), userColor.blue())
+        # converted to Lab once here instead of per frame
+        self.hints.ab[row] = color_space.rgb2lab(c[np.newaxis, np.newaxis])[0, 0, 1:]
 
     def update_color(self, color, userColor):
-        self.userEdit.update_color(color, userColor)
+        if self.selected is None:
+            return
+        self.set_colors(self.selected, color, userColor)
+        self.redraw(self.hints.rect[self.selected])
 
     def update_painter(self, painter):
-        for ue in self.userEdits:
-            if ue is not None:
-                ue.update_painter(painter)
+        hints = self.hints
+        for row in hints.rows():
+            w = max(3, float(hints.width[row]))
+            x, y = [int(v) for v in hints.pnt[row]]
+            r, g, b = [int(v) for v in hints.color[row]]
+            ca = QColor(r, g, b, 255)
+            d_to_black = r * r + g * g + b * b
+            d_to_white = (255 - r) * (255 - r) + (255 - g) * (255 - g) + (255 - r) * (255 - r)
+            if d_to_black > d_to_white:
+                painter.setPen(QPen(Qt.black, 1))
+            else:
+                painter.setPen(QPen(Qt.white, 1))
+            painter.setBrush(ca)
+            painter.drawRoundedRect(x - w, y - w, 1 + 2 * w, 1 + 2 * w, 2, 2)
 
     def get_stroke_image(self, im):
         return im
 
     def used_colors(self):  # get recently used colors
-        if len(self.userEdits) == 0:
+        rows = self.hints.rows()
+        if len(rows) == 0:
             return None
-        nEdits = len(self.userEdits)
-        ui_counts = np.zeros(nEdits)
-        ui_colors = np.zeros((nEdits, 3))
-        for n, ue in enumerate(self.userEdits):
-            ui_counts[n] = ue.ui_count
-            c = ue.userColor
-            ui_colors[n, :] = [c.red(), c.green(), c.blue()]
-
-        ui_counts = np.array(ui_counts)
-        ids = np.argsort(-ui_counts)
-        ui_colors = ui_colors[ids, :]
-        unique_colors = []
-        for ui_color in ui_colors:
-            is_exit = False
-            for u_color in unique_colors:
-                d = np.sum(np.abs(u_color - ui_color))
-                if d < 0.1:
-                    is_exit = True
-                    break
-
-            if not is_exit:
-                unique_colors.append(ui_color)
-
-        unique_colors = np.vstack(unique_colors)
+        ids = np.argsort(-self.hints.ui_count[rows])
+        ui_colors = self.hints.user_color[rows[ids]]
+        # unique colors, in order of their most recent use
+        _, first = np.unique(ui_colors, axis=0, return_index=True)
+        unique_colors = ui_colors[np.sort(first)]
         return unique_colors / 255.0
 
     def get_input(self):
-        h = self.load_size
-        w = self.load_size
-        im = np.zeros((h, w, 3), np.uint8)
-        mask = np.zeros((h, w, 1), np.uint8)
-        vis_im = np.zeros((h, w, 3), np.uint8)
+        ''' OUTPUTS
+                im_ab     2xHxW     float32 ab of the hints, 0 elsewhere
+                im_mask   1xHxW     float32, 1 where a hint was placed
+            The planes are kept up to date as edits change, so this does no work.
+            The caller may hold on to them: the next edit writes to a copy. '''
+        self.planes_shared = True
+        return self.im_ab, self.im_mask
 
-        for ue in self.userEdits:
-            ue.updateInput(im, mask, vis_im)
+    def writable_planes(self):
+        # copy on write, so arrays handed out by get_input never change underneath
+        if self.planes_shared:
+            self.im_ab = self.im_ab.copy()
+            self.im_mask = self.im_mask.copy()
+            self.planes_shared = False
+        return self.im_ab, self.im_mask
 
-        return im, mask
+    def paint(self, row, clip):
+        # paint the part of a hint square inside clip into the ab and mask planes
+        rect = self.hints.rect[row]
+        y1, y2, x1, x2 = max(rect[0], clip[0]), min(rect[1], clip[1]), max(rect[2], clip[2]), min(rect[3], clip[3])
+        if y1 >= y2 or x1 >= x2:
+            return
+        im_ab, im_mask = self.writable_planes()
+        im_ab[:, y1:y2, x1:x2] = self.hints.ab[row, :, np.newaxis, np.newaxis]
+        im_mask[:, y1:y2, x1:x2] = 1
+
+    def redraw(self, rect):
+        # repaint one (y1, y2, x1, x2) rectangle of the planes from the hints overlapping it
+        y1, y2, x1, x2 = rect
+        if y1 >= y2 or x1 >= x2:
+            return
+        im_ab, im_mask = self.writable_planes()
+        im_ab[:, y1:y2, x1:x2] = 0
+        im_mask[:, y1:y2, x1:x2] = 0
+        for row in self.hints.overlapping(rect):
+            self.paint(row, rect)
 
     def reset(self):
-        self.userEdits = []
-        self.userEdit = None
+        self.hints = HintStore()
+        self.selected = None  # row of the hint being edited
         self.ui_count = 0
-        self.undo_stack = []
-        self.redo_stack = []
-    
-    def save_state(self):
-        """Save current state to undo stack"""
-        import copy
-        # Deep copy the current state
-        state = {
-            'userEdits': copy.deepcopy(self.userEdits),
-            'ui_count': self.ui_count
-        }
-        self.undo_stack.append(state)
-        
-        # Limit stack size
-        if len(self.undo_stack) > self.max_history:
-            self.undo_stack.pop(0)
-        
+        # Undo/Redo stacks of (kind, row, ui_count) entries
+        self.undo_stack = deque(maxlen=self.max_history)
+        self.redo_stack = deque()
+        self.im_ab = np.zeros((2, ) + self.load_shape, np.float32)
+        self.im_mask = np.zeros((1, ) + self.load_shape, np.float32)
+        self.planes_shared = False
+
+    def save_state(self, kind, row):
+        """Record an add or erase of a hint row in the undo history"""
+        self.undo_stack.append((kind, row, self.ui_count))
+
         # Clear redo stack when new action is performed
-        self.redo_stack = []
-    
+        self.redo_stack.clear()
+
+    def apply_op(self, op, reverse):
+        # (re)apply one history entry, returns the entry to push on the opposite stack
+        kind, row, ui_count = op
+        alive = (kind == 'add') != reverse
+        self.hints.set_alive(row, alive)
+        if not alive and self.selected == row:
+            self.selected = None
+        self.redraw(self.hints.rect[row])
+        op = (kind, row, self.ui_count)
+        self.ui_count = ui_count
+        return op
+
     def undo(self):
         """Undo last action"""
         if len(self.undo_stack) > 0:
-            # Save current state to redo stack
-            import copy
-            current_state = {
-                'userEdits': copy.deepcopy(self.userEdits),
-                'ui_count': self.ui_count
-            }
-            self.redo_stack.append(current_state)
-            
-            # Restore previous state
-            state = self.undo_stack.pop()
-            self.userEdits = state['userEdits']
-            self.ui_count = state['ui_count']
+            self.redo_stack.append(self.apply_op(self.undo_stack.pop(), reverse=True))
             return True
         return False
-    
+
     def redo(self):
         """Redo last undone action"""
         if len(self.redo_stack) > 0:
-            # Save current state to undo stack
-            import copy
-            current_state = {
-                'userEdits': copy.deepcopy(self.userEdits),
-                'ui_count': self.ui_count
-            }
-            self.undo_stack.append(current_state)
-            
-            # Restore next state
-            state = self.redo_stack.pop()
-            self.userEdits = state['userEdits']
-            self.ui_count = state['ui_count']
+            self.undo_stack.append(self.apply_op(self.redo_stack.pop(), reverse=False))
             return True
         return False
-    
+
     def can_undo(self):
         """Check if undo is available"""
         return len(self.undo_stack) > 0
-    
+
     def can_redo(self):
         """Check if redo is available"""
         return len(self.redo_stack) > 0